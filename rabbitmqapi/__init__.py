@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 
 from flask import Flask
+from . import defaults
 from .api import api
 
 
@@ -15,6 +16,7 @@ def create_app(cfg=None):
     :returns: a Flask application
     """
     app = Flask(__name__)
+    app.config.from_object(defaults)
     if cfg:
         app.config.from_pyfile(cfg)
 
@@ -1,124 +1,277 @@
 from __future__ import unicode_literals
 
 import json
-
-from flask import Blueprint, current_app, request, jsonify, abort
-
-from .http_client import send
+from collections import OrderedDict
+from functools import partial
+
+from flask import Blueprint, Response, current_app, request, jsonify, abort, make_response, url_for
+from werkzeug.exceptions import HTTPException
+
+from .cache import TTLCache
+from .checks import failed, get_check, run_check
+from .clusters import get_clusters
+from .definitions import Definitions, full_permissions
+from .http_client import send, stream, clients_stats
+from .idempotency import forget_instance, idempotent
+from .jobs import PENDING, RUNNING, FAILED, async_provisioning, get_jobs, job_handler, report_progress
+from .logs import RequestDump, log_response, start_timer
+from .metrics import get_metrics, instrument
+from .pipeline import Pipeline, map_in_context
+from .plans import ha_policy, ha_policy_name, get_plans
+from .rotation import ROTATE, RETIRE
+from .store import get_store
+from .usage import usage
 from .auth import requires_auth
-from .utils import generate_username, generate_password
+from .utils import app_extension, all_credentials, generate_username, get_credentials, previous_credentials, \
+    service_username
 
 
 api = Blueprint('api', __name__)
 
-#
-# Policies to allow high availability
-#
-ha_policy_name = "ha-queues"
-ha_policy = {
-    "vhost": None,
-    "name": ha_policy_name,
-    "pattern": "",
-    "apply-to": "all",
-    "definition": {
-        "ha-mode": "all",
-        "ha-sync-mode": "automatic"
-    },
-    "priority": 0
-}
-
-#
-# User permissions
-#
-full_permissions = {"configure": ".*", "write": ".*", "read": ".*"}
-
 
 def log_request():
-    """Debug incoming requests, useful to debug tsuru incoming calls"""
-    current_app.logger.debug('Got request: {request}\n{headers}{body}'.format(
-        request=str(request), headers=request.headers, body=request.get_data()
-    ))
+    """
+    Debug incoming requests, useful to debug tsuru incoming calls.
+
+    The request is only formatted, with its credentials and passwords redacted, if the debug message is emitted.
+    """
+    start_timer()
+    current_app.logger.debug('Got request: %s', RequestDump(request._get_current_object()))
 
 
 # we don't use the decorator form to leave the log_request function intact and unit-test it more cleanly
 api.before_request(log_request)
+api.after_request(log_response)
+instrument(api)
+
+
+@job_handler('add_instance')
+def create_instance(name, plan=None):
+    """
+    Create the vhost of the instance named <name>, with the permissions of the admin user, and the policies and
+    limits of its plan
+    """
+    vhost_url = 'vhosts/{name}'.format(name=name)
+    settings = get_plans().get(plan)
+    clusters = get_clusters()
+    cluster = clusters.place(name, plan)
+    vhost = settings.vhost()
+
+    #
+    # Only the vhost has to exist before the other calls, which can go out concurrently. Deleting the vhost also
+    # removes its permissions, policies and limits, so it is the only step that needs to be rolled back.
+    #
+    pipeline = Pipeline()
+    pipeline.add('vhost', partial(send, 'put', vhost_url, cluster=cluster,
+                                  **({'data': json.dumps(vhost)} if vhost else {})),
+                 rollback=partial(send, 'delete', vhost_url, cluster=cluster))
+
+    # Grant access in vhost to admin
+    pipeline.add('permissions', partial(
+        send, 'put', 'permissions/{instance_name}/{username}'.format(
+            username=cluster.user,
+            instance_name=name),
+        data=json.dumps(full_permissions), cluster=cluster
+    ), requires=['vhost'])
+
+    # add the policies of the plan, like the one for HA
+    for policy_name, policy in sorted(settings.policies(name).items()):
+        pipeline.add('policy {}'.format(policy_name), partial(
+            send, 'put', 'policies/{name}/{policy_name}'.format(
+                name=name,
+                policy_name=policy_name
+            ), data=json.dumps(policy), cluster=cluster
+        ), requires=['vhost'])
+
+    for limit, value in sorted(settings.limits().items()):
+        pipeline.add('limit {}'.format(limit), partial(
+            send, 'put', 'vhost-limits/{name}/{limit}'.format(name=name, limit=limit),
+            data=json.dumps({'value': value}), cluster=cluster
+        ), requires=['vhost'])
+
+    pipeline.run()
+    clusters.remember(name, cluster)
+    get_store().add_instance(name, cluster.name, settings.name or plan)
+
+
+def job_accepted(job_id, body=None):
+    """202 response to a request queued as the job <job_id>, pointing to the job endpoint"""
+    response = jsonify(body if body is not None else {'job': job_id})
+    response.status_code = 202
+    response.headers['Location'] = url_for('api.job', job_id=job_id)
+    response.headers['X-Job-Id'] = job_id
+    return response
 
 
 @api.route("/resources", methods=["POST"])
 @requires_auth
+@idempotent
 def add_instance():
-    """create a new instance of the service. This translates to a new vhost in RabbitMQ"""
+    """
+    create a new instance of the service. This translates to a new vhost in RabbitMQ
+
+    With ASYNC_PROVISIONING set, the instance is created by a background job, see `job`.
+    """
 
     if 'name' not in request.form:
         return 'Error, missing name argument', 400
 
-    send('put', 'vhosts/{name}'.format(name=request.form['name']))
+    name, plan = request.form['name'], request.form.get('plan')
+    try:
+        get_plans().get(plan)
+    except KeyError:
+        return 'Error, unknown plan {}'.format(plan), 400
+    if async_provisioning(current_app.config):
+        return job_accepted(get_jobs().enqueue('add_instance', name, name=name, plan=plan))
+    create_instance(name, plan)
+    return '', 201
 
-    # Grant access in vhost to admin
-    status = send('put', 'permissions/{instance_name}/{username}'.format(
-        username=current_app.config['RMQ_USER'],
-        instance_name=request.form['name']),
-        data=json.dumps(full_permissions),
-        raise_for_status=False)
 
-    if not status.ok:
-        send('delete', 'vhosts/{name}'.format(name=request.form['name']))
-        return abort(500, 'Error, rabbitmq returned status code {}'.format(status.status_code))
+def bound_users(name):
+    """The users of the bindings of the instance named <name> in the state store, derived with any of the salts"""
+    bindings = get_store().bindings_of(name)
+    usernames = set(bindings.values())
+    for credentials in all_credentials():
+        usernames.update(username for username, _ in credentials.derive_many(name, sorted(bindings)))
+    return usernames
 
-    # add automatic policies for HA
-    ha_policy['vhost'] = request.form['name']
-    status = send('put', 'policies/{name}/{policy_name}'.format(
-        name=request.form['name'],
-        policy_name=ha_policy_name
-        ), data=json.dumps(ha_policy), raise_for_status=False)
 
-    if not status.ok:
-        send('delete', 'vhosts/{name}'.format(name=request.form['name']))
-        return abort(500, 'Error, rabbitmq returned status code {}'.format(status.status_code))
+def instance_users(name, cluster):
+    """
+    The RabbitMQ users bound to the instance named <name>: the ones in the state store, plus the users named like
+    ours with permissions on its vhost, which the store of another worker may be the only one to know about
+    """
+    usernames = bound_users(name)
+    permissions = stream('vhosts/{}/permissions'.format(name), params={'columns': 'user'}, cluster=cluster)
+    usernames.update(permission['user'] for permission in permissions
+                     if service_username.match(permission['user']) and permission['user'].startswith(name[:20] + '_'))
+    usernames.discard(cluster.user)
+    return sorted(usernames)
 
-    return '', 201
+
+@job_handler('delete_instance')
+def destroy_instance(name):
+    """
+    Delete the instance named <name>: the users of its bound units, removed TEARDOWN_CHUNK_SIZE at a time with bulk
+    deletes, and then its vhost.
+
+    Users go first, so a teardown which fails half way finds the remaining ones through the permissions of the vhost
+    when run again. Deleting an instance which is already gone succeeds.
+    """
+    clusters = get_clusters()
+    cluster = clusters.locate(name)
+    exists = send('get', 'vhosts/{}'.format(name), raise_for_status=False, cluster=cluster).status_code != 404
+
+    usernames = instance_users(name, cluster) if exists else sorted(bound_users(name))
+    chunk_size = current_app.config['TEARDOWN_CHUNK_SIZE']
+    report_progress(users=len(usernames), deleted=0)
+    for start in range(0, len(usernames), chunk_size):
+        chunk = usernames[start:start + chunk_size]
+        send('post', 'users/bulk-delete', data=json.dumps({'users': chunk}), cluster=cluster)
+        report_progress(users=len(usernames), deleted=start + len(chunk))
+
+    if exists:
+        send('delete', 'vhosts/{name}'.format(name=name), cluster=cluster)
+    clusters.forget(name)
+    get_store().remove_instance(name)
+    forget_instance(name)
 
 
 @api.route("/resources/<name>", methods=["DELETE"])
 @requires_auth
 def delete_instance(name):
-    """delete a new instance of the service. This translates to removing a vhost in RabbitMQ"""
+    """
+    delete a new instance of the service. This translates to removing a vhost in RabbitMQ, and the users of the units
+    bound to it
 
-    send('delete', 'vhosts/{name}'.format(name=name))
+    With ASYNC_PROVISIONING set, the instance is deleted by a background job, whose progress is reported by `job`.
+    """
+    if async_provisioning(current_app.config):
+        return job_accepted(get_jobs().enqueue('delete_instance', name, name=name))
+    destroy_instance(name)
     return '', 200
 
 
-@api.route("/resources/<name>/bind-app", methods=["POST"])
-@requires_auth
-def bind_app(name):
+def binding_settings(name, app_host, cluster, credentials=None):
     """
-    Called every time an app adds an unit (container). This can be used to keep track of authentication details related
-    to the ip address of a container.
+    Connection settings handed to the unit `app_host` bound to the instance named <name>, living in `cluster`.
+
+    `credentials` are the username and password of the unit, derived if not given.
     """
-    app_host = request.form.get('app-host')
-    if not app_host:
-        return 'Parameter `app-host` is empty', 400
+    username, password = credentials or get_credentials().derive(name, app_host)
+    return dict(
+        RABBITMQ_HOST=cluster.host,
+        RABBITMQ_PORT=str(cluster.port),
+        RABBITMQ_VHOST=name,
+        RABBITMQ_USERNAME=username,
+        RABBITMQ_PASSWORD=password,
+    )
 
-    username, password = generate_username(name, app_host), generate_password(name, app_host)
+
+def bind_host(name, app_host):
+    """Create the RabbitMQ user of `app_host` in the instance named <name>, returning its connection settings"""
+    cluster = get_clusters().locate(name)
+    settings = binding_settings(name, app_host, cluster)
+    username, password = settings['RABBITMQ_USERNAME'], settings['RABBITMQ_PASSWORD']
 
     # create the user
-    send('put', 'users/{username}'.format(username=username), data=json.dumps({"password": password, "tags": ""}))
+    send('put', 'users/{username}'.format(username=username), data=json.dumps({"password": password, "tags": ""}),
+         cluster=cluster)
     permissions_granted = send(
         'put', 'permissions/{instance_name}/{username}'.format(username=username, instance_name=name),
         data=json.dumps(full_permissions),
-        raise_for_status=False
+        raise_for_status=False, cluster=cluster
     )
     if not permissions_granted.ok:
-        send('delete', 'users/{username}'.format(username=username))
+        send('delete', 'users/{username}'.format(username=username), cluster=cluster)
         return abort(500, 'Error, rabbitmq returned status code {}'.format(permissions_granted.status_code))
 
-    return jsonify(
-        RABBITMQ_HOST=current_app.config['RMQ_HOST'],
-        RABBITMQ_PORT=str(current_app.config['RMQ_PORT']),
-        RABBITMQ_VHOST=name,
-        RABBITMQ_USERNAME=username,
-        RABBITMQ_PASSWORD=password,
-    ), 201
+    get_store().add_binding(name, app_host, username)
+    return settings
+
+
+@job_handler('bind_app')
+def bind_job(name, app_host):
+    # the connection settings are not kept with the job, they hold the password
+    bind_host(name, app_host)
+
+
+def unbind_host(name, app_host):
+    """Delete the RabbitMQ user of `app_host` in the instance named <name>"""
+    username = generate_username(name, app_host)
+    cluster = get_clusters().locate(name)
+    previous = [credentials.derive(name, app_host)[0] for credentials in previous_credentials()]
+    if previous:
+        # while SALT is rotated, the unit may still use the user of a previous salt; bulk deletes skip missing users
+        send('post', 'users/bulk-delete', data=json.dumps({'users': [username] + previous}), cluster=cluster)
+    else:
+        send('delete', 'users/{username}'.format(username=username), cluster=cluster)
+    get_store().remove_binding(name, app_host)
+    forget_instance(name)
+
+
+def replayed_binding(name):
+    """Body of a replayed bind, derived again rather than recorded since it holds the password of the unit"""
+    return jsonify(**binding_settings(name, request.form['app-host'], get_clusters().locate(name))).get_data()
+
+
+@api.route("/resources/<name>/bind-app", methods=["POST"])
+@requires_auth
+@idempotent(body=replayed_binding)
+def bind_app(name):
+    """
+    Called every time an app adds an unit (container). This can be used to keep track of authentication details related
+    to the ip address of a container.
+    """
+    app_host = request.form.get('app-host')
+    if not app_host:
+        return 'Parameter `app-host` is empty', 400
+
+    if async_provisioning(current_app.config):
+        # the credentials do not depend on RabbitMQ, the unit gets them right away and they work once the job is done
+        job_id = get_jobs().enqueue('bind_app', name, name=name, app_host=app_host)
+        return job_accepted(job_id, binding_settings(name, app_host, get_clusters().locate(name)))
+    return jsonify(**bind_host(name, app_host)), 201
 
 
 @api.route("/resources/<name>/bind-app", methods=["DELETE"])
@@ -127,26 +280,170 @@ def unbind_app(name):
     app_host = request.form.get("app-host")
     if not app_host:
         return 'Parameter `app-host` is empty', 400
-    username = generate_username(name, app_host)
-    send('delete', 'users/{username}'.format(username=username))
+    unbind_host(name, app_host)
     return "", 200
 
 
+def batch_app_hosts():
+    """The distinct `app-host` parameters of the request, in order"""
+    return list(OrderedDict.fromkeys(host for host in request.form.getlist('app-host') if host))
+
+
+def batch(func, name, app_hosts, status_code=200):
+    """
+    Run `func(name, app_host)` concurrently for every host in `app_hosts`, returning a JSON response with the result
+    of each host under `bindings` and the error of each failed host under `errors`.
+    """
+    results, errors = {}, {}
+    outcomes = map_in_context(lambda app_host: func(name, app_host), app_hosts,
+                              current_app.config['BATCH_CONCURRENCY'])
+    for app_host, (ok, result) in zip(app_hosts, outcomes):
+        if ok:
+            results[app_host] = result
+        else:
+            errors[app_host] = getattr(result, 'description', None) or str(result)
+    return jsonify(bindings=results, errors=errors), 500 if errors else status_code
+
+
+@api.route("/resources/<name>/bind-app/batch", methods=["POST"])
+@requires_auth
+def bind_app_batch(name):
+    """
+    Bind several units at once, `app-host` may be given many times. Returns the connection settings of each one.
+
+    With BULK_DEFINITIONS set, every user and permission is created with a single definitions import, falling back
+    to one bind per unit if RabbitMQ rejects it.
+    """
+    app_hosts = batch_app_hosts()
+    if not app_hosts:
+        return 'Parameter `app-host` is empty', 400
+
+    if current_app.config['BULK_DEFINITIONS'] and len(app_hosts) > 1:
+        cluster = get_clusters().locate(name)
+        bindings = dict(
+            (app_host, binding_settings(name, app_host, cluster, credentials))
+            for app_host, credentials in zip(app_hosts, get_credentials().derive_many(name, app_hosts))
+        )
+        definitions = Definitions()
+        for settings in bindings.values():
+            definitions.add_user(settings['RABBITMQ_USERNAME'], settings['RABBITMQ_PASSWORD'])
+            definitions.add_permission(name, settings['RABBITMQ_USERNAME'], full_permissions)
+        if definitions.submit(fallback=False, cluster=cluster):
+            get_store().add_bindings(name, dict(
+                (app_host, settings['RABBITMQ_USERNAME']) for app_host, settings in bindings.items()))
+            return jsonify(bindings=bindings, errors={}), 201
+
+    return batch(bind_host, name, app_hosts, status_code=201)
+
+
+@api.route("/resources/<name>/bind-app/batch", methods=["DELETE"])
+@requires_auth
+def unbind_app_batch(name):
+    """Unbind several units at once, `app-host` may be given many times"""
+    app_hosts = batch_app_hosts()
+    if not app_hosts:
+        return 'Parameter `app-host` is empty', 400
+    return batch(unbind_host, name, app_hosts)
+
+
+def status_cache():
+    """Cache of the status check results, see `status`"""
+    return app_extension('status_cache', lambda app: TTLCache(
+        maxsize=app.config['STATUS_CACHE_SIZE'],
+        ttl=app.config['STATUS_CACHE_TTL'],
+        negative_ttl=app.config['STATUS_CACHE_NEGATIVE_TTL'],
+    ))
+
+
 @api.route("/resources/<name>/status", methods=["GET"])
 @requires_auth
 def status(name):
-    """check the status of the instance named <name>"""
-    response = send('get', 'aliveness-test/{name}'.format(name=name))
-    try:
-        response_data = response.json()['status']
-    except (ValueError, KeyError):
-        return 'Error pinging service, malformed response from rabbitmq, content: {}'.format(
-            response.text), 500
+    """
+    check the status of the instance named <name>
+
+    Instances are checked the way their plan says, or STATUS_CHECK, see `checks.CHECKS`. Results are cached for a
+    while, concurrent checks of the same instance share a single call to RabbitMQ, and the check used and the seconds
+    it took are told by the X-Check and X-Check-Latency headers.
+
+    With ASYNC_PROVISIONING set, instances still being created answer with a 202 status, and instances whose
+    creation failed with a 500 status.
+    """
+    if async_provisioning(current_app.config):
+        job = get_jobs().latest(name, 'add_instance')
+        if job is not None and job['state'] in (PENDING, RUNNING):
+            return 'Instance is being created', 202
+        if job is not None and job['state'] == FAILED:
+            return 'Error creating the instance: {}'.format(job['error']), 500
+    check = get_check(get_plans().of(get_store().instance(name)).check or current_app.config['STATUS_CHECK'])
+    result, latency = status_cache().get_or_compute(check.key(name), partial(run_check, check, name),
+                                                    is_negative=failed)
+    response = result.get_response() if isinstance(result, HTTPException) else make_response(result)
+    response.headers['X-Check'] = check.name
+    response.headers['X-Check-Latency'] = '{:.6f}'.format(latency)
+    return response
+
+
+@api.route("/resources/<name>/usage", methods=["GET"])
+@requires_auth
+def instance_usage(name):
+    """Queues, message backlog and rates, connections and memory of the instance named <name>, see `usage.usage`"""
+    return jsonify(**usage(name))
+
+
+@api.route("/usage", methods=["GET"])
+@requires_auth
+def usages():
+    """Usage of every instance, by name"""
+    return jsonify(instances=usage())
+
+
+@api.route("/credentials/rotate", methods=["POST"])
+@requires_auth
+def rotate():
+    """Create the users of the current SALT for every bound unit, in a background job"""
+    if not current_app.config['STATE_STORE_PATH']:
+        return 'Error, rotating credentials needs a persistent state store', 400
+    return job_accepted(get_jobs().enqueue(ROTATE, None))
+
+
+@api.route("/credentials/retire", methods=["POST"])
+@requires_auth
+def retire():
+    """Delete the users of the PREVIOUS_SALTS of every rotated binding, in a background job"""
+    if not current_app.config['STATE_STORE_PATH']:
+        return 'Error, retiring credentials needs a persistent state store', 400
+    if not current_app.config['PREVIOUS_SALTS']:
+        return 'Error, there are no PREVIOUS_SALTS to retire', 400
+    return job_accepted(get_jobs().enqueue(RETIRE, None))
 
-    if not (response_data == 'ok'):
-        return 'Error pinging rabbitmq, content: {}'.format(response.text), 500
 
-    return "", 204
+@api.route("/jobs/<job_id>", methods=["GET"])
+@requires_auth
+def job(job_id):
+    """State of a provisioning job queued with ASYNC_PROVISIONING set: pending, running, done or failed"""
+    job = get_jobs().get(job_id)
+    if job is None:
+        return 'Unknown job', 404
+    return jsonify(**job)
+
+
+@api.route("/stats", methods=["GET"])
+@requires_auth
+def stats():
+    """Internal counters, useful to tune the service"""
+    return jsonify(
+        status_cache=status_cache().stats(),
+        state_store=get_store().stats(),
+        management_api=clients_stats(),
+        jobs=get_jobs().stats() if async_provisioning(current_app.config) else None,
+    )
+
+
+@api.route("/metrics", methods=["GET"])
+@requires_auth
+def metrics():
+    """Latency histograms, counters and gauges of the requests served and of the management API calls made"""
+    return Response(get_metrics().render(), mimetype='text/plain; version=0.0.4')
 
 
 #
@@ -178,10 +475,5 @@ def unbind_unit(name):
 
 @api.route("/resources/plans", methods=["GET"])
 def plans():
-    """Placeholder until we figure out what plans we could expose."""
-    #
-    # Use dumps instead of jsonify to return a top level array, see
-    # http://flask.pocoo.org/docs/0.10/security/#json-security
-    # It is safe if we don't do any user-data processing.
-    #
-    return json.dumps([])
+    """The plans instances can be created with, see PLANS"""
+    return Response(get_plans().response, mimetype='application/json')
@@ -1,6 +1,18 @@
 from __future__ import unicode_literals
 
 from . import create_app
+from .jobs import async_provisioning, get_jobs
+from .reconciler import Reconciler
 
 
 app = create_app('../service.cfg')
+
+if app.config['RECONCILE_INTERVAL']:
+    Reconciler(app).start()
+
+if app.config['ASYNC_PROVISIONING'] and not async_provisioning(app.config):
+    app.logger.warning('Provisioning synchronously, ASYNC_PROVISIONING needs a persistent state store')
+elif app.config['ASYNC_PROVISIONING']:
+    # run the jobs left behind by previous worker processes
+    with app.app_context():
+        get_jobs().start()
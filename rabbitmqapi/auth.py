@@ -1,16 +1,78 @@
 from __future__ import unicode_literals
 
+import base64
+import binascii
+import hmac
+import threading
+from collections import OrderedDict
 from functools import wraps
-from flask import request, Response, current_app
+from flask import request, Response
+
+from .utils import app_extension
+
+
+class Authenticator(object):
+    """
+    Checks HTTP basic auth credentials against a set of username and password pairs.
+
+    Passwords are looked up by username and compared in constant time. The last `cache_size` Authorization headers
+    found valid are remembered, so the headers tsuru sends over and over are not decoded and checked again.
+    """
+
+    def __init__(self, credentials, cache_size=256):
+        self.passwords = dict((username, password.encode('utf-8')) for username, password in credentials.items())
+        self.cache_size = cache_size
+        self._verified = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        credentials = dict(config['EXTRA_CREDENTIALS'] or {})
+        credentials[config['USERNAME']] = config['PASSWORD']
+        return cls(credentials, config['AUTH_CACHE_SIZE'])
+
+    def check(self, username, password):
+        expected = self.passwords.get(username)
+        # compare even for unknown users, so they take as long as known ones
+        matches = hmac.compare_digest(expected or b'\0', password.encode('utf-8'))
+        return expected is not None and matches
+
+    def verify(self, header):
+        """Tell whether the value of an Authorization header carries valid credentials"""
+        if not header:
+            return False
+        with self._lock:
+            if header in self._verified:
+                return True
+        scheme, _, value = header.partition(' ')
+        if scheme.lower() != 'basic':
+            return False
+        try:
+            username, _, password = base64.b64decode(value.strip()).decode('utf-8').partition(':')
+        except (binascii.Error, TypeError, ValueError):
+            return False
+        if not self.check(username, password):
+            return False
+        with self._lock:
+            self._verified[header] = True
+            while len(self._verified) > self.cache_size:
+                self._verified.popitem(last=False)
+        return True
+
+
+def get_authenticator():
+    """Return the authenticator of the current app, loaded from its configuration the first time"""
+    return app_extension('authenticator', lambda app: Authenticator.from_config(app.config))
 
 
 def requires_auth(f):
-    """Authenticate incoming requests against app.config['USERNAME'] and app.config['PASSWORD'] using HTTP basic auth"""
+    """
+    Authenticate incoming requests using HTTP basic auth against app.config['USERNAME'] and app.config['PASSWORD'],
+    or any of the pairs of app.config['EXTRA_CREDENTIALS']
+    """
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.authorization
-        if not auth or not (auth.username == current_app.config['USERNAME'] and
-                            auth.password == current_app.config['PASSWORD']):
+        if not get_authenticator().verify(request.headers.get('Authorization')):
             return Response('Login Required', 401,
                             {'WWW-Authenticate': 'Basic realm="Login Required"'})
         return f(*args, **kwargs)
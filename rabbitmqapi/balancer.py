@@ -0,0 +1,118 @@
+from __future__ import unicode_literals
+
+import itertools
+import random
+import threading
+import time
+
+
+class Node(object):
+    """A management API endpoint of a cluster, with the calls it is serving and its recent latency"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0
+        self.ejected = False
+
+    def __repr__(self):
+        return '<Node {}>'.format(self.base_url)
+
+    def stats(self):
+        return {'outstanding': self.outstanding, 'latency': self.latency, 'ejected': self.ejected}
+
+
+class Balancer(object):
+    """
+    Spreads management API calls over the nodes of a cluster, every one of which serves the whole API.
+
+    With the `least-outstanding` strategy, calls go to the node serving the fewest calls, taking turns between equally
+    busy ones. With the `latency` strategy, nodes are picked at random, weighted by the inverse of their latency, an
+    exponentially weighted moving average of the time their last calls took.
+
+    Nodes failing `eject_threshold` calls in a row are ejected: they get no calls while a background thread probes
+    them every `probe_interval` seconds with `probe(node)`, until it answers. If every node is ejected, calls go to
+    all of them.
+    """
+
+    strategies = ('least-outstanding', 'latency')
+
+    def __init__(self, base_urls, strategy='least-outstanding', eject_threshold=3, probe=None, probe_interval=5,
+                 decay=0.3):
+        if strategy not in self.strategies:
+            raise ValueError('Unknown balancing strategy {}'.format(strategy))
+        self.nodes = [Node(base_url) for base_url in base_urls]
+        self.strategy = strategy
+        self.eject_threshold = eject_threshold
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self.decay = decay
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        self._prober = None
+
+    def pick(self, avoid=None):
+        """Choose the node of the next call, preferring another one than `avoid`, like the node a retry failed on"""
+        with self._lock:
+            candidates = [node for node in self.nodes if not node.ejected] or self.nodes
+            candidates = [node for node in candidates if node is not avoid] or candidates
+            if len(candidates) == 1:
+                node = candidates[0]
+            elif self.strategy == 'latency':
+                node = self._weighted(candidates)
+            else:
+                # rotating the candidates makes equally busy nodes take turns
+                turn = next(self._turn) % len(candidates)
+                node = min(candidates[turn:] + candidates[:turn], key=lambda node: node.outstanding)
+            node.outstanding += 1
+            return node
+
+    def _weighted(self, candidates):
+        known = [node.latency for node in candidates if node.latency is not None]
+        # nodes without a latency yet are weighted like the fastest one, so they get calls and a latency
+        fastest = min(known) if known else 1
+        weights = [1.0 / max(node.latency if node.latency is not None else fastest, 1e-4) for node in candidates]
+        threshold = random.uniform(0, sum(weights))
+        for node, weight in zip(candidates, weights):
+            threshold -= weight
+            if threshold <= 0:
+                return node
+        return candidates[-1]
+
+    def release(self, node, latency, failed=False):
+        """Record the end of a call picked with `pick`, which took `latency` seconds, None if it was interrupted"""
+        with self._lock:
+            node.outstanding -= 1
+            if latency is None:
+                return
+            if not failed:
+                node.failures = 0
+                node.latency = latency if node.latency is None else \
+                    self.decay * latency + (1 - self.decay) * node.latency
+                return
+            node.failures += 1
+            if node.failures < self.eject_threshold or node.ejected or self.probe is None:
+                return
+            node.ejected = True
+            if self._prober is None:
+                self._prober = threading.Thread(target=self._probe, name='balancer-probe')
+                self._prober.daemon = True
+                self._prober.start()
+
+    def _probe(self):
+        while True:
+            time.sleep(self.probe_interval)
+            with self._lock:
+                ejected = [node for node in self.nodes if node.ejected]
+                if not ejected:
+                    self._prober = None
+                    return
+            for node in ejected:
+                if self.probe(node):
+                    with self._lock:
+                        node.ejected, node.failures, node.latency = False, 0, None
+
+    def stats(self):
+        with self._lock:
+            return dict((node.base_url, node.stats()) for node in self.nodes)
@@ -0,0 +1,151 @@
+"""
+Load benchmark of the service API against an in-process fake of the RabbitMQ management API.
+
+Run it with `python -m rabbitmqapi.benchmark --help` to see the available options. Each client creates instances,
+binds units to them and checks their status, and the report shows the latency percentiles and throughput of each
+endpoint, along with the calls each one caused to the management API.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import base64
+import math
+import threading
+import time
+from collections import defaultdict
+
+from . import create_app
+from .fake_rmq import FakeManagementAPI
+
+
+BENCHMARK_CONFIG = dict(
+    USERNAME='benchmark',
+    PASSWORD='benchmark',
+    RMQ_HOST='rabbitmq.benchmark',
+    RMQ_USER='admin',
+    RMQ_PASSWORD='admin',
+    SALT='benchmark',
+)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted `values`"""
+    if not values:
+        return 0
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+
+class Benchmark(object):
+    """Drives the app with concurrent clients, recording the latency of each call"""
+
+    def __init__(self, clients=10, iterations=10, binds=5, statuses=5, config=None, **fake_settings):
+        self.clients = clients
+        self.iterations = iterations
+        self.binds = binds
+        self.statuses = statuses
+        self.fake = FakeManagementAPI(**fake_settings)
+        self.app = create_app()
+        self.app.config.from_mapping(BENCHMARK_CONFIG, RMQ_ADAPTER=self.fake, **(config or {}))
+        self.headers = {'Authorization': 'Basic {}'.format(base64.b64encode('{}:{}'.format(
+            self.app.config['USERNAME'], self.app.config['PASSWORD']).encode('utf-8')).decode('utf-8'))}
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.elapsed = {}
+        self.upstream = {}
+        self._lock = threading.Lock()
+
+    def call(self, client, endpoint, method, url, expected, **kwargs):
+        started = time.time()
+        response = getattr(client, method)(url, headers=self.headers, **kwargs)
+        latency = time.time() - started
+        with self._lock:
+            self.latencies[endpoint].append(latency)
+            if response.status_code != expected:
+                self.errors[endpoint] += 1
+
+    def add_instances(self, client, number):
+        for iteration in range(self.iterations):
+            self.call(client, 'add_instance', 'post', '/resources', 201,
+                      data={'name': 'bench-{}-{}'.format(number, iteration)})
+
+    def bind_apps(self, client, number):
+        for iteration in range(self.iterations):
+            for unit in range(self.binds):
+                self.call(client, 'bind_app', 'post', '/resources/bench-{}-{}/bind-app'.format(number, iteration),
+                          201, data={'app-host': 'unit{}'.format(unit)})
+
+    def statuses_of(self, client, number):
+        for iteration in range(self.iterations):
+            for _ in range(self.statuses):
+                self.call(client, 'status', 'get', '/resources/bench-{}-{}/status'.format(number, iteration), 204)
+
+    def phase(self, endpoint, work):
+        """Run `work` with every client at once, recording the elapsed time and management API calls it caused"""
+        clients = [self.app.test_client() for _ in range(self.clients)]
+        threads = [threading.Thread(target=work, args=(client, number)) for number, client in enumerate(clients)]
+        calls = self.fake.calls.copy()
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed[endpoint] = time.time() - started
+        self.upstream[endpoint] = dict(
+            ('{} {}'.format(*key), count - calls[key]) for key, count in self.fake.calls.items() if count != calls[key]
+        )
+
+    def run(self):
+        # endpoints are benchmarked one after the other, so the management API calls of each one can be told apart
+        self.phase('add_instance', self.add_instances)
+        self.phase('bind_app', self.bind_apps)
+        self.phase('status', self.statuses_of)
+        return self.report()
+
+    def report(self):
+        """Statistics of each endpoint, latencies are in milliseconds"""
+        report = {}
+        for endpoint, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            report[endpoint] = {
+                'requests': len(latencies),
+                'errors': self.errors[endpoint],
+                'p50': percentile(latencies, 0.50) * 1000,
+                'p95': percentile(latencies, 0.95) * 1000,
+                'p99': percentile(latencies, 0.99) * 1000,
+                'rps': len(latencies) / self.elapsed[endpoint] if self.elapsed[endpoint] else 0,
+                'upstream': self.upstream[endpoint],
+            }
+        return report
+
+
+def print_report(report):
+    print('{:<14} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+        'endpoint', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+    for endpoint, stats in sorted(report.items()):
+        print('{:<14} {requests:>9} {errors:>7} {p50:>9.2f} {p95:>9.2f} {p99:>9.2f} {rps:>9.1f}'.format(
+            endpoint, **stats))
+
+    print('\n{:<14} {:<40} {:>9}'.format('endpoint', 'management API call', 'calls'))
+    for endpoint, stats in sorted(report.items()):
+        for call, count in sorted(stats['upstream'].items()):
+            print('{:<14} {:<40} {:>9}'.format(endpoint, call, count))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--clients', type=int, default=10, help='concurrent clients')
+    parser.add_argument('--iterations', type=int, default=10, help='instances created by each client')
+    parser.add_argument('--binds', type=int, default=5, help='units bound to each instance')
+    parser.add_argument('--statuses', type=int, default=5, help='status checks of each instance')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds each management API call takes')
+    parser.add_argument('--jitter', type=float, default=0.002, help='maximum variation of the latency, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='probability of a management API call failing')
+    args = parser.parse_args(argv)
+
+    benchmark = Benchmark(clients=args.clients, iterations=args.iterations, binds=args.binds, statuses=args.statuses,
+                          latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    print_report(benchmark.run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+from collections import OrderedDict
+
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+class _Flight(object):
+    """An upstream call in progress, which concurrent lookups of the same key wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class TTLCache(object):
+    """
+    Bounded LRU cache whose entries expire after a while.
+
+    Concurrent lookups of a missing key are coalesced: only the first one computes the value, the others wait for it
+    and get the same result (or exception). Values considered negative get their own, usually shorter, TTL.
+    """
+
+    def __init__(self, maxsize=1024, ttl=5, negative_ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.hits = self.misses = self.coalesced = 0
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, func, is_negative=None):
+        """Return the cached value of `key`, calling `func` to compute it if missing or expired"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > clock():
+                # re-inserting the key marks it as the most recently used one
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return flight.wait()
+
+        completed = False
+        try:
+            flight.value = func()
+            completed = True
+        except BaseException as e:
+            # including the GreenletExit or Timeout of a gevent worker, so waiters do not get a None value
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if completed:
+                    self._store(key, flight.value, is_negative)
+                del self._flights[key]
+            flight.done.set()
+        return flight.value
+
+    def _store(self, key, value, is_negative):
+        ttl = self.negative_ttl if is_negative and is_negative(value) else self.ttl
+        if ttl <= 0:
+            return
+        self._entries[key] = (clock() + ttl, value)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def evict(self, predicate):
+        """Drop the entries whose key matches `predicate`"""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+        }
@@ -0,0 +1,239 @@
+from __future__ import unicode_literals
+
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from werkzeug.exceptions import HTTPException
+
+from .cache import clock
+from .clusters import get_clusters
+from .http_client import send
+from .metrics import get_metrics
+from .utils import app_extension
+
+try:
+    import pika
+except ImportError:  # AMQP checks are optional
+    pika = None
+
+
+class Check(object):
+    """
+    A way of checking the health of an instance, see `status`.
+
+    Calling a check with the name of an instance returns the response of the `status` view: an empty 204 response if
+    the instance is healthy, or an error message and a 500 status, or the HTTPException to raise. Results are cached
+    by the `key` of the instance.
+    """
+
+    name = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls()
+
+    def key(self, name):
+        return self.name, name
+
+    def __call__(self, name):
+        raise NotImplementedError
+
+
+class AlivenessCheck(Check):
+    """Declares a queue in the vhost of the instance, publishes a message to it and consumes it: the heaviest check"""
+
+    name = 'aliveness'
+
+    def __call__(self, name):
+        try:
+            response = send('get', 'aliveness-test/{name}'.format(name=name), cluster=get_clusters().locate(name))
+        except HTTPException as e:
+            # returned instead of raised so it is cached as a negative result, and raised again for every request
+            return e
+        try:
+            response_data = response.json()['status']
+        except (ValueError, KeyError):
+            return 'Error pinging service, malformed response from rabbitmq, content: {}'.format(
+                response.text), 500
+
+        if not (response_data == 'ok'):
+            return 'Error pinging rabbitmq, content: {}'.format(response.text), 500
+
+        return "", 204
+
+
+class VirtualHostsCheck(Check):
+    """
+    Asks RabbitMQ whether every vhost of the cluster is running, with the health check endpoint of RabbitMQ 3.8.10
+    and later. A single call checks every instance of a cluster, so results are cached by cluster, but they do not
+    tell whether the vhost of an instance exists.
+    """
+
+    name = 'health'
+
+    def key(self, name):
+        return self.name, get_clusters().locate(name).name
+
+    def __call__(self, name):
+        try:
+            response = send('get', 'health/checks/virtual-hosts', raise_for_status=False,
+                            cluster=get_clusters().locate(name))
+        except HTTPException as e:
+            return e
+        if response.ok:
+            return '', 204
+        if response.status_code != 503:
+            return 'Error, rabbitmq returned status code {}'.format(response.status_code), 500
+        try:
+            reason = response.json()['reason']
+        except (ValueError, KeyError):
+            reason = response.text
+        return 'Error, virtual hosts are down: {}'.format(reason), 500
+
+
+class VhostCheck(Check):
+    """Reads the vhost of the instance, checking it exists and is running on every node of the cluster"""
+
+    name = 'vhost'
+
+    def __call__(self, name):
+        try:
+            response = send('get', 'vhosts/{}'.format(name), raise_for_status=False,
+                            params={'columns': 'cluster_state'}, cluster=get_clusters().locate(name))
+        except HTTPException as e:
+            return e
+        if response.status_code == 404:
+            return 'Error, vhost {} not found'.format(name), 500
+        if not response.ok:
+            return 'Error, rabbitmq returned status code {}'.format(response.status_code), 500
+        try:
+            states = response.json().get('cluster_state') or {}
+        except (ValueError, AttributeError):
+            return 'Error, malformed response from rabbitmq, content: {}'.format(response.text), 500
+        stopped = sorted(node for node, state in states.items() if state != 'running')
+        if stopped:
+            return 'Error, vhost {} is not running on {}'.format(name, ', '.join(stopped)), 500
+        return '', 204
+
+
+class _Pooled(object):
+    """A pooled AMQP connection, used by a single check at a time"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def close(self):
+        connection, self.connection = self.connection, None
+        try:
+            if connection is not None and connection.is_open:
+                connection.close()
+        except Exception:
+            pass
+
+
+class AMQPCheck(Check):
+    """
+    Opens and closes a channel on a long-lived AMQP connection to the vhost of the instance, with the credentials of
+    the cluster. Opening a channel is cheap, yet goes through the AMQP listener and the vhost of the instance.
+
+    Connections are kept in a bounded LRU pool, one per instance, and opened again when found closed. Needs the
+    pika library.
+    """
+
+    name = 'amqp'
+
+    def __init__(self, pool_size=64, timeout=5, connect=None):
+        if connect is None and pika is None:
+            raise RuntimeError('The amqp status check needs the pika library')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connect = connect or self._connect
+        self._pool = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['AMQP_CHECK_POOL_SIZE'], config['AMQP_CHECK_TIMEOUT'])
+
+    def _connect(self, cluster, vhost):
+        return pika.BlockingConnection(pika.ConnectionParameters(
+            host=cluster.host,
+            port=cluster.port,
+            virtual_host=vhost,
+            credentials=pika.PlainCredentials(cluster.user, cluster.password),
+            # the connection sits idle between checks, it is opened again if the broker closed it
+            heartbeat=0,
+            connection_attempts=1,
+            socket_timeout=self.timeout,
+            blocked_connection_timeout=self.timeout,
+        ))
+
+    def _pooled(self, key):
+        evicted = []
+        with self._lock:
+            pooled = self._pool.pop(key, None) or _Pooled()
+            # re-inserting the key marks it as the most recently used one
+            self._pool[key] = pooled
+            while len(self._pool) > self.pool_size:
+                evicted.append(self._pool.popitem(last=False)[1])
+        for connection in evicted:
+            with connection.lock:
+                connection.close()
+        return pooled
+
+    def __call__(self, name):
+        cluster = get_clusters().locate(name)
+        pooled = self._pooled((cluster.name, name))
+        error = None
+        with pooled.lock:
+            # a pooled connection may have been closed by the broker since the last check, it gets a second chance
+            for _ in range(2):
+                try:
+                    if pooled.connection is None or not pooled.connection.is_open:
+                        pooled.connection = self.connect(cluster, name)
+                    pooled.connection.channel().close()
+                    return '', 204
+                except Exception as e:  # pika raises AMQP errors as well as socket errors
+                    pooled.close()
+                    error = e
+        return 'Error opening an AMQP channel: {}'.format(error), 500
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = list(self._pool.values()), OrderedDict()
+        for pooled in pool:
+            with pooled.lock:
+                pooled.close()
+
+
+#
+# Checks by name, as set by STATUS_CHECK and the `check` of plans
+#
+CHECKS = dict((check.name, check) for check in (AlivenessCheck, VirtualHostsCheck, VhostCheck, AMQPCheck))
+
+
+def get_check(name):
+    """Return the check named <name> of the current app"""
+    checks = app_extension('checks', lambda app: {})
+    try:
+        return checks[name]
+    except KeyError:
+        check = CHECKS[name].from_config(current_app.config)
+        return checks.setdefault(name, check)
+
+
+def run_check(check, name):
+    """Run `check` on the instance named <name>, returning its result and the seconds it took"""
+    started = clock()
+    result = check(name)
+    latency = clock() - started
+    get_metrics().status_check_duration.observe(latency, check=check.name)
+    return result, latency
+
+
+def failed(outcome):
+    """Tell whether the outcome of `run_check` is a failure, cached for STATUS_CACHE_NEGATIVE_TTL seconds"""
+    result = outcome[0]
+    return isinstance(result, HTTPException) or result[1] != 204
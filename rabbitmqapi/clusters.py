@@ -0,0 +1,162 @@
+from __future__ import unicode_literals
+
+import bisect
+import hashlib
+import threading
+
+from flask import current_app
+from werkzeug.exceptions import HTTPException
+
+from .cache import TTLCache
+from .http_client import send
+from .store import get_store
+from .utils import app_extension
+
+
+class Cluster(object):
+    """
+    A RabbitMQ cluster instances can be placed in.
+
+    Units connect to `host`, while management API calls are spread over the `mgmt_hosts` nodes if given, see
+    `http_client.ManagementClient`.
+    """
+
+    def __init__(self, name, host, port, mgmt_port, user, password, plans=(), mgmt_hosts=None):
+        self.name = name
+        self.host = host
+        self.mgmt_hosts = mgmt_hosts
+        self.port = port
+        self.mgmt_port = mgmt_port
+        self.user = user
+        self.password = password
+        self.plans = tuple(plans)
+
+    def __repr__(self):
+        return '<Cluster {}>'.format(self.name)
+
+    @classmethod
+    def from_config(cls, config, **settings):
+        """Build a cluster from `settings`, taking any missing setting from the RMQ_* parameters of `config`"""
+        return cls(
+            name=settings.get('name', 'default'),
+            host=settings.get('host', config.get('RMQ_HOST')),
+            port=settings.get('port', config['RMQ_PORT']),
+            mgmt_port=settings.get('mgmt_port', config['RMQ_MGMT_PORT']),
+            user=settings.get('user', config['RMQ_USER']),
+            password=settings.get('password', config['RMQ_PASSWORD']),
+            plans=settings.get('plans', ()),
+            # the nodes of RMQ_MGMT_HOSTS belong to the RMQ_HOST cluster
+            mgmt_hosts=settings.get('mgmt_hosts', None if 'host' in settings else config.get('RMQ_MGMT_HOSTS')),
+        )
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class ClusterMap(object):
+    """
+    Places new instances in one of the configured clusters, and finds out the cluster of existing ones.
+
+    The cluster of each instance is kept in an in-memory index. Instances missing from the index are looked up in the
+    state store, and then in the clusters themselves, starting with the one consistent hashing would place them in.
+    """
+
+    virtual_nodes = 100
+
+    def __init__(self, clusters, placement='hash', load_ttl=30, store=None):
+        if not clusters:
+            raise ValueError('At least a cluster must be configured')
+        if placement not in ('hash', 'least-loaded', 'plan'):
+            raise ValueError('Unknown placement strategy {}'.format(placement))
+        self.clusters = list(clusters)
+        self.by_name = dict((cluster.name, cluster) for cluster in self.clusters)
+        self.store = store
+        self.placement = placement
+        self.loads = TTLCache(maxsize=len(self.clusters), ttl=load_ttl)
+        self._ring = sorted(
+            (_hash('{}-{}'.format(cluster.name, node)), index)
+            for index, cluster in enumerate(self.clusters)
+            for node in range(self.virtual_nodes)
+        )
+        self._ring_keys = [key for key, _ in self._ring]
+        self._index = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, store=None):
+        clusters = [Cluster.from_config(config, **settings) for settings in config['RMQ_CLUSTERS'] or [{}]]
+        return cls(clusters, placement=config['CLUSTER_PLACEMENT'], load_ttl=config['CLUSTER_LOAD_TTL'], store=store)
+
+    @property
+    def default(self):
+        return self.clusters[0]
+
+    def hashed(self, instance):
+        """The cluster consistent hashing places `instance` in"""
+        position = bisect.bisect(self._ring_keys, _hash(instance)) % len(self._ring)
+        return self.clusters[self._ring[position][1]]
+
+    def load(self, cluster):
+        """Connections and queues of `cluster`, or None if it cannot be reached"""
+        def fetch():
+            try:
+                totals = send('get', 'overview', cluster=cluster).json()['object_totals']
+                return totals['connections'], totals['queues']
+            except (HTTPException, ValueError, KeyError) as e:
+                current_app.logger.warning('Error getting the load of cluster {}: {}'.format(cluster.name, e))
+                return None
+        return self.loads.get_or_compute(cluster.name, fetch)
+
+    def place(self, instance, plan=None):
+        """Choose the cluster a new instance is created in"""
+        if len(self.clusters) == 1:
+            return self.default
+        if self.placement == 'plan':
+            candidates = [cluster for cluster in self.clusters if plan in cluster.plans]
+            if candidates:
+                return candidates[_hash(instance) % len(candidates)]
+        elif self.placement == 'least-loaded':
+            loads = [(self.load(cluster), index) for index, cluster in enumerate(self.clusters)]
+            loads = [(load, index) for load, index in loads if load is not None]
+            if loads:
+                return self.clusters[min(loads)[1]]
+        return self.hashed(instance)
+
+    def locate(self, instance):
+        """Find out the cluster an existing instance lives in"""
+        cluster = self._index.get(instance)
+        if cluster is not None:
+            return cluster
+        if len(self.clusters) == 1:
+            return self.default
+
+        record = self.store.instance(instance) if self.store is not None else None
+        if record is not None and record['cluster'] in self.by_name:
+            cluster = self.by_name[record['cluster']]
+            self.remember(instance, cluster)
+            return cluster
+
+        hashed = self.hashed(instance)
+        for cluster in [hashed] + [cluster for cluster in self.clusters if cluster is not hashed]:
+            try:
+                found = send('get', 'vhosts/{name}'.format(name=instance), raise_for_status=False, cluster=cluster).ok
+            except HTTPException:
+                found = False
+            if found:
+                self.remember(instance, cluster)
+                return cluster
+        return hashed
+
+    def remember(self, instance, cluster):
+        with self._lock:
+            self._index[instance] = cluster
+
+    def forget(self, instance):
+        with self._lock:
+            self._index.pop(instance, None)
+
+
+def get_clusters():
+    """Return the cluster map of the current app"""
+    return app_extension('rmq_clusters', lambda app: ClusterMap.from_config(app.config, store=get_store()))
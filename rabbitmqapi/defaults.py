@@ -0,0 +1,191 @@
+"""
+Default configuration values, loaded before any user supplied configuration.
+
+Only optional parameters belong here: credentials and hosts must always be provided explicitly
+(see service.cfg).
+"""
+
+#
+# RabbitMQ optional parameters
+#
+RMQ_PORT = 5672
+RMQ_MGMT_PORT = 15672
+
+#
+# Management API client
+#
+RMQ_MGMT_SCHEME = 'http'
+RMQ_POOL_SIZE = 10
+RMQ_POOL_BLOCK = False
+RMQ_CONNECT_TIMEOUT = 5
+RMQ_READ_TIMEOUT = 5
+# management API nodes of the RMQ_HOST cluster, as host names optionally followed by a port, like `node2:15673`.
+# Calls go to the `least-outstanding` node, the one serving the fewest calls, or to a node picked at random by
+# `latency`. Nodes failing RMQ_MGMT_EJECT_THRESHOLD calls in a row get no calls until they answer a probe, sent every
+# RMQ_MGMT_PROBE_INTERVAL seconds.
+RMQ_MGMT_HOSTS = None
+RMQ_MGMT_BALANCING = 'least-outstanding'
+RMQ_MGMT_EJECT_THRESHOLD = 3
+RMQ_MGMT_PROBE_INTERVAL = 5
+
+#
+# Provisioning
+#
+PROVISIONING_CONCURRENCY = 4
+# users of the bound units removed by each bulk delete call when an instance is deleted
+TEARDOWN_CHUNK_SIZE = 500
+
+#
+# Salts still accepted while SALT is rotated: their users are kept, and deleted on unbind, until they are retired.
+# Rotations create the users of the new salt with definitions imports of ROTATION_BATCH_SIZE users, running
+# ROTATION_CONCURRENCY of them at a time and waiting ROTATION_BATCH_INTERVAL seconds between rounds.
+#
+PREVIOUS_SALTS = None
+ROTATION_BATCH_SIZE = 500
+ROTATION_CONCURRENCY = 4
+ROTATION_BATCH_INTERVAL = 0
+
+#
+# Plans instances can be created with, as a list of dicts with the arguments of `plans.Plan`. Without plans, every
+# queue is mirrored to every node.
+#
+PLANS = None
+
+#
+# How instances are checked, unless their plan says otherwise: `aliveness` publishes and consumes a message, `health`
+# asks whether every vhost of the cluster is running (RabbitMQ 3.8.10 or later), `vhost` reads the vhost of the
+# instance, and `amqp` opens a channel on a pooled AMQP connection to it (needs pika). AMQP connections are kept for
+# the last AMQP_CHECK_POOL_SIZE instances checked.
+#
+STATUS_CHECK = 'aliveness'
+AMQP_CHECK_POOL_SIZE = 64
+AMQP_CHECK_TIMEOUT = 5
+
+#
+# Status checks cache, in seconds. Set the TTLs to 0 to ping RabbitMQ on every check.
+#
+STATUS_CACHE_TTL = 5
+STATUS_CACHE_NEGATIVE_TTL = 1
+STATUS_CACHE_SIZE = 1024
+
+#
+# Usage reports: seconds they are cached for, how many are kept, and items fetched per page of the management API
+# listings they are built from
+#
+USAGE_CACHE_TTL = 10
+USAGE_CACHE_SIZE = 1024
+USAGE_PAGE_SIZE = 500
+
+#
+# Asynchronous provisioning: instances are created and units bound by background jobs, run by JOBS_WORKERS threads
+# per worker process. Jobs are kept in the state store database, so provisioning stays synchronous without a
+# STATE_STORE_PATH. Running jobs not updated for JOBS_TIMEOUT seconds are run again.
+#
+ASYNC_PROVISIONING = False
+JOBS_WORKERS = 4
+JOBS_POLL_INTERVAL = 1
+JOBS_TIMEOUT = 300
+
+#
+# Seconds the successful responses of the provisioning endpoints, kept in the state store, are replayed to retries of
+# the same request. Without a STATE_STORE_PATH, only retries arriving while the request is served are joined. Set it to
+# 0 to run every request.
+#
+IDEMPOTENCY_TTL = 60
+
+#
+# Batch binds, number of units handled at the same time
+#
+BATCH_CONCURRENCY = 8
+# create the users of batch binds with a single definitions import
+BULK_DEFINITIONS = False
+
+#
+# Clusters instances are placed in. Each one is a dictionary with a `name` and any of the `host`, `port`,
+# `mgmt_port`, `user` and `password` settings, defaulting to the RMQ_* parameters, plus the `plans` placed in it
+# when CLUSTER_PLACEMENT is `plan`, and its `mgmt_hosts` (see RMQ_MGMT_HOSTS). Without clusters, every instance lives
+# in the RMQ_HOST cluster.
+#
+RMQ_CLUSTERS = None
+# one of `hash`, `least-loaded` or `plan`
+CLUSTER_PLACEMENT = 'hash'
+# seconds the load of a cluster is cached for, see the `least-loaded` placement
+CLUSTER_LOAD_TTL = 30
+
+#
+# SQLite database recording the instances and bindings created by the service. Without it, each worker only keeps
+# an in-memory record of what it did.
+#
+STATE_STORE_PATH = None
+
+#
+# Background reconciliation, see rabbitmqapi/reconciler.py. It needs STATE_STORE_PATH and is disabled with a 0
+# interval (in seconds).
+#
+RECONCILE_INTERVAL = 0
+RECONCILE_PAGE_SIZE = 500
+RECONCILE_PAGES_PER_CYCLE = 4
+RECONCILE_MAX_FIXES = 100
+# seconds to wait between batches of fixes, each batch holds BATCH_CONCURRENCY fixes
+RECONCILE_BATCH_INTERVAL = 1
+# delete the orphan vhosts and users instead of logging them; only those of the instances and bindings deleted
+# while the state store was in use are deleted, the ones it has no record of (e.g. created before the store) are kept
+RECONCILE_DELETE_ORPHANS = False
+
+#
+# Resilience of the management API client: retries of idempotent calls (with a jittered exponential backoff, in
+# seconds), circuit breaker opened after RMQ_BREAKER_THRESHOLD consecutive failures for RMQ_BREAKER_RESET_TIMEOUT
+# seconds, and maximum concurrent calls per endpoint and process (0 for no limit).
+#
+RMQ_RETRIES = 2
+RMQ_RETRY_BACKOFF = 0.1
+RMQ_RETRY_BACKOFF_MAX = 2
+RMQ_RETRY_STATUSES = (502, 503, 504)
+RMQ_BREAKER_THRESHOLD = 5
+RMQ_BREAKER_RESET_TIMEOUT = 30
+RMQ_MAX_CONCURRENCY = 32
+RMQ_BULKHEAD_TIMEOUT = 5
+
+#
+# Calls per second to the management API of each cluster, 0 for no limit: writes, and expensive reads like listings
+# and aliveness tests. Limits are shared by the worker processes through files in RATE_LIMIT_DIR, or else apply to
+# each process. Calls waiting more than RATE_LIMIT_TIMEOUT seconds for their turn fail with a 503 status.
+#
+RATE_LIMIT_WRITES = 0
+RATE_LIMIT_WRITES_BURST = None
+RATE_LIMIT_EXPENSIVE = 0
+RATE_LIMIT_EXPENSIVE_BURST = None
+RATE_LIMIT_DIR = None
+RATE_LIMIT_TIMEOUT = 5
+
+#
+# Authentication: more username and password pairs accepted besides USERNAME and PASSWORD, as a dict, useful while
+# rotating them, and the number of valid Authorization headers remembered by each worker
+#
+EXTRA_CREDENTIALS = None
+AUTH_CACHE_SIZE = 256
+
+#
+# Derived credentials of bound units remembered by each worker
+#
+CREDENTIALS_CACHE_SIZE = 4096
+
+#
+# Access log of the requests served, on the `rabbitmqapi.access` logger. Only a fraction of the successful requests
+# is logged when ACCESS_LOG_SAMPLE_RATE is below 1. With an ACCESS_LOG_QUEUE_SIZE, records are written by a
+# background thread.
+#
+ACCESS_LOG = False
+ACCESS_LOG_SAMPLE_RATE = 1.0
+ACCESS_LOG_FORMAT = 'text'
+ACCESS_LOG_QUEUE_SIZE = 0
+
+#
+# Upper bounds, in seconds, of the buckets of the latency histograms exposed at /metrics
+#
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#
+# requests transport adapter serving the management API calls instead of the network, see rabbitmqapi/fake_rmq.py
+#
+RMQ_ADAPTER = None
@@ -0,0 +1,95 @@
+from __future__ import unicode_literals
+
+import json
+
+from flask import current_app
+from werkzeug.exceptions import HTTPException
+
+from .http_client import send
+from .pipeline import map_in_context
+
+#
+# User permissions
+#
+full_permissions = {"configure": ".*", "write": ".*", "read": ".*"}
+
+
+class Definitions(object):
+    """
+    A RabbitMQ definitions document, used to create many vhosts, users, permissions and policies in one call.
+
+    The document is posted to the management API `definitions` endpoint, which merges it with the existing
+    definitions. If RabbitMQ rejects it, `submit` may fall back to one call per object.
+    """
+
+    def __init__(self):
+        self.vhosts = []
+        self.users = []
+        self.permissions = []
+        self.policies = []
+
+    def __len__(self):
+        return len(self.vhosts) + len(self.users) + len(self.permissions) + len(self.policies)
+
+    def add_vhost(self, name):
+        self.vhosts.append({'name': name})
+
+    def add_user(self, name, password, tags=''):
+        self.users.append({'name': name, 'password': password, 'tags': tags})
+
+    def add_permission(self, vhost, user, permissions):
+        """`permissions` holds the `configure`, `write` and `read` patterns, as in `full_permissions`"""
+        self.permissions.append(dict(permissions, vhost=vhost, user=user))
+
+    def add_policy(self, policy):
+        """`policy` holds the same fields used to create it through `policies/<vhost>/<name>`"""
+        self.policies.append(policy)
+
+    def document(self):
+        return {
+            'vhosts': self.vhosts,
+            'users': self.users,
+            'permissions': self.permissions,
+            'policies': self.policies,
+        }
+
+    def calls(self):
+        """
+        The management API calls equivalent to the document, as lists of (verb, url, body) tuples. Calls of a list
+        only depend on the calls of the previous lists.
+        """
+        return [
+            [('put', 'vhosts/{name}'.format(**vhost), {}) for vhost in self.vhosts] +
+            [('put', 'users/{name}'.format(**user), {'password': user['password'], 'tags': user['tags']})
+             for user in self.users],
+            [('put', 'permissions/{vhost}/{user}'.format(**permission),
+              dict((key, permission[key]) for key in ('configure', 'write', 'read')))
+             for permission in self.permissions] +
+            [('put', 'policies/{vhost}/{name}'.format(**policy), policy) for policy in self.policies],
+        ]
+
+    def apply_each(self, cluster=None):
+        """Apply the document with one call per object, raising an HTTP error if any of them fails"""
+        for calls in self.calls():
+            outcomes = map_in_context(
+                lambda call: send(call[0], call[1], data=json.dumps(call[2]), cluster=cluster),
+                calls, current_app.config['BATCH_CONCURRENCY']
+            )
+            errors = [result for ok, result in outcomes if not ok]
+            if errors:
+                raise errors[0]
+
+    def submit(self, fallback=True, cluster=None):
+        """
+        Apply the document in a single call, returning whether it succeeded. If RabbitMQ rejects it, the document is
+        applied object by object when `fallback` is set. The document goes to `cluster` if given.
+        """
+        try:
+            send('post', 'definitions', data=json.dumps(self.document()), cluster=cluster)
+            return True
+        except HTTPException as e:
+            current_app.logger.warning('Error importing definitions: {}'.format(e.description))
+
+        if fallback:
+            self.apply_each(cluster)
+        return False
@@ -0,0 +1,328 @@
+"""
+In-process stand-in for the RabbitMQ management API, used by the benchmarks and tests.
+
+`FakeManagementAPI` is a requests transport adapter: set it as the RMQ_ADAPTER configuration parameter and the
+management API calls of the app are served from an in-memory model of each broker, with a configurable latency and
+error injection, instead of going through the network.
+"""
+from __future__ import unicode_literals
+
+import base64
+import json
+import random
+import threading
+import time
+from collections import Counter
+
+import requests
+from requests.adapters import BaseAdapter
+
+try:
+    from urllib.parse import urlsplit, parse_qs, unquote
+except ImportError:  # Python 2
+    from urlparse import urlsplit, parse_qs
+    from urllib import unquote
+
+from .http_client import path_template
+
+
+class NotFound(Exception):
+    status_code = 404
+
+
+class BadRequest(Exception):
+    status_code = 400
+
+
+class ServiceUnavailable(Exception):
+    status_code = 503
+
+
+class Broker(object):
+    """In-memory model of the vhosts, users, permissions, policies, queues and connections of a RabbitMQ cluster"""
+
+    def __init__(self, admin):
+        self.vhosts = {'/': {'name': '/'}}
+        self.users = {admin: {'name': admin, 'tags': 'administrator'}}
+        self.permissions = {}
+        self.policies = {}
+        self.limits = {}
+        self.queues = {}
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def overview(self):
+        return {'object_totals': {'connections': len(self.connections), 'channels': 0, 'queues': len(self.queues),
+                                  'exchanges': 0, 'consumers': 0}}
+
+    def declare_queue(self, vhost, name, messages=0, unacknowledged=0, consumers=0, memory=0, publish_rate=0,
+                      deliver_rate=0):
+        """Add a queue to `vhost`, with the given stats"""
+        if vhost not in self.vhosts:
+            raise BadRequest('vhost_not_found')
+        self.queues[vhost, name] = {
+            'vhost': vhost,
+            'name': name,
+            'messages': messages,
+            'messages_ready': messages - unacknowledged,
+            'messages_unacknowledged': unacknowledged,
+            'consumers': consumers,
+            'memory': memory,
+            'message_stats': {'publish_details': {'rate': publish_rate},
+                              'deliver_get_details': {'rate': deliver_rate}},
+        }
+
+    def connect(self, vhost, user):
+        """Open a connection of `user` to `vhost`, returning its name"""
+        name = '127.0.0.1:{} -> 127.0.0.1:5672'.format(40000 + len(self.connections))
+        self.connections[name] = {'name': name, 'vhost': vhost, 'user': user}
+        return name
+
+    def vhost(self, name):
+        """A vhost, with the message stats of its queues"""
+        queues = [queue for queue in self.queues.values() if queue['vhost'] == name]
+        vhost = dict(self.vhosts[name])
+        vhost.setdefault('cluster_state', {'rabbit@localhost': 'running'})
+        for field in ('messages', 'messages_ready', 'messages_unacknowledged'):
+            vhost[field] = sum(queue[field] for queue in queues)
+        vhost['message_stats'] = dict(
+            (stat, {'rate': sum(queue['message_stats'][stat]['rate'] for queue in queues)})
+            for stat in ('publish_details', 'deliver_get_details'))
+        return vhost
+
+    def import_definitions(self, definitions):
+        for vhost in definitions.get('vhosts', []):
+            self.vhosts[vhost['name']] = {'name': vhost['name']}
+        for user in definitions.get('users', []):
+            self.users[user['name']] = dict(user)
+        for permission in definitions.get('permissions', []):
+            self.grant(permission['vhost'], permission['user'], permission)
+        for policy in definitions.get('policies', []):
+            self.set_policy(policy['vhost'], policy['name'], policy)
+
+    def grant(self, vhost, user, permissions):
+        if vhost not in self.vhosts or user not in self.users:
+            raise BadRequest('vhost_or_user_not_found')
+        self.permissions[vhost, user] = dict(
+            vhost=vhost, user=user, **dict((key, permissions[key]) for key in ('configure', 'write', 'read')))
+
+    def set_policy(self, vhost, name, policy):
+        if vhost not in self.vhosts:
+            raise BadRequest('vhost_not_found')
+        self.policies[vhost, name] = dict(policy, vhost=vhost, name=name)
+
+    def delete_vhost(self, name):
+        if self.vhosts.pop(name, None) is None:
+            raise NotFound()
+        for objects in (self.permissions, self.policies, self.limits, self.queues):
+            for key in [key for key in objects if key[0] == name]:
+                del objects[key]
+
+    def delete_user(self, name):
+        if self.users.pop(name, None) is None:
+            raise NotFound()
+        for key in [key for key in self.permissions if key[1] == name]:
+            del self.permissions[key]
+
+    def handle(self, verb, segments, body):
+        """Serve a call to the path made of `segments`, returning the data to answer with"""
+        kind, args = segments[0], segments[1:]
+        if kind == 'overview' and verb == 'GET':
+            return self.overview()
+        if kind == 'whoami' and verb == 'GET':
+            return {'name': 'guest', 'tags': 'administrator'}
+        if kind == 'definitions' and verb == 'POST':
+            return self.import_definitions(body)
+        if kind == 'health' and verb == 'GET' and args == ['checks', 'virtual-hosts']:
+            down = sorted(name for name in self.vhosts if 'stopped' in self.vhost(name)['cluster_state'].values())
+            if down:
+                raise ServiceUnavailable('Some virtual hosts are down: {}'.format(', '.join(down)))
+            return {'status': 'ok'}
+        if kind == 'aliveness-test' and verb == 'GET' and len(args) == 1:
+            if args[0] not in self.vhosts:
+                raise NotFound()
+            return {'status': 'ok'}
+        if kind == 'users' and args == ['bulk-delete'] and verb == 'POST':
+            for user in body['users']:
+                if user in self.users:
+                    self.delete_user(user)
+            return None
+        if kind == 'vhosts' and verb == 'GET' and args[1:] == ['connections']:
+            if args[0] not in self.vhosts:
+                raise NotFound()
+            return [connection for connection in self.connections.values() if connection['vhost'] == args[0]]
+        if kind == 'vhosts' and verb == 'GET' and args[1:] == ['permissions']:
+            if args[0] not in self.vhosts:
+                raise NotFound()
+            return [permission for key, permission in sorted(self.permissions.items()) if key[0] == args[0]]
+        if kind == 'vhosts' and verb == 'GET':
+            if args and args[0] not in self.vhosts:
+                raise NotFound()
+            return self.vhost(args[0]) if args else [self.vhost(name) for name in sorted(self.vhosts)]
+        if kind == 'queues' and verb == 'GET' and len(args) < 2:
+            return [queue for key, queue in sorted(self.queues.items()) if not args or key[0] == args[0]]
+        if kind == 'queues' and verb == 'PUT' and len(args) == 2:
+            return self.declare_queue(args[0], args[1])
+
+        objects = {'vhosts': self.vhosts, 'users': self.users, 'permissions': self.permissions,
+                   'policies': self.policies, 'vhost-limits': self.limits, 'connections': self.connections}.get(kind)
+        if objects is None:
+            raise NotFound()
+        if not args and verb == 'GET':
+            return list(objects.values())
+        key = args[0] if len(args) == 1 else tuple(args)
+        if verb == 'GET':
+            if key not in objects:
+                raise NotFound()
+            return objects[key]
+        if verb == 'PUT':
+            if kind == 'vhosts':
+                self.vhosts[key] = dict(body or {}, name=key)
+            elif kind == 'users':
+                self.users[key] = dict(body, name=key)
+            elif kind == 'permissions':
+                self.grant(key[0], key[1], body)
+            elif kind == 'vhost-limits':
+                if key[0] not in self.vhosts:
+                    raise BadRequest('vhost_not_found')
+                self.limits[key] = body['value']
+            else:
+                self.set_policy(key[0], key[1], body)
+            return None
+        if verb == 'DELETE':
+            if kind == 'vhosts':
+                self.delete_vhost(key)
+            elif kind == 'users':
+                self.delete_user(key)
+            elif objects.pop(key, None) is None:
+                raise NotFound()
+            return None
+        raise NotFound()
+
+
+def select(item, columns):
+    """The `columns` of `item`, nested ones like `message_stats.publish_details.rate` included"""
+    selected = {}
+    for column in columns:
+        value, target, path = item, selected, column.split('.')
+        for field in path:
+            value = value.get(field) if isinstance(value, dict) else None
+        for field in path[:-1]:
+            target = target.setdefault(field, {})
+        if value is not None or len(path) == 1:
+            target[path[-1]] = value
+    return selected
+
+
+def paginate(items, query):
+    """Apply the `page`, `page_size` and `columns` parameters of the management API to a listing"""
+    columns = query.get('columns', [''])[0].split(',') if 'columns' in query else None
+    if columns:
+        items = [select(item, columns) for item in items]
+    if 'page' not in query:
+        return items
+    page, page_size = int(query['page'][0]), int(query.get('page_size', ['100'])[0])
+    return {
+        'items': items[(page - 1) * page_size:page * page_size],
+        'page': page,
+        'page_size': page_size,
+        'page_count': (len(items) + page_size - 1) // page_size,
+        'item_count': len(items[(page - 1) * page_size:page * page_size]),
+        'filtered_count': len(items),
+        'total_count': len(items),
+    }
+
+
+class FakeManagementAPI(BaseAdapter):
+    """
+    requests transport adapter serving management API calls from in-memory brokers, one per host and port, or per
+    cluster for the nodes which `join` one.
+
+    :param latency: seconds each call takes, on average, see also `slow`.
+    :param jitter: maximum seconds added to or removed from `latency`.
+    :param error_rate: probability of a call failing with `error_status` instead of being served.
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, error_status=503):
+        super(FakeManagementAPI, self).__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.brokers = {}
+        self.calls = Counter()
+        self.node_calls = Counter()
+        self.failures = {}
+        self.clusters = {}
+        self.down = set()
+        self.latencies = {}
+        self._lock = threading.Lock()
+
+    def broker(self, netloc, request):
+        """The broker at `netloc`, created on the first call with the user of `request` as its administrator"""
+        with self._lock:
+            if netloc not in self.brokers:
+                credentials = request.headers.get('Authorization', 'Basic Og==').split(' ', 1)[1]
+                self.brokers[netloc] = Broker(base64.b64decode(credentials).decode('utf-8').split(':', 1)[0])
+            return self.brokers[netloc]
+
+    def join(self, netloc, cluster_netloc):
+        """Make the node at `netloc` serve the broker of `cluster_netloc`, like another node of its cluster"""
+        self.clusters[netloc] = cluster_netloc
+
+    def slow(self, netloc, latency):
+        """Make the calls to the node at `netloc` take `latency` seconds"""
+        self.latencies[netloc] = latency
+
+    def fail(self, verb, template, status=500):
+        """Make every call to `template`, like `permissions/{vhost}/{user}`, fail with `status`"""
+        self.failures[verb.upper(), template] = status
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        path = url.path.split('/api/', 1)[1].strip('/')
+        segments = [unquote(segment) for segment in path.split('/')]
+        template = path_template(path)
+        with self._lock:
+            self.calls[request.method, template] += 1
+            self.node_calls[url.netloc] += 1
+        if url.netloc in self.down:
+            raise requests.ConnectionError('Connection refused by {}'.format(url.netloc))
+
+        delay = self.latencies.get(url.netloc, self.latency) + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        status = self.failures.get((request.method, template))
+        if status is None and self.error_rate and random.random() < self.error_rate:
+            status = self.error_status
+        if status is not None:
+            return self.build_response(request, status, {'error': 'injected'})
+
+        body = json.loads(request.body) if request.body else None
+        broker = self.broker(self.clusters.get(url.netloc, url.netloc), request)
+        try:
+            with broker.lock:
+                data = broker.handle(request.method, segments, body)
+        except (NotFound, BadRequest, ServiceUnavailable) as e:
+            return self.build_response(request, e.status_code, {'error': type(e).__name__, 'reason': str(e)})
+        if isinstance(data, list):
+            data = paginate(data, parse_qs(url.query))
+        elif isinstance(data, dict) and 'columns' in url.query:
+            data = select(data, parse_qs(url.query)['columns'][0].split(','))
+        return self.build_response(request, 200 if data is not None else 204, data)
+
+    def build_response(self, request, status_code, data):
+        response = requests.Response()
+        response.status_code = status_code
+        response.reason = 'OK' if status_code < 400 else 'Error'
+        response._content = json.dumps(data).encode('utf-8') if data is not None else b''
+        response._content_consumed = True
+        response.headers['Content-Type'] = 'application/json'
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
@@ -0,0 +1,14 @@
+"""
+gunicorn settings, see the Procfile.
+
+Set RMQAPI_WORKER_CLASS=gevent to serve the API with cooperative workers: calls to the management API then yield
+to other requests instead of blocking the worker, so a single process can keep hundreds of provisioning calls in
+flight. Remember to raise RMQAPI_RMQ_POOL_SIZE accordingly, so those calls reuse pooled connections.
+"""
+from os import environ as env
+
+worker_class = env.get('RMQAPI_WORKER_CLASS', 'sync')
+workers = int(env.get('RMQAPI_WORKERS', 1))
+# only used by the asynchronous worker classes
+worker_connections = int(env.get('RMQAPI_WORKER_CONNECTIONS', 1000))
+timeout = int(env.get('RMQAPI_WORKER_TIMEOUT', 30))
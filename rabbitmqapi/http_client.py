@@ -1,37 +1,423 @@
 from __future__ import unicode_literals
 
+import codecs
+import json
+import os
+import re
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from flask import abort, current_app
 
+from .balancer import Balancer
+from .cache import clock
+from .metrics import get_metrics
+from .resilience import Bulkhead, CircuitBreaker, RateLimiter, Unavailable, backoff_delays
+
+
+_client_lock = threading.Lock()
+
+
+class ManagementClient(object):
+    """
+    Pooled, keep-alive client for the RabbitMQ management API.
+
+    The base URL, credentials and default headers are built once, and connections (including TLS sessions) are
+    reused across calls instead of being opened for every request sent to RabbitMQ.
+
+    Idempotent calls are retried with a jittered exponential backoff when the connection fails or RabbitMQ answers
+    with one of the `retry_statuses`. A circuit breaker fails fast while the endpoint is down, a bulkhead caps
+    the number of concurrent calls to it, and a rate limiter the number of calls per second.
+
+    With several `hosts`, like `node1` or `node2:15673`, calls are spread over the management API of each node of
+    the cluster by a `Balancer`, with the `balancing` strategy, and retries go to another node. Nodes failing
+    `eject_threshold` calls in a row get no more calls until they answer a probe, sent every `probe_interval`
+    seconds.
+    """
+
+    idempotent_verbs = ('get', 'head', 'put', 'delete')
+
+    def __init__(self, host, port, user, password, scheme='http', pool_size=10, pool_block=False,
+                 connect_timeout=5, read_timeout=5, retries=0, retry_backoff=0.1, retry_backoff_max=2,
+                 retry_statuses=(502, 503, 504), breaker=None, bulkhead=None, limiter=None, adapter=None,
+                 hosts=None, balancing='least-outstanding', eject_threshold=3, probe_interval=5):
+        self.base_url = node_url(scheme, host, port)
+        self.timeout = (connect_timeout, read_timeout)
+        self.pid = os.getpid()
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.retry_statuses = tuple(retry_statuses)
+        self.breaker = breaker or CircuitBreaker()
+        self.bulkhead = bulkhead or Bulkhead(None, None)
+        self.limiter = limiter or RateLimiter()
+        self.balancer = Balancer([node_url(scheme, node, port) for node in hosts or [host]], balancing,
+                                 eject_threshold, self.probe, probe_interval)
+
+        self.session = requests.Session()
+        self.session.auth = (user, password)
+        self.session.headers['Content-Type'] = 'application/json'
+        # a pool of connections per node
+        self.session.mount('{}://'.format(scheme), adapter or HTTPAdapter(
+            pool_connections=len(self.balancer.nodes), pool_maxsize=pool_size, pool_block=pool_block
+        ))
+
+    @classmethod
+    def from_config(cls, config, cluster=None):
+        """Build a client from a Flask configuration mapping, talking to `cluster` if given"""
+        return cls(
+            host=cluster.host if cluster else config['RMQ_HOST'],
+            port=cluster.mgmt_port if cluster else config['RMQ_MGMT_PORT'],
+            user=cluster.user if cluster else config['RMQ_USER'],
+            password=cluster.password if cluster else config['RMQ_PASSWORD'],
+            scheme=config['RMQ_MGMT_SCHEME'],
+            pool_size=config['RMQ_POOL_SIZE'],
+            pool_block=config['RMQ_POOL_BLOCK'],
+            connect_timeout=config['RMQ_CONNECT_TIMEOUT'],
+            read_timeout=config['RMQ_READ_TIMEOUT'],
+            retries=config['RMQ_RETRIES'],
+            retry_backoff=config['RMQ_RETRY_BACKOFF'],
+            retry_backoff_max=config['RMQ_RETRY_BACKOFF_MAX'],
+            retry_statuses=config['RMQ_RETRY_STATUSES'],
+            breaker=CircuitBreaker(config['RMQ_BREAKER_THRESHOLD'], config['RMQ_BREAKER_RESET_TIMEOUT']),
+            bulkhead=Bulkhead(config['RMQ_MAX_CONCURRENCY'], config['RMQ_BULKHEAD_TIMEOUT']),
+            limiter=RateLimiter.from_config(config, '{}:{}'.format(
+                cluster.host if cluster else config['RMQ_HOST'],
+                cluster.mgmt_port if cluster else config['RMQ_MGMT_PORT'])),
+            adapter=config['RMQ_ADAPTER'],
+            hosts=cluster.mgmt_hosts if cluster else config['RMQ_MGMT_HOSTS'],
+            balancing=config['RMQ_MGMT_BALANCING'],
+            eject_threshold=config['RMQ_MGMT_EJECT_THRESHOLD'],
+            probe_interval=config['RMQ_MGMT_PROBE_INTERVAL'],
+        )
+
+    def request(self, verb, rel_url, *request_args, **requests_kwargs):
+        """
+        Call the management API, raising `Unavailable` if the call cannot go out and `requests.RequestException` if
+        it failed on every attempt.
+        """
+        budget = budget_of(verb, rel_url)
+        self.limiter.acquire(budget)
+        if not self.breaker.allow():
+            raise Unavailable('Circuit open for {}'.format(self.base_url))
+        requests_kwargs.setdefault('timeout', self.timeout)
+        delays = backoff_delays(self.retries if verb in self.idempotent_verbs else 0,
+                                self.retry_backoff, self.retry_backoff_max)
+        node = None
+        try:
+            while True:
+                response = error = None
+                with self.bulkhead:
+                    node = self.balancer.pick(avoid=node)
+                    started = clock()
+                    try:
+                        response = getattr(self.session, verb)(node.base_url + rel_url, *request_args,
+                                                               **requests_kwargs)
+                    except requests.RequestException as e:
+                        error = e
+                    finally:
+                        # an interrupted call only gives its node back
+                        completed = response is not None or error is not None
+                        self.balancer.release(node, clock() - started if completed else None,
+                                              failed=completed and call_failed(rel_url, response, error))
+                if response is not None and response.status_code not in self.retry_statuses:
+                    break
+                delay = next(delays, None)
+                if delay is None:
+                    break
+                time.sleep(delay)
+                try:
+                    self.limiter.acquire(budget)
+                except Unavailable:
+                    break
+        except BaseException:
+            # a call rejected by the bulkhead, or interrupted, tells nothing about the endpoint
+            self.breaker.release()
+            raise
+
+        if call_failed(rel_url, response, error):
+            self.breaker.failed()
+        else:
+            self.breaker.succeeded()
+        if error is not None:
+            raise error
+        return response
+
+    def probe(self, node):
+        """Tell whether an ejected node answers again, see `Balancer`"""
+        try:
+            return self.session.get(node.base_url + 'whoami', timeout=self.timeout).status_code < 500
+        except requests.RequestException:
+            return False
+
+    def close(self):
+        self.session.close()
+
+
+def node_url(scheme, node, default_port):
+    """Base URL of the management API of `node`, a host name optionally followed by a port, like `node2:15673`"""
+    host, _, port = node.rpartition(':')
+    if not host or not port.isdigit():
+        host, port = node, default_port
+    return '{scheme}://{host}:{port}/api/'.format(scheme=scheme, host=host, port=port)
+
+
+def call_failed(rel_url, response, error):
+    """
+    Tell whether a management API call failed because of the node serving it. Health checks answer with a 503 status
+    when what they check is down, which says nothing about the node.
+    """
+    if error is not None:
+        return True
+    return response.status_code >= 500 and not rel_url.startswith('health/')
+
+
+def get_client(cluster=None):
+    """
+    Return the management API client of the current app for `cluster`, or for the RMQ_HOST cluster if not given.
+
+    Clients are created lazily and are never shared between processes: a gunicorn worker forked after the client
+    was built gets a fresh connection pool instead of reusing the parent's sockets.
+    """
+    app = current_app._get_current_object()
+    config = app.config
+    key = (cluster.host, cluster.mgmt_port, cluster.user) if cluster else \
+        (config['RMQ_HOST'], config['RMQ_MGMT_PORT'], config['RMQ_USER'])
+    clients = app.extensions.setdefault('rmq_clients', {})
+    client = clients.get(key)
+    if client is None or client.pid != os.getpid():
+        with _client_lock:
+            client = clients.get(key)
+            if client is None or client.pid != os.getpid():
+                client = clients[key] = ManagementClient.from_config(config, cluster)
+    return client
+
 
 def send(verb, rel_url, raise_for_status=True, *request_args, **requests_kwargs):
     """
     Thin wrapper around requests which takes care of setting up default params needed to talk with the RabbitMQ API.
 
+    The call goes to the management API of the `cluster` keyword argument if given, see `clusters.Cluster`.
+
     If a non-recoverable error occurs while talking to RabbitMQ, we propagate an HTTP error.
     """
-    verb = getattr(requests, verb)
-    rmq_base_url = 'http://{host}:{port}/api'.format(
-        host=current_app.config['RMQ_HOST'],
-        port=current_app.config['RMQ_MGMT_PORT']
-    )
+    client = get_client(requests_kwargs.pop('cluster', None))
+    metrics = get_metrics()
+    labels = {'verb': verb.upper(), 'path': path_template(rel_url)}
+    metrics.management_in_flight.inc(**labels)
+    started = clock()
     try:
-        response = verb(
-            '{}/{}'.format(rmq_base_url, rel_url),
-            *request_args,
-            auth=(current_app.config['RMQ_USER'], current_app.config['RMQ_PASSWORD']),
-            headers={'Content-Type': 'application/json'},
-            timeout=5,
-            **requests_kwargs
-        )
+        response = client.request(verb, rel_url, *request_args, **requests_kwargs)
+    except Unavailable as e:
+        metrics.management_errors.inc(reason='unavailable', **labels)
+        return abort(503, str(e))
+    except requests.Timeout as e:
+        metrics.management_errors.inc(reason='timeout', **labels)
+        return abort(500, str(e))
     except requests.RequestException as e:
+        metrics.management_errors.inc(reason='connection', **labels)
         return abort(500, str(e))
+    finally:
+        metrics.management_in_flight.dec(**labels)
+        metrics.management_duration.observe(clock() - started, **labels)
+    metrics.management_calls.inc(status=response.status_code, **labels)
 
     if raise_for_status:
         try:
             response.raise_for_status()
         except requests.HTTPError:
+            metrics.management_errors.inc(reason='status', **labels)
             return abort(500, 'Error, rabbitmq returned status code {}'.format(response.status_code))
 
     return response
+
+
+class JSONStream(object):
+    """
+    Incremental parser of a JSON document read a chunk at a time, yielding the elements of its top level array, or
+    of the `items` array of a paginated listing, as soon as they are read.
+
+    Only one element is decoded at a time, so a listing takes as much memory as its biggest element, however long it
+    is. The other fields of a paginated listing, like `page_count`, are kept in `fields` as they are read.
+    """
+
+    whitespace = re.compile(r'[ \t\n\r]*')
+    number_tail = re.compile(r'[0-9.eE+-]*\Z')
+    decoder = json.JSONDecoder()
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.pos = 0
+        self.fields = {}
+
+    @property
+    def page_count(self):
+        """Number of pages of the listing, once its items have been read. Plain arrays make a single page."""
+        return self.fields.get('page_count', 1)
+
+    def _read(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """The next character which is not whitespace, without consuming it, or an empty string at the end"""
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read():
+                return ''
+
+    def _expect(self, characters):
+        character = self._peek()
+        if not character or character not in characters:
+            raise ValueError('Expected one of {!r} at {!r}'.format(characters, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+        return character
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                value, end = None, None
+            # a number at the end of the buffer, like `1.` before `5`, may go on in the next chunk
+            number = self.buffer[self.pos:self.pos + 1] in '-0123456789'
+            if end is not None and not (number and self.number_tail.match(self.buffer, end)):
+                self.pos = end
+                return value
+            if not self._read():
+                if end is None:
+                    raise ValueError('Truncated JSON document')
+                self.pos = end
+                return value
+
+    def _array(self):
+        self._expect('[')
+        if self._peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(',]') == ']':
+                return
+
+    def __iter__(self):
+        if self._peek() == '[':
+            for item in self._array():
+                yield item
+            return
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'items' and self._peek() == '[':
+                for item in self._array():
+                    yield item
+            else:
+                self.fields[key] = self._value()
+            if self._expect(',}') == '}':
+                return
+
+
+def decoded_chunks(response, chunk_size):
+    """The body of a streamed response as text chunks, releasing its connection once read"""
+    # JSON is always UTF-8 encoded, whatever the content type says
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for chunk in response.iter_content(chunk_size):
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
+    except requests.RequestException as e:
+        abort(500, str(e))
+    finally:
+        response.close()
+
+
+def stream(rel_url, chunk_size=65536, **requests_kwargs):
+    """
+    GET a management API listing without buffering its body, returning a `JSONStream` of its items.
+
+    Items are read from the connection as the stream is iterated over, so they can be filtered and aggregated with
+    bounded memory. Iterate over the stream to the end, or close it, to give the connection back to the pool.
+    """
+    response = send('get', rel_url, stream=True, **requests_kwargs)
+    return JSONStream(decoded_chunks(response, chunk_size))
+
+
+def stream_page(rel_url, page=1, page_size=500, columns=None, **requests_kwargs):
+    """
+    Stream a page of a management API listing, see `stream`. The number of pages of the listing is known once the
+    items of the page have been read, as the `page_count` of the stream.
+
+    Only the given `columns` of each item are requested. Listings which do not support pagination are returned
+    whole, as a single page.
+    """
+    params = {'page': page, 'page_size': page_size}
+    if columns:
+        params['columns'] = ','.join(columns)
+    return stream(rel_url, params=params, **requests_kwargs)
+
+
+def clients_stats():
+    """State of the circuit breaker of each management API endpoint used by the current app"""
+    clients = current_app.extensions.get('rmq_clients', {})
+    return dict(
+        (client.base_url, {'circuit': client.breaker.state, 'failures': client.breaker.failures,
+                           'nodes': client.balancer.stats()})
+        for client in list(clients.values())
+    )
+
+
+#
+# Placeholders of the path segments following the first one, by first segment. Literal segments stay as they are.
+#
+path_placeholders = {
+    'vhosts': ('{vhost}',),
+    'users': ('{user}',),
+    'permissions': ('{vhost}', '{user}'),
+    'policies': ('{vhost}', '{name}'),
+    'aliveness-test': ('{vhost}',),
+    'queues': ('{vhost}', '{name}'),
+    'vhost-limits': ('{vhost}', '{name}'),
+    'connections': ('{name}',),
+}
+path_literals = ('bulk-delete',)
+
+
+def path_template(rel_url):
+    """Turn a management API path into its template, like `permissions/{vhost}/{user}`"""
+    segments = rel_url.split('?', 1)[0].strip('/').split('/')
+    placeholders = path_placeholders.get(segments[0], ())
+    return '/'.join(segments[:1] + [
+        segment if segment in path_literals or index >= len(placeholders) else placeholders[index]
+        for index, segment in enumerate(segments[1:])
+    ])
+
+
+#
+# Reads which are expensive for the management plugin, besides listings
+#
+expensive_paths = ('aliveness-test', 'health', 'overview', 'definitions')
+
+
+def budget_of(verb, rel_url):
+    """Rate limiting budget of a management API call: `writes`, `expensive` reads, or `reads`, see `RateLimiter`"""
+    if verb not in ('get', 'head'):
+        return 'writes'
+    segments = rel_url.split('?', 1)[0].strip('/').split('/')
+    if segments[0] in expensive_paths or len(segments) - 1 < len(path_placeholders.get(segments[0], ())):
+        return 'expensive'
+    return 'reads'
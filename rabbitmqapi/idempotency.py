@@ -0,0 +1,77 @@
+from __future__ import unicode_literals
+
+import json
+from functools import partial, wraps
+
+from flask import Response, current_app, request
+
+from .cache import TTLCache
+from .store import get_store
+from .utils import app_extension
+
+
+def idempotency_cache():
+    """Requests of the idempotent views being served by this process, see `idempotent`"""
+    # responses are kept in the state store, shared by every worker process, this only joins requests in flight
+    return app_extension('idempotency_cache', lambda app: TTLCache(ttl=0))
+
+
+def request_key():
+    """
+    Key of the request being served: the instance it is about, the endpoint, and the `Idempotency-Key` header if
+    given, or else the parameters of the request
+    """
+    explicit = request.headers.get('Idempotency-Key')
+    discriminator = ('key', explicit) if explicit else ('form', tuple(sorted(request.form.items(multi=True))))
+    return (request.view_args.get('name') or request.form.get('name'), request.endpoint, discriminator)
+
+
+def idempotent(f=None, body=None):
+    """
+    Serve retries of a request without running the view again.
+
+    A request arriving while the same one is being served by the same process waits for it and gets the same
+    response. With a STATE_STORE_PATH, successful responses are then recorded in the state store and replayed for
+    IDEMPOTENCY_TTL seconds, with an `Idempotent-Replayed` header, while errors are never kept so the request can be
+    retried. Without one, nothing is replayed once served: another worker process may have undone it since.
+
+    Responses holding secrets, like the password of a bound unit, are recorded without their body, which
+    `body(*args, **kwargs)` builds again for replays.
+    """
+    if f is None:
+        return partial(idempotent, body=body)
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        ttl = current_app.config['IDEMPOTENCY_TTL']
+        if not ttl:
+            return f(*args, **kwargs)
+
+        key = request_key()
+        served = []
+
+        def serve():
+            store = get_store()
+            stored_key = json.dumps(key)
+            recorded = store.response(stored_key) if store.persistent else None
+            if recorded is not None:
+                data, status_code, headers = recorded
+                return (body(*args, **kwargs) if data is None else data), status_code, headers
+            served.append(True)
+            response = current_app.make_response(f(*args, **kwargs))
+            result = response.get_data(), response.status_code, list(response.headers.items())
+            if store.persistent and 200 <= response.status_code < 300:
+                store.add_response(stored_key, key[0], None if body else result[0], *result[1:], ttl=ttl)
+            return result
+
+        data, status_code, headers = idempotency_cache().get_or_compute(key, serve)
+        response = Response(data, status_code, headers)
+        if not served:
+            response.headers['Idempotent-Replayed'] = 'true'
+        return response
+    return decorated
+
+
+def forget_instance(name):
+    """Stop replaying the responses about the instance named <name>, once it or its bindings are deleted"""
+    get_store().remove_responses(name)
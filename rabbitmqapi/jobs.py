@@ -0,0 +1,198 @@
+from __future__ import unicode_literals
+
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+from werkzeug.exceptions import HTTPException
+
+from .utils import app_extension
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT,
+    instance TEXT,
+    payload TEXT,
+    state TEXT,
+    progress TEXT,
+    error TEXT,
+    created_at REAL,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at);
+CREATE INDEX IF NOT EXISTS jobs_instance ON jobs (instance, kind, created_at);
+"""
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+#
+# Functions running each kind of job, called with the payload of the job as keyword arguments, see `job_handler`
+#
+handlers = {}
+
+_current = threading.local()
+
+
+def job_handler(kind):
+    """Register the decorated function as the handler of the jobs of `kind`"""
+    def register(func):
+        handlers[kind] = func
+        return func
+    return register
+
+
+def report_progress(**progress):
+    """Record the progress of the job being run by the current thread, shown by the job endpoint"""
+    job = getattr(_current, 'job', None)
+    if job is not None:
+        job[0].update(job[1], progress=json.dumps(progress))
+
+
+class JobQueue(object):
+    """
+    Durable queue of provisioning jobs, run by a pool of worker threads.
+
+    Jobs are kept in an SQLite database, shared by every worker process when it is a file, and each job is claimed by
+    a single worker thread. Jobs left running for more than `timeout` seconds, by a worker process which died, are
+    queued again. The number of worker threads caps the provisioning calls made to RabbitMQ at the same time.
+    """
+
+    columns = ('id', 'kind', 'instance', 'state', 'progress', 'error', 'created_at', 'updated_at')
+
+    def __init__(self, app, path=None, workers=4, poll_interval=1, timeout=300):
+        self.app = app
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path or ':memory:', check_same_thread=False, isolation_level=None)
+        if path:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(SCHEMA)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def enqueue(self, kind, instance, **payload):
+        """Queue a job of `kind` about the instance named <instance>, returning its id"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute('INSERT INTO jobs VALUES (?, ?, ?, ?, ?, NULL, NULL, ?, ?)',
+                               (job_id, kind, instance, json.dumps(payload), PENDING, now, now))
+        self.start()
+        self._wakeup.set()
+        return job_id
+
+    def update(self, job_id, **fields):
+        fields['updated_at'] = time.time()
+        names = sorted(fields)
+        assignments = ', '.join('{} = ?'.format(name) for name in names)
+        with self._lock:
+            self._conn.execute('UPDATE jobs SET {} WHERE id = ?'.format(assignments),
+                               [fields[name] for name in names] + [job_id])
+
+    def get(self, job_id):
+        """The job with id <job_id> as a dict, or None if there is none"""
+        with self._lock:
+            row = self._conn.execute('SELECT {} FROM jobs WHERE id = ?'.format(', '.join(self.columns)),
+                                     (job_id,)).fetchone()
+        return self._job(row)
+
+    def latest(self, instance, kind):
+        """The last job of `kind` queued for the instance named <instance>, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT {} FROM jobs WHERE instance = ? AND kind = ? ORDER BY created_at DESC LIMIT 1'.format(
+                    ', '.join(self.columns)), (instance, kind)).fetchone()
+        return self._job(row)
+
+    def _job(self, row):
+        if row is None:
+            return None
+        job = dict(zip(self.columns, row))
+        job['progress'] = json.loads(job['progress']) if job['progress'] else None
+        return job
+
+    def claim(self):
+        """Take the oldest pending job, returning its id, kind and payload, or None if there is none"""
+        with self._lock:
+            # jobs of a worker process which died are run again
+            self._conn.execute('UPDATE jobs SET state = ? WHERE state = ? AND updated_at < ?',
+                               (PENDING, RUNNING, time.time() - self.timeout))
+            while True:
+                row = self._conn.execute('SELECT id, kind, payload FROM jobs WHERE state = ? '
+                                         'ORDER BY created_at LIMIT 1', (PENDING,)).fetchone()
+                if row is None:
+                    return None
+                # another worker process may have claimed it in between
+                claimed = self._conn.execute('UPDATE jobs SET state = ?, updated_at = ? WHERE id = ? AND state = ?',
+                                             (RUNNING, time.time(), row[0], PENDING)).rowcount
+                if claimed:
+                    return row[0], row[1], json.loads(row[2])
+
+    def run(self, job_id, kind, payload):
+        _current.job = (self, job_id)
+        try:
+            with self.app.app_context():
+                handlers[kind](**payload)
+        except Exception as e:
+            error = e.description if isinstance(e, HTTPException) else str(e)
+            self.app.logger.error('Job {} ({}) failed: {}'.format(job_id, kind, error))
+            self.update(job_id, state=FAILED, error=error)
+        else:
+            self.update(job_id, state=DONE)
+        finally:
+            _current.job = None
+
+    def _work(self):
+        while not self._stop.is_set():
+            job = self.claim()
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self.run(*job)
+
+    def start(self):
+        """Start the worker threads, unless they are running already"""
+        with self._lock:
+            if self._threads:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._work, name='jobs-{}'.format(number))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+
+def async_provisioning(config):
+    """
+    Tell whether provisioning requests are run by background jobs. Jobs are kept in the state store database, so
+    ASYNC_PROVISIONING needs a STATE_STORE_PATH: an in-memory queue loses its jobs on restart, and the other worker
+    processes cannot tell their state.
+    """
+    return bool(config['ASYNC_PROVISIONING'] and config['STATE_STORE_PATH'])
+
+
+def get_jobs():
+    """Return the job queue of the current app"""
+    return app_extension('jobs', lambda app: JobQueue(
+        app,
+        path=app.config['STATE_STORE_PATH'],
+        workers=app.config['JOBS_WORKERS'],
+        poll_interval=app.config['JOBS_POLL_INTERVAL'],
+        timeout=app.config['JOBS_TIMEOUT'],
+    ))
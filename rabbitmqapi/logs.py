@@ -0,0 +1,168 @@
+from __future__ import unicode_literals
+
+import json
+import logging
+import random
+import re
+
+from flask import current_app, g, request
+
+from .cache import clock
+from .utils import app_extension
+
+try:
+    from queue import Queue, Full
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:  # Python 2
+    QueueHandler = QueueListener = None
+
+
+#
+# Secrets kept out of the logs: the values of these headers, and of password fields in bodies
+#
+secret_headers = ('authorization', 'cookie', 'proxy-authorization')
+secret_fields = re.compile(r'''(?i)(password["']?\s*[:=]\s*["']?)[^&"'\s,}]+''')
+redacted = '[redacted]'
+
+#
+# Bodies are truncated to this many characters when dumped
+#
+body_limit = 4096
+
+
+def redact(text):
+    """Replace the values of password fields in `text`"""
+    return secret_fields.sub(r'\1' + redacted, text)
+
+
+def format_headers(headers):
+    return ''.join('{}: {}\r\n'.format(name, redacted if name.lower() in secret_headers else value)
+                   for name, value in headers.items())
+
+
+class RequestDump(object):
+    """The request being served, formatted only if the log record it is passed to is emitted"""
+
+    def __init__(self, request):
+        self.request = request
+
+    def __str__(self):
+        return '{}\n{}\r\n{}'.format(self.request, format_headers(self.request.headers),
+                                     redact(self.request.get_data(as_text=True)[:body_limit]))
+
+
+class ResponseDump(object):
+    """A response, formatted only if the log record it is passed to is emitted"""
+
+    def __init__(self, response):
+        self.response = response
+
+    def __str__(self):
+        body = '(streamed)' if self.response.is_streamed else self.response.get_data(as_text=True)[:body_limit]
+        return '{}\n{}\r\n{}'.format(self.response.status, format_headers(self.response.headers), redact(body))
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats access log records as a JSON object of their fields"""
+
+    def format(self, record):
+        fields = dict(getattr(record, 'access', {}), time=self.formatTime(record), level=record.levelname)
+        return json.dumps(fields, sort_keys=True)
+
+
+if QueueHandler is not None:
+    class DroppingQueueHandler(QueueHandler):
+        """Queues records for a background thread, dropping them instead of waiting when the queue is full"""
+
+        dropped = 0
+
+        def enqueue(self, record):
+            try:
+                self.queue.put_nowait(record)
+            except Full:
+                self.dropped += 1
+
+
+class AccessLog(object):
+    """
+    Structured access log of the requests served, one record per request on the `rabbitmqapi.access` logger.
+
+    Records carry the method, path, endpoint, status, size and duration of the request in their `access` attribute,
+    and are only built when the logger is enabled for INFO. Only a `sample_rate` fraction of the requests is logged,
+    except errors which are always logged.
+
+    With a `queue_size`, records are handed over to a background thread through a bounded queue, so a slow log
+    destination never stalls a worker. Records are dropped while the queue is full.
+    """
+
+    text_format = '%(remote_addr)s "%(method)s %(path)s" %(status)s %(bytes)s %(duration_ms).1fms'
+
+    def __init__(self, sample_rate=1.0, json_format=False, queue_size=0, logger=None, handler=None):
+        self.sample_rate = sample_rate
+        self.logger = logger or logging.getLogger('rabbitmqapi.access')
+        self.handler = handler or logging.StreamHandler()
+        self.handler.setFormatter(JSONFormatter() if json_format else logging.Formatter('%(asctime)s %(message)s'))
+        self.listener = None
+        if queue_size and QueueHandler is not None:
+            self.listener = QueueListener(Queue(queue_size), self.handler)
+            self.installed = DroppingQueueHandler(self.listener.queue)
+            self.listener.start()
+        else:
+            self.installed = self.handler
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.logger.addHandler(self.installed)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            sample_rate=config['ACCESS_LOG_SAMPLE_RATE'],
+            json_format=config['ACCESS_LOG_FORMAT'] == 'json',
+            queue_size=config['ACCESS_LOG_QUEUE_SIZE'],
+        )
+
+    @property
+    def dropped(self):
+        return getattr(self.installed, 'dropped', 0)
+
+    def log(self, request, response, duration):
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        if response.status_code < 500 and random.random() >= self.sample_rate:
+            return
+        fields = {
+            'remote_addr': request.remote_addr,
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'bytes': response.content_length,
+            'duration_ms': duration * 1000,
+        }
+        self.logger.info(self.text_format, fields, extra={'access': fields})
+
+    def close(self):
+        self.logger.removeHandler(self.installed)
+        if self.listener is not None:
+            # flushes the records still queued
+            self.listener.stop()
+            self.listener = None
+
+
+def get_access_log():
+    """Return the access log of the current app, or None if ACCESS_LOG is not set"""
+    return app_extension('access_log', lambda app: AccessLog.from_config(app.config) if app.config['ACCESS_LOG']
+                         else None)
+
+
+def start_timer():
+    g.request_started = clock()
+
+
+def log_response(response):
+    """Log the response to the request being served, with the time it took since `start_timer`"""
+    access_log = get_access_log()
+    if access_log is not None and 'request_started' in g:
+        access_log.log(request, response, clock() - g.request_started)
+    current_app.logger.debug('Sent response: %s', ResponseDump(response))
+    return response
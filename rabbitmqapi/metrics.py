@@ -0,0 +1,157 @@
+from __future__ import unicode_literals
+
+import threading
+from bisect import bisect_left
+
+from flask import g, request
+
+from .cache import clock
+from .utils import app_extension
+
+
+def escape(value):
+    return '{}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+
+class Metric(object):
+    """
+    A counter, gauge or histogram, holding a value for each combination of label values.
+
+    Histograms count the observations falling in each bucket, and keep their sum and count, so latency percentiles
+    can be estimated across workers and time by the monitoring system.
+    """
+
+    def __init__(self, name, kind, help, labels=(), buckets=()):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple('{}'.format(labels[name]) for name in self.labels)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self.values.get(key)
+            if series is None:
+                # a count per bucket plus one for values above the last bucket, then the sum and the count
+                series = self.values[key] = [0] * (len(self.buckets) + 3)
+            series[bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def get(self, **labels):
+        """Current value of a counter or gauge, or the count of a histogram"""
+        value = self.values.get(self._key(labels), 0)
+        return value[-1] if isinstance(value, list) else value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            values = sorted((key, list(value) if isinstance(value, list) else value)
+                            for key, value in self.values.items())
+        for key, value in values:
+            if self.kind != 'histogram':
+                lines.append('{}{} {!r}'.format(self.name, format_labels(self.labels, key), value))
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), value):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, format_labels(self.labels, key, [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {!r}'.format(self.name, format_labels(self.labels, key), float(value[-2])))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(self.labels, key), value[-1]))
+        return '\n'.join(lines)
+
+
+class Metrics(object):
+    """
+    Instrumentation of the service, rendered in the Prometheus text format by the `/metrics` endpoint.
+
+    Requests to the service are labelled by endpoint, and management API calls by verb and path template, like
+    `permissions/{vhost}/{user}`, so the time spent in our workers can be told apart from the time spent in RabbitMQ.
+    Metrics are kept by each worker process.
+    """
+
+    def __init__(self, buckets):
+        self.metrics = []
+        self.requests = self.add('rabbitmqapi_requests_total', 'counter', 'Requests served, by endpoint and status',
+                                 ('endpoint', 'method', 'status'))
+        self.request_duration = self.add('rabbitmqapi_request_duration_seconds', 'histogram',
+                                         'Time spent serving requests', ('endpoint', 'method'), buckets)
+        self.requests_in_flight = self.add('rabbitmqapi_requests_in_flight', 'gauge', 'Requests being served',
+                                           ('endpoint',))
+        self.management_calls = self.add('rabbitmqapi_management_calls_total', 'counter',
+                                         'Calls to the RabbitMQ management API answered, by status',
+                                         ('verb', 'path', 'status'))
+        self.management_duration = self.add('rabbitmqapi_management_call_duration_seconds', 'histogram',
+                                            'Time spent in calls to the RabbitMQ management API, retries included',
+                                            ('verb', 'path'), buckets)
+        self.management_in_flight = self.add('rabbitmqapi_management_calls_in_flight', 'gauge',
+                                             'Calls to the RabbitMQ management API waiting for an answer',
+                                             ('verb', 'path'))
+        self.management_errors = self.add('rabbitmqapi_management_call_errors_total', 'counter',
+                                          'Failed calls to the RabbitMQ management API, by reason: timeout, '
+                                          'connection, unavailable or status', ('verb', 'path', 'reason'))
+        self.status_check_duration = self.add('rabbitmqapi_status_check_duration_seconds', 'histogram',
+                                              'Time spent checking the health of instances, by check',
+                                              ('check',), buckets)
+
+    def add(self, name, kind, help, labels=(), buckets=()):
+        metric = Metric(name, kind, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+def get_metrics():
+    """Return the metrics of the current app"""
+    return app_extension('metrics', lambda app: Metrics(app.config['METRICS_BUCKETS']))
+
+
+def start_request():
+    g.metrics_started = clock()
+    get_metrics().requests_in_flight.inc(endpoint=request.endpoint)
+
+
+def record_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def finish_request(exc):
+    if 'metrics_started' not in g:
+        return
+    metrics = get_metrics()
+    metrics.requests_in_flight.dec(endpoint=request.endpoint)
+    metrics.request_duration.observe(clock() - g.metrics_started, endpoint=request.endpoint, method=request.method)
+    # unhandled exceptions skip the after request hooks, and end up as a 500 response
+    metrics.requests.inc(endpoint=request.endpoint, method=request.method, status=g.get('metrics_status', 500))
+
+
+def instrument(blueprint):
+    """Record the requests served by the routes of `blueprint`"""
+    blueprint.before_request(start_request)
+    blueprint.after_request(record_status)
+    blueprint.teardown_request(finish_request)
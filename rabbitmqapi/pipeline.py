@@ -0,0 +1,114 @@
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from flask import current_app
+
+
+class Step(object):
+    """A single provisioning call, its requirements and the call undoing it"""
+
+    def __init__(self, name, action, requires=(), rollback=None):
+        self.name = name
+        self.action = action
+        self.requires = tuple(requires)
+        self.rollback = rollback
+
+
+def _call(app, func):
+    """Run `func` inside an app context, returning a (succeeded, result or exception) tuple"""
+    with app.app_context():
+        try:
+            return True, func()
+        except Exception as e:
+            return False, e
+
+
+def map_in_context(func, items, concurrency):
+    """
+    Call `func` on every item using up to `concurrency` threads, each one running inside the current app context.
+
+    Returns a list of (succeeded, result or exception) tuples, in the same order as `items`.
+    """
+    app = current_app._get_current_object()
+    if len(items) <= 1:
+        return [_call(app, partial(func, item)) for item in items]
+    pool = ThreadPool(min(concurrency, len(items)))
+    try:
+        return pool.map(lambda item: _call(app, partial(func, item)), items)
+    finally:
+        pool.close()
+
+
+class Pipeline(object):
+    """
+    Runs a dependency graph of management API calls.
+
+    Steps whose requirements are satisfied run concurrently, each one in its own app context. If a step
+    fails, the rollbacks of every step that already succeeded run in the reverse order, and the error of the first
+    failing step is raised again to the caller.
+    """
+
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency
+        self.steps = OrderedDict()
+        self._pool = None
+
+    def add(self, name, action, requires=(), rollback=None):
+        """Add a step to the pipeline. `requires` lists the names of the steps that must succeed first."""
+        if name in self.steps:
+            raise ValueError('Duplicated step {}'.format(name))
+        self.steps[name] = Step(name, action, requires, rollback)
+        return self
+
+    def waves(self):
+        """Group the steps in waves, every step depending only on steps of previous waves"""
+        done = set()
+        pending = list(self.steps.values())
+        while pending:
+            wave = [step for step in pending if done.issuperset(step.requires)]
+            if not wave:
+                raise ValueError('Unsatisfiable dependencies for steps {}'.format(
+                    ', '.join(step.name for step in pending)))
+            yield wave
+            done.update(step.name for step in wave)
+            pending = [step for step in pending if step.name not in done]
+
+    def _run_wave(self, app, funcs):
+        if len(funcs) == 1:
+            return [_call(app, funcs[0])]
+        if self._pool is None:
+            # threads are only started when there is something to run concurrently
+            self._pool = ThreadPool(self.concurrency or app.config['PROVISIONING_CONCURRENCY'])
+        return self._pool.map(lambda func: _call(app, func), funcs)
+
+    def run(self):
+        """Run every step, returning a dictionary with the result of each one"""
+        app = current_app._get_current_object()
+        results = {}
+        completed = []
+        try:
+            for wave in self.waves():
+                outcomes = self._run_wave(app, [step.action for step in wave])
+                completed.append([step for step, (ok, _) in zip(wave, outcomes) if ok])
+                errors = [result for ok, result in outcomes if not ok]
+                if errors:
+                    self._rollback(app, completed)
+                    raise errors[0]
+                results.update((step.name, result) for step, (_, result) in zip(wave, outcomes))
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+        return results
+
+    def _rollback(self, app, completed):
+        for wave in reversed(completed):
+            rollbacks = [step.rollback for step in wave if step.rollback is not None]
+            if not rollbacks:
+                continue
+            for ok, error in self._run_wave(app, rollbacks):
+                if not ok:
+                    app.logger.error('Error rolling back provisioning step: {}'.format(error))
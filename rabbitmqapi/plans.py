@@ -0,0 +1,163 @@
+from __future__ import unicode_literals
+
+import json
+
+from .checks import CHECKS
+from .utils import app_extension
+
+
+#
+# Policies to allow high availability, applied to the instances of the legacy plan
+#
+ha_policy_name = "ha-queues"
+ha_policy = {
+    "vhost": None,
+    "name": ha_policy_name,
+    "pattern": "",
+    "apply-to": "all",
+    "definition": {
+        "ha-mode": "all",
+        "ha-sync-mode": "automatic"
+    },
+    "priority": 0
+}
+
+#
+# Name of the policy holding the queue settings of a plan
+#
+plan_policy_name = "plan"
+
+#
+# Settings of a plan mapped to the vhost limits they set
+#
+vhost_limits = (('max_connections', 'max-connections'), ('max_queues', 'max-queues'))
+
+
+class Plan(object):
+    """
+    A plan instances can be created with, as set in the PLANS configuration parameter.
+
+    :param ha: how queues are replicated: `all` mirrors them on every node, `exactly` on `replicas` nodes, and
+               `quorum` makes quorum queues the default queue type of the vhost. Queues are not replicated otherwise.
+    :param lazy: keep messages on disk as early as possible.
+    :param max_length: maximum number of messages of each queue.
+    :param message_ttl: milliseconds messages are kept in queues.
+    :param max_connections: and `max_queues` limit the connections and queues of the vhost.
+    :param check: how the status of instances is checked, one of `checks.CHECKS`, STATUS_CHECK if not given.
+    """
+
+    def __init__(self, name, description='', ha=None, replicas=2, lazy=False, max_length=None, message_ttl=None,
+                 max_connections=None, max_queues=None, check=None):
+        if ha not in (None, 'all', 'exactly', 'quorum'):
+            raise ValueError('Unknown replication {} of plan {}'.format(ha, name))
+        if check is not None and check not in CHECKS:
+            raise ValueError('Unknown status check {} of plan {}'.format(check, name))
+        self.name = name
+        self.description = description
+        self.ha = ha
+        self.replicas = replicas
+        self.lazy = lazy
+        self.max_length = max_length
+        self.message_ttl = message_ttl
+        self.max_connections = max_connections
+        self.max_queues = max_queues
+        self.check = check
+
+    def __repr__(self):
+        return '<Plan {}>'.format(self.name)
+
+    def vhost(self):
+        """Body of the request creating the vhost of an instance"""
+        return {'default_queue_type': 'quorum'} if self.ha == 'quorum' else None
+
+    def policies(self, vhost):
+        """Policies of the vhost of an instance, by name"""
+        definition = {}
+        if self.ha == 'all':
+            definition.update({'ha-mode': 'all', 'ha-sync-mode': 'automatic'})
+        elif self.ha == 'exactly':
+            definition.update({'ha-mode': 'exactly', 'ha-params': self.replicas, 'ha-sync-mode': 'automatic'})
+        if self.lazy:
+            definition['queue-mode'] = 'lazy'
+        if self.max_length is not None:
+            definition['max-length'] = self.max_length
+        if self.message_ttl is not None:
+            definition['message-ttl'] = self.message_ttl
+        if not definition:
+            return {}
+        # queues only get the settings of the policy with the highest priority, so they all go in a single one
+        return {plan_policy_name: {
+            'vhost': vhost,
+            'name': plan_policy_name,
+            'pattern': '',
+            'apply-to': 'queues',
+            'definition': definition,
+            'priority': 0,
+        }}
+
+    def limits(self):
+        """Limits of the vhost of an instance, by name"""
+        return dict((limit, getattr(self, setting)) for setting, limit in vhost_limits
+                    if getattr(self, setting) is not None)
+
+    def public(self):
+        """The plan as listed to tsuru"""
+        return {'name': self.name, 'description': self.description}
+
+
+class LegacyPlan(Plan):
+    """Plan of the instances created without a plan, or before plans were configured: every queue is mirrored"""
+
+    def __init__(self):
+        super(LegacyPlan, self).__init__('')
+
+    def policies(self, vhost):
+        return {ha_policy_name: dict(ha_policy, vhost=vhost)}
+
+
+class Plans(object):
+    """
+    The configured plans, with the response of the plans endpoint built once. Without plans, the names in `placement`,
+    which only choose the cluster of instances (see `ClusterMap`), are still accepted.
+    """
+
+    def __init__(self, plans=(), placement=()):
+        self.plans = [plan if isinstance(plan, Plan) else Plan(**plan) for plan in plans or ()]
+        self.by_name = dict((plan.name, plan) for plan in self.plans)
+        self.placement = frozenset(placement)
+        self.legacy = LegacyPlan()
+        #
+        # Use dumps instead of jsonify to return a top level array, see
+        # http://flask.pocoo.org/docs/0.10/security/#json-security
+        # It is safe if we don't do any user-data processing.
+        #
+        self.response = json.dumps([plan.public() for plan in self.plans])
+
+    def get(self, name):
+        """
+        The plan named <name>. Without a name, that is the first configured plan, or the legacy plan if there is none.
+        Raises KeyError for unknown plans.
+        """
+        if not name:
+            return self.plans[0] if self.plans else self.legacy
+        if not self.plans:
+            if name not in self.placement:
+                raise KeyError(name)
+            return self.legacy
+        return self.by_name[name]
+
+    def of(self, record):
+        """The plan of an instance, given its record in the state store"""
+        name = record and record['plan']
+        # instances created before plans were configured, or whose plan was removed, keep the legacy policies
+        return self.by_name.get(name, self.legacy) if name else self.legacy
+
+
+def get_plans():
+    """Return the plans of the current app"""
+    def factory(app):
+        placement = ()
+        if app.config['CLUSTER_PLACEMENT'] == 'plan':
+            placement = [name for settings in app.config['RMQ_CLUSTERS'] or () for name in settings.get('plans', ())]
+        return Plans(app.config['PLANS'], placement)
+    return app_extension('plans', factory)
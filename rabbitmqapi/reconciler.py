@@ -0,0 +1,220 @@
+from __future__ import unicode_literals
+
+import fcntl
+import json
+import threading
+import time
+from collections import deque
+from functools import partial
+
+from werkzeug.exceptions import HTTPException
+
+from .clusters import get_clusters
+from .definitions import full_permissions
+from .http_client import send, stream_page
+from .pipeline import map_in_context
+from .plans import get_plans
+from .store import get_store
+from .utils import all_credentials, service_username
+
+
+#
+# Listings compared against the state store, with the columns requested and the key identifying each item
+#
+LISTINGS = [
+    ('vhosts', ('name',), lambda item: item['name']),
+    ('users', ('name',), lambda item: item['name']),
+    ('permissions', ('vhost', 'user'), lambda item: (item['vhost'], item['user'])),
+    ('policies', ('vhost', 'name'), lambda item: (item['vhost'], item['name'])),
+]
+
+
+class Reconciler(object):
+    """
+    Background worker repairing the drift between what the state store says the service created and the actual
+    state of RabbitMQ: missing vhosts, users, permissions or policies left behind by failed provisioning calls.
+
+    Listings are walked incrementally, a few pages per cycle, so a cycle stays cheap however big the broker is. When
+    the walk of a listing is over, it is compared with the store and the fixes it needs are queued. Fixes are applied
+    in rate limited batches, a bounded number per cycle.
+
+    Vhosts missing from the store, and users named like ours but missing from it, are only deleted with
+    RECONCILE_DELETE_ORPHANS set, and only when they show up in two walks in a row, so instances being provisioned
+    are left alone.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.cursors = {}
+        self.seen = {}
+        self.suspects = {}
+        self.fixes = deque()
+        self._queued = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def config(self):
+        return self.app.config
+
+    def run_once(self):
+        """Run a reconciliation cycle, returning the number of fixes applied"""
+        with self.app.app_context():
+            get_store().reload()
+            for cluster in get_clusters().clusters:
+                for listing in LISTINGS:
+                    self._walk(cluster, *listing)
+            return self._apply_fixes()
+
+    def _walk(self, cluster, kind, columns, key):
+        state = (cluster.name, kind)
+        page = self.cursors.get(state, 1)
+        seen = self.seen.setdefault(state, set())
+        for _ in range(self.config['RECONCILE_PAGES_PER_CYCLE']):
+            try:
+                # only the keys of the items are kept, items are parsed and dropped as they are read
+                items = stream_page(kind, page, self.config['RECONCILE_PAGE_SIZE'], columns, cluster=cluster)
+                seen.update(key(item) for item in items)
+                page_count = items.page_count
+            except HTTPException as e:
+                # the listing may have shrunk under our cursor, start the walk over
+                self.app.logger.error('Error listing {} of cluster {}: {}'.format(kind, cluster.name, e))
+                self.cursors[state], self.seen[state] = 1, set()
+                return
+            if page >= page_count:
+                self._compare(cluster, kind, seen)
+                self.cursors[state], self.seen[state] = 1, set()
+                return
+            page += 1
+        self.cursors[state] = page
+
+    def _compare(self, cluster, kind, seen):
+        """Queue the fixes needed for the whole `kind` listing of `cluster`, as seen in `seen`"""
+        store = get_store()
+        single_cluster = len(get_clusters().clusters) == 1
+        instances = [name for name, record in store.instances.items()
+                     if single_cluster or record['cluster'] == cluster.name]
+
+        if kind == 'vhosts':
+            for name in instances:
+                if name not in seen:
+                    self._queue('create vhost {}'.format(name), cluster, 'put', 'vhosts/{}'.format(name),
+                                instance=name)
+            self._orphans(cluster, kind, seen - set(store.instances) - set(['/']), 'vhosts/{}')
+
+        elif kind == 'users':
+            bound = set()
+            derivations = all_credentials()
+            for name in instances:
+                for app_host, username in store.bindings_of(name).items():
+                    # the users of the previous salts are kept while SALT is rotated, see `rotation`
+                    derived = dict(credentials.derive(name, app_host) for credentials in derivations)
+                    bound.update(derived)
+                    if username not in seen:
+                        password = derived.get(username) or derivations[0].derive(name, app_host)[1]
+                        self._queue('create user {}'.format(username), cluster, 'put', 'users/{}'.format(username),
+                                    {'password': password, 'tags': ''}, instance=name)
+            orphans = set(username for username in seen - bound if service_username.match(username))
+            orphans.discard(cluster.user)
+            self._orphans(cluster, kind, orphans, 'users/{}')
+
+        elif kind == 'permissions':
+            for name in instances:
+                for username in [cluster.user] + sorted(store.bindings_of(name).values()):
+                    if (name, username) not in seen:
+                        self._queue('grant {} on {}'.format(username, name), cluster, 'put',
+                                    'permissions/{}/{}'.format(name, username), full_permissions, instance=name)
+
+        elif kind == 'policies':
+            plans = get_plans()
+            for name in instances:
+                for policy_name, policy in sorted(plans.of(store.instances[name]).policies(name).items()):
+                    if (name, policy_name) not in seen:
+                        self._queue('set policy {} on {}'.format(policy_name, name), cluster, 'put',
+                                    'policies/{}/{}'.format(name, policy_name), policy, instance=name)
+
+    def _orphans(self, cluster, kind, orphans, url):
+        """
+        Delete the orphans seen in two cycles in a row, only if the state store recorded their deletion: objects it
+        has no record of may predate the store, and are only logged
+        """
+        state = (cluster.name, kind)
+        previous = self.suspects.get(state, set())
+        self.suspects[state] = orphans
+        deleted = get_store().deleted(kind[:-1]) if self.config['RECONCILE_DELETE_ORPHANS'] else set()
+        for orphan in sorted(orphans & previous):
+            if orphan in deleted:
+                self._queue('delete orphan {}'.format(url.format(orphan)), cluster, 'delete', url.format(orphan))
+            else:
+                self.app.logger.warning('Orphan {} found in cluster {}'.format(url.format(orphan), cluster.name))
+
+    def _queue(self, description, cluster, verb, rel_url, body=None, instance=None):
+        """Queue a fix, which is dropped if it is about an `instance` deleted by the time it is applied"""
+        fix = (cluster.name, verb, rel_url)
+        if fix in self._queued:
+            return
+        self._queued.add(fix)
+        call = partial(send, verb, rel_url, cluster=cluster)
+        if body is not None:
+            call = partial(call, data=json.dumps(body))
+        self.fixes.append((fix, description, call, instance))
+
+    def _apply(self, fix):
+        """Apply a queued fix, returning whether it was applied"""
+        instance = fix[3]
+        # the store was loaded before the listings were walked, creating the objects of an instance deleted since
+        # then would bring it back as an orphan
+        if instance is not None and get_store().instance(instance, fresh=True) is None:
+            return False
+        fix[2]()
+        return True
+
+    def _apply_fixes(self):
+        applied = 0
+        batch_size = self.config['BATCH_CONCURRENCY']
+        while self.fixes and applied < self.config['RECONCILE_MAX_FIXES']:
+            batch = [self.fixes.popleft() for _ in range(min(batch_size, len(self.fixes)))]
+            outcomes = map_in_context(self._apply, batch, batch_size)
+            for (fix, description, _, instance), (ok, result) in zip(batch, outcomes):
+                self._queued.discard(fix)
+                if ok and result:
+                    self.app.logger.info('Reconciler: {}'.format(description))
+                elif ok:
+                    self.app.logger.info('Reconciler did not {}, instance {} was deleted'.format(description, instance))
+                else:
+                    self.app.logger.error('Reconciler could not {}: {}'.format(description, result))
+            applied += len(batch)
+            if self.fixes:
+                time.sleep(self.config['RECONCILE_BATCH_INTERVAL'])
+        return applied
+
+    def _locked_cycle(self, lock_file):
+        """Run a cycle unless another worker process is already reconciling"""
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return
+        try:
+            self.run_once()
+        except Exception as e:
+            self.app.logger.exception('Reconciliation cycle failed: {}'.format(e))
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _run(self):
+        with open('{}.reconciler.lock'.format(self.config['STATE_STORE_PATH']), 'a') as lock_file:
+            while not self._stop.wait(self.config['RECONCILE_INTERVAL']):
+                self._locked_cycle(lock_file)
+
+    def start(self):
+        """Run reconciliation cycles every RECONCILE_INTERVAL seconds in a background thread"""
+        if not self.config['STATE_STORE_PATH']:
+            self.app.logger.warning('Not starting the reconciler, it needs a persistent state store')
+            return False
+        self._thread = threading.Thread(target=self._run, name='reconciler')
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,200 @@
+from __future__ import unicode_literals
+
+import fcntl
+import os
+import random
+import re
+import struct
+import threading
+import time
+
+from .cache import clock
+
+
+class Unavailable(Exception):
+    """Raised instead of calling an endpoint which is known to be down or overloaded"""
+
+
+def backoff_delays(retries, base, cap):
+    """Delays to wait before each retry: exponential backoff with full jitter"""
+    for attempt in range(retries):
+        yield random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """
+    Fails fast while an endpoint is down.
+
+    After `threshold` consecutive failures the circuit opens, and calls are refused for `reset_timeout` seconds.
+    Then a single trial call is let through: the circuit closes again if it succeeds, and re-opens otherwise.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self._trial or clock() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        """Tell whether a call can go out now"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._trial and clock() - self.opened_at >= self.reset_timeout:
+                self._trial = True
+                return True
+            return False
+
+    def release(self):
+        """Give back the trial call handed out by `allow`, for a call which did not complete"""
+        with self._lock:
+            self._trial = False
+
+    def succeeded(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = clock()
+                self._trial = False
+
+
+class Bulkhead(object):
+    """Caps the number of concurrent calls to an endpoint, so a slow endpoint cannot hold every worker thread"""
+
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self.running = 0
+        # semaphores only take a timeout on Python 3
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        if not self.limit:
+            return self
+        deadline = None if self.timeout is None else clock() + self.timeout
+        with self._condition:
+            while self.running >= self.limit:
+                remaining = None if deadline is None else deadline - clock()
+                if remaining is not None and remaining <= 0:
+                    raise Unavailable('Too many concurrent calls')
+                self._condition.wait(remaining)
+            self.running += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.limit:
+            with self._condition:
+                self.running -= 1
+                self._condition.notify()
+
+
+class TokenBucket(object):
+    """
+    Lets `rate` calls per second through, with bursts of up to `burst` calls.
+
+    With a `path`, the bucket is kept in that file and shared by every process using it, which take turns through a
+    file lock. Otherwise it is only shared by the threads of the current process.
+    """
+
+    state = struct.Struct(str('<dd'))
+
+    def __init__(self, rate, burst=None, path=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.path = path
+        self._tokens, self._updated = self.burst, time.time()
+        self._file = open(path, 'a+b') if path else None
+        self._lock = threading.Lock()
+
+    def _read(self):
+        if self._file is None:
+            return self._tokens, self._updated
+        self._file.seek(0)
+        data = self._file.read(self.state.size)
+        # a new file holds a full bucket
+        return self.state.unpack(data) if len(data) == self.state.size else (self.burst, time.time())
+
+    def _write(self, tokens, updated):
+        if self._file is None:
+            self._tokens, self._updated = tokens, updated
+            return
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(self.state.pack(tokens, updated))
+        self._file.flush()
+
+    def take(self):
+        """Take a token if there is one, returning 0, or else the seconds to wait for the next one"""
+        with self._lock:
+            if self._file is not None:
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                tokens, updated = self._read()
+                now = time.time()
+                tokens = min(self.burst, tokens + max(0, now - updated) * self.rate)
+                wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+                self._write(tokens - 1 if tokens >= 1 else tokens, now)
+                return wait
+            finally:
+                if self._file is not None:
+                    fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def acquire(self, timeout):
+        """Wait for a token for up to `timeout` seconds, telling whether one was taken"""
+        deadline = time.time() + timeout
+        while True:
+            wait = self.take()
+            if not wait:
+                return True
+            if time.time() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class RateLimiter(object):
+    """
+    Token buckets capping the calls made to an endpoint, one per budget, like `writes` or `expensive` reads.
+
+    Calls of a budget without a bucket are not limited. Calls waiting more than `timeout` seconds for a token raise
+    `Unavailable`.
+    """
+
+    def __init__(self, buckets=None, timeout=5):
+        self.buckets = buckets or {}
+        self.timeout = timeout
+
+    @classmethod
+    def from_config(cls, config, endpoint):
+        """Build the limiter of `endpoint`, a `host:port` string, from the RATE_LIMIT_* settings"""
+        buckets = {}
+        for budget in ('writes', 'expensive'):
+            rate = config['RATE_LIMIT_{}'.format(budget.upper())]
+            if not rate:
+                continue
+            path = None
+            if config['RATE_LIMIT_DIR']:
+                path = os.path.join(config['RATE_LIMIT_DIR'], 'rabbitmqapi-{}-{}.bucket'.format(
+                    re.sub(r'[^\w.-]', '_', endpoint), budget))
+            buckets[budget] = TokenBucket(rate, config['RATE_LIMIT_{}_BURST'.format(budget.upper())], path)
+        return cls(buckets, config['RATE_LIMIT_TIMEOUT'])
+
+    def acquire(self, budget):
+        bucket = self.buckets.get(budget)
+        if bucket is not None and not bucket.acquire(self.timeout):
+            raise Unavailable('Rate limit of {} calls exceeded'.format(budget))
@@ -0,0 +1,146 @@
+from __future__ import unicode_literals
+
+import json
+import time
+
+from flask import current_app
+
+from .clusters import get_clusters
+from .definitions import Definitions, full_permissions
+from .http_client import send
+from .jobs import job_handler, report_progress
+from .pipeline import map_in_context
+from .store import get_store
+from .utils import get_credentials, previous_credentials
+
+ROTATE, RETIRE = 'rotate_credentials', 'retire_credentials'
+
+
+def batches(items, cluster_of, size):
+    """Split `items` in batches of at most `size` items of the same cluster, as (cluster, items) tuples"""
+    by_cluster = {}
+    for item in items:
+        cluster = cluster_of(item)
+        by_cluster.setdefault(cluster.name, (cluster, []))[1].append(item)
+    return [(cluster, items[start:start + size])
+            for _, (cluster, items) in sorted(by_cluster.items())
+            for start in range(0, len(items), size)]
+
+
+def run_batches(func, batches, progress):
+    """
+    Call `func(cluster, items)` on every batch, ROTATION_CONCURRENCY batches at a time and waiting
+    ROTATION_BATCH_INTERVAL seconds between rounds, reporting `progress(done, failed)` after each round. `func` may
+    return how many of the items failed, all of them fail if it raises. Returns the number of items which failed.
+    """
+    config = current_app.config
+    concurrency = config['ROTATION_CONCURRENCY']
+    done = failed = 0
+    for start in range(0, len(batches), concurrency):
+        if start:
+            time.sleep(config['ROTATION_BATCH_INTERVAL'])
+        running = batches[start:start + concurrency]
+        outcomes = map_in_context(lambda batch: func(*batch), running, concurrency)
+        for (cluster, items), (ok, result) in zip(running, outcomes):
+            if ok:
+                failed += result or 0
+                done += len(items) - (result or 0)
+            else:
+                failed += len(items)
+                current_app.logger.error('Credentials rotation failed for {} bindings of cluster {}: {}'.format(
+                    len(items), cluster.name, getattr(result, 'description', None) or result))
+        progress(done, failed)
+    return failed
+
+
+def user_definitions(bindings):
+    definitions = Definitions()
+    for instance, _, username, password in bindings:
+        definitions.add_user(username, password)
+        definitions.add_permission(instance, username, full_permissions)
+    return definitions
+
+
+def create_users(cluster, bindings):
+    """
+    Create the users of `bindings`, (instance, app host, username, password) tuples, with a definitions import.
+    Records the bindings whose user was created in the state store, and returns how many failed.
+    """
+    created = bindings
+    # RabbitMQ rejects the whole document if any vhost is gone, the users are then created one binding at a time
+    if not user_definitions(bindings).submit(fallback=False, cluster=cluster):
+        outcomes = map_in_context(lambda binding: user_definitions([binding]).apply_each(cluster), bindings,
+                                  current_app.config['BATCH_CONCURRENCY'])
+        created = []
+        for binding, (ok, result) in zip(bindings, outcomes):
+            if ok:
+                created.append(binding)
+            else:
+                current_app.logger.error('Credentials rotation failed for binding {} of instance {}: {}'.format(
+                    binding[1], binding[0], getattr(result, 'description', None) or result))
+    usernames = {}
+    for instance, app_host, username, _ in created:
+        usernames.setdefault(instance, {})[app_host] = username
+    store = get_store()
+    for instance, hosts in usernames.items():
+        store.add_bindings(instance, hosts)
+    return len(bindings) - len(created)
+
+
+@job_handler(ROTATE)
+def rotate_credentials():
+    """Create the users of the current SALT for every binding of the state store still using a previous salt"""
+    store = get_store()
+    store.reload()
+    credentials = get_credentials()
+    clusters = get_clusters()
+    total, pending = 0, []
+    for instance, bindings in sorted(store.bindings.items()):
+        app_hosts = sorted(bindings)
+        total += len(app_hosts)
+        for app_host, (username, password) in zip(app_hosts, credentials.derive_many(instance, app_hosts)):
+            if bindings[app_host] != username:
+                pending.append((instance, app_host, username, password))
+
+    rotated = total - len(pending)
+    report_progress(bindings=total, rotated=rotated, failed=0)
+    failed = run_batches(
+        create_users, batches(pending, lambda binding: clusters.locate(binding[0]),
+                              current_app.config['ROTATION_BATCH_SIZE']),
+        lambda done, failed: report_progress(bindings=total, rotated=rotated + done, failed=failed))
+    if failed:
+        raise RuntimeError('{} of {} bindings could not be rotated, run the rotation again'.format(failed, total))
+
+
+def delete_users(cluster, usernames):
+    send('post', 'users/bulk-delete', data=json.dumps({'users': usernames}), cluster=cluster)
+
+
+@job_handler(RETIRE)
+def retire_credentials():
+    """
+    Delete the users of the PREVIOUS_SALTS of every binding of the state store. Bindings which were not rotated yet
+    keep them, and are reported as skipped.
+    """
+    store = get_store()
+    store.reload()
+    credentials = get_credentials()
+    previous = previous_credentials()
+    clusters = get_clusters()
+    skipped, retired = 0, []
+    for instance, bindings in sorted(store.bindings.items()):
+        app_hosts = sorted(bindings)
+        for app_host, (username, _) in zip(app_hosts, credentials.derive_many(instance, app_hosts)):
+            if bindings[app_host] != username:
+                skipped += 1
+                continue
+            retired.extend((instance, old.derive(instance, app_host)[0]) for old in previous)
+
+    report_progress(users=len(retired), deleted=0, skipped=skipped, failed=0)
+    failed = run_batches(
+        lambda cluster, users: delete_users(cluster, [username for _, username in users]),
+        batches(retired, lambda user: clusters.locate(user[0]), current_app.config['ROTATION_BATCH_SIZE']),
+        lambda done, failed: report_progress(users=len(retired), deleted=done, skipped=skipped, failed=failed))
+    if failed:
+        raise RuntimeError('{} of {} users could not be deleted, run the retirement again'.format(
+            failed, len(retired)))
@@ -0,0 +1,180 @@
+from __future__ import unicode_literals
+
+import json
+import sqlite3
+import threading
+import time
+
+from .utils import app_extension
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    name TEXT PRIMARY KEY,
+    cluster TEXT,
+    plan TEXT,
+    created_at REAL
+);
+CREATE TABLE IF NOT EXISTS bindings (
+    instance TEXT,
+    app_host TEXT,
+    username TEXT,
+    created_at REAL,
+    PRIMARY KEY (instance, app_host)
+);
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    instance TEXT,
+    status_code INTEGER,
+    headers TEXT,
+    data BLOB,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS responses_instance ON responses (instance);
+CREATE TABLE IF NOT EXISTS tombstones (
+    kind TEXT,
+    name TEXT,
+    deleted_at REAL,
+    PRIMARY KEY (kind, name)
+);
+"""
+
+
+class StateStore(object):
+    """
+    Record of the instances and bindings created by the service.
+
+    Records are persisted in an SQLite database and mirrored by an in-memory index, loaded when the store is opened,
+    so lookups never need to list users or vhosts through the management API. Without a path the database lives in
+    memory, and the store only knows about what the current process did.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.persistent = path is not None
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path or ':memory:', check_same_thread=False, isolation_level=None)
+        if self.persistent:
+            # let readers in other worker processes go on while we write
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(SCHEMA)
+        self.reload()
+
+    def reload(self):
+        """Load the index from the database, picking up changes made by other processes"""
+        with self._lock:
+            self.instances = dict(
+                (name, {'cluster': cluster, 'plan': plan})
+                for name, cluster, plan in self._conn.execute('SELECT name, cluster, plan FROM instances')
+            )
+            self.bindings = {}
+            for instance, app_host, username in self._conn.execute(
+                    'SELECT instance, app_host, username FROM bindings'):
+                self.bindings.setdefault(instance, {})[app_host] = username
+
+    def add_instance(self, name, cluster=None, plan=None):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?)',
+                               (name, cluster, plan, time.time()))
+            self._conn.execute("DELETE FROM tombstones WHERE kind = 'vhost' AND name = ?", (name,))
+            self.instances[name] = {'cluster': cluster, 'plan': plan}
+
+    def _bury(self, kind, names):
+        self._conn.executemany('INSERT OR REPLACE INTO tombstones VALUES (?, ?, ?)',
+                               [(kind, name, time.time()) for name in names])
+
+    def remove_instance(self, name):
+        """Forget an instance and all of its bindings, keeping a tombstone of its vhost and users"""
+        with self._lock:
+            self._bury('vhost', [name])
+            self._bury('user', [username for username, in self._conn.execute(
+                'SELECT username FROM bindings WHERE instance = ?', (name,))])
+            self._conn.execute('DELETE FROM instances WHERE name = ?', (name,))
+            self._conn.execute('DELETE FROM bindings WHERE instance = ?', (name,))
+            self.instances.pop(name, None)
+            self.bindings.pop(name, None)
+
+    def instance(self, name, fresh=False):
+        """
+        The record of the instance named <name>, or None if there is none. With `fresh`, the database is read even
+        if the index knows the instance, which another worker may have deleted since the index was loaded.
+        """
+        record = self.instances.get(name)
+        if (record is None or fresh) and self.persistent:
+            # the instance may have been created by another worker since the index was loaded
+            with self._lock:
+                row = self._conn.execute('SELECT cluster, plan FROM instances WHERE name = ?', (name,)).fetchone()
+                record = None if row is None else {'cluster': row[0], 'plan': row[1]}
+                if record is not None:
+                    self.instances[name] = record
+        return record
+
+    def add_binding(self, instance, app_host, username):
+        self.add_bindings(instance, {app_host: username})
+
+    def add_bindings(self, instance, usernames):
+        """Record many bindings of `instance` at once, `usernames` maps each app host to its RabbitMQ user"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO bindings VALUES (?, ?, ?, ?)',
+                [(instance, app_host, username, now) for app_host, username in usernames.items()]
+            )
+            self._conn.executemany("DELETE FROM tombstones WHERE kind = 'user' AND name = ?",
+                                   [(username,) for username in usernames.values()])
+            self.bindings.setdefault(instance, {}).update(usernames)
+
+    def remove_binding(self, instance, app_host):
+        with self._lock:
+            self._bury('user', [username for username, in self._conn.execute(
+                'SELECT username FROM bindings WHERE instance = ? AND app_host = ?', (instance, app_host))])
+            self._conn.execute('DELETE FROM bindings WHERE instance = ? AND app_host = ?', (instance, app_host))
+            self.bindings.get(instance, {}).pop(app_host, None)
+
+    def deleted(self, kind):
+        """Names of the vhosts or users, by `kind`, of the instances and bindings which were removed"""
+        with self._lock:
+            return set(name for name, in self._conn.execute('SELECT name FROM tombstones WHERE kind = ?', (kind,)))
+
+    def bindings_of(self, instance):
+        """Map of the app hosts bound to `instance` to their RabbitMQ users"""
+        return dict(self.bindings.get(instance, {}))
+
+    def response(self, key):
+        """
+        The response recorded for the request <key>, as (data, status code, headers), or None if it expired. Data is
+        None for responses recorded without their body.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT data, status_code, headers FROM responses WHERE key = ? AND expires_at > ?', (key, time.time())
+            ).fetchone()
+        return row and (None if row[0] is None else bytes(row[0]), row[1], json.loads(row[2]))
+
+    def add_response(self, key, instance, data, status_code, headers, ttl):
+        """Record the response to the request <key> about `instance`, for `ttl` seconds, see `idempotency`"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('DELETE FROM responses WHERE expires_at <= ?', (now,))
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, instance, status_code, json.dumps(headers),
+                                None if data is None else sqlite3.Binary(data), now + ttl))
+
+    def remove_responses(self, instance):
+        with self._lock:
+            self._conn.execute('DELETE FROM responses WHERE instance = ?', (instance,))
+
+    def stats(self):
+        return {
+            'persistent': self.persistent,
+            'instances': len(self.instances),
+            'bindings': sum(len(bindings) for bindings in self.bindings.values()),
+        }
+
+    def close(self):
+        self._conn.close()
+
+
+def get_store():
+    """Return the state store of the current app"""
+    return app_extension('state_store', lambda app: StateStore(app.config['STATE_STORE_PATH']))
@@ -1,25 +1,53 @@
 from __future__ import unicode_literals
 
+import io
 import os
+import logging
+import re
+import shutil
+import runpy
 import json
 import unittest
 import base64
+import hashlib
+import hmac
 import tempfile
+import threading
+import time
+from collections import Counter
+from functools import partial
 from mock import patch
 
 import pep8
 import requests
 import responses
-from werkzeug.exceptions import InternalServerError
+from werkzeug.exceptions import InternalServerError, ServiceUnavailable
 
 
 from . import create_app
-from .api import log_request, ha_policy_name
-from .http_client import send
-from .auth import requires_auth
-from .utils import generate_username, generate_password
+from .api import log_request, ha_policy, ha_policy_name, full_permissions, create_instance, bind_host, unbind_host
+from .http_client import JSONStream, send, stream, stream_page, get_client, path_template, budget_of, node_url
+from .auth import Authenticator, requires_auth
+from .balancer import Balancer
+from .pipeline import Pipeline
+from .cache import TTLCache
+from .definitions import Definitions
+from .clusters import ClusterMap, Cluster, get_clusters
+from .store import StateStore, get_store
+from .reconciler import Reconciler
+from .resilience import CircuitBreaker, Bulkhead, TokenBucket, Unavailable, backoff_delays
+from .fake_rmq import FakeManagementAPI
+from .benchmark import Benchmark, percentile
+from .checks import AMQPCheck
+from .metrics import Metric, get_metrics
+from .idempotency import idempotency_cache
+from .plans import Plan, Plans, get_plans
+from .rotation import retire_credentials
+from .jobs import JobQueue, handlers as job_handlers, report_progress
+from .logs import AccessLog, RequestDump, ResponseDump, get_access_log, redact
+from .utils import Credentials, generate_username, generate_password, get_credentials
 
-from flask import Flask, Response
+from flask import Flask, Response, request as flask_request
 
 CONFIG = dict(
     USERNAME='foo',
@@ -44,6 +72,19 @@ class AppFactoryTest(unittest.TestCase):
             self.assertEqual(app1.config['FOO'], 1)
 
 
+class ServingTest(unittest.TestCase):
+    def test_gunicorn_config(self):
+        config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn_config.py')
+        with patch.dict(os.environ, {}, clear=True):
+            config = runpy.run_path(config_file)
+        self.assertEqual(config['worker_class'], 'sync')
+
+        with patch.dict(os.environ, {'RMQAPI_WORKER_CLASS': 'gevent', 'RMQAPI_WORKER_CONNECTIONS': '500'}):
+            config = runpy.run_path(config_file)
+        self.assertEqual(config['worker_class'], 'gevent')
+        self.assertEqual(config['worker_connections'], 500)
+
+
 class PEP8Test(unittest.TestCase):
     def test_pep8_conformance(self):
         """Test that we conform to PEP8."""
@@ -90,6 +131,31 @@ class AuthTest(unittest.TestCase):
             response = myview()
             self.assertEqual(response.status_code, 200)
 
+    def test_authenticator(self):
+        authenticator = Authenticator({'tsuru': 'old', 'tsuru2': 'new'}, cache_size=1)
+
+        def header(credentials, scheme='Basic'):
+            return '{} {}'.format(scheme, base64.b64encode(credentials.encode('utf-8')).decode('utf-8'))
+
+        self.assertTrue(authenticator.verify(header('tsuru:old')))
+        self.assertTrue(authenticator.verify(header('tsuru2:new')))
+        for invalid in (header('tsuru:new'), header('nobody:old'), header('tsuru'), header('tsuru:old', 'Digest'),
+                        'Basic %%%', '', None):
+            self.assertFalse(authenticator.verify(invalid))
+        self.assertEqual(list(authenticator._verified), [header('tsuru2:new')])
+
+        with patch.object(authenticator, 'check') as mocked_check:
+            self.assertTrue(authenticator.verify(header('tsuru2:new')))
+        self.assertEqual(mocked_check.call_count, 0)
+
+    def test_extra_credentials(self):
+        test_app = create_app()
+        test_app.config.from_mapping(CONFIG, EXTRA_CREDENTIALS={'rotated': 'secret'})
+        client = test_app.test_client()
+        for credentials, status_code in (('foo:bar', 200), ('rotated:secret', 200), ('rotated:bar', 401)):
+            headers = {'Authorization': 'Basic {}'.format(base64.b64encode(credentials.encode('utf-8')).decode())}
+            self.assertEqual(client.delete('/resources/foo/bind', headers=headers).status_code, status_code)
+
 
 class RequestDebuggingTest(unittest.TestCase):
     def test_requestdebugging(self):
@@ -108,6 +174,83 @@ class RequestDebuggingTest(unittest.TestCase):
 
         self.assertEqual(mocked_debug.call_count, 1)
 
+    def test_redaction(self):
+        with app.test_request_context('/resources', method='POST', data={'name': 'foo', 'password': 's3cret'},
+                                      headers={'Authorization': 'Basic Zm9vOmJhcg=='}):
+            dump = str(RequestDump(flask_request._get_current_object()))
+        self.assertIn('Authorization: [redacted]', dump)
+        self.assertIn('name=foo&password=[redacted]', dump)
+        self.assertNotIn('Zm9vOmJhcg==', dump)
+
+        response = Response(json.dumps({'RABBITMQ_PASSWORD': 's3cret'}), 201)
+        self.assertIn('{"RABBITMQ_PASSWORD": "[redacted]"}', str(ResponseDump(response)))
+        self.assertEqual(redact('user=foo&Password=bar'), 'user=foo&Password=[redacted]')
+
+    def test_lazy_formatting(self):
+        with patch.object(RequestDump, '__str__') as mocked_str:
+            with app.test_client() as client:
+                client.get('/resources/plans')
+        self.assertEqual(mocked_str.call_count, 0)
+
+
+class AccessLogTest(unittest.TestCase):
+    def access_log(self, **kwargs):
+        stream = io.StringIO()
+        access_log = AccessLog(logger=logging.getLogger('rabbitmqapi.tests.access'),
+                               handler=logging.StreamHandler(stream), **kwargs)
+        self.addCleanup(access_log.close)
+        return access_log, stream
+
+    def served(self, access_log, status=200):
+        with app.test_request_context('/resources/foo/status', headers={'Authorization': 'Basic Zm9vOmJhcg=='},
+                                      environ_base={'REMOTE_ADDR': '127.0.0.1'}):
+            access_log.log(flask_request, Response('', status), 0.0125)
+
+    def test_text(self):
+        access_log, stream = self.access_log()
+        self.served(access_log)
+        self.assertTrue(stream.getvalue().endswith(' 127.0.0.1 "GET /resources/foo/status" 200 0 12.5ms\n'))
+        self.assertNotIn('Zm9vOmJhcg==', stream.getvalue())
+
+    def test_json(self):
+        access_log, stream = self.access_log(json_format=True)
+        self.served(access_log, 201)
+        fields = json.loads(stream.getvalue())
+        self.assertEqual(fields['status'], 201)
+        self.assertEqual(fields['duration_ms'], 12.5)
+        self.assertEqual(fields['path'], '/resources/foo/status')
+        self.assertEqual(fields['level'], 'INFO')
+
+    def test_sampling(self):
+        access_log, stream = self.access_log(sample_rate=0)
+        self.served(access_log)
+        self.assertEqual(stream.getvalue(), '')
+        # errors are always logged
+        self.served(access_log, 500)
+        self.assertIn('" 500 ', stream.getvalue())
+
+    def test_queue(self):
+        access_log, stream = self.access_log(queue_size=1)
+        access_log.listener.stop()
+        for _ in range(3):
+            self.served(access_log)
+        self.assertEqual(access_log.dropped, 2)
+        access_log.listener.start()
+        access_log.close()
+        self.assertEqual(stream.getvalue().count('\n'), 1)
+
+    def test_app(self):
+        test_app = create_app()
+        test_app.config.from_mapping(CONFIG, ACCESS_LOG=True)
+        with patch.object(AccessLog, 'log') as mocked_log:
+            test_app.test_client().get('/resources/plans')
+        self.assertEqual(mocked_log.call_count, 1)
+        request, response, duration = mocked_log.call_args[0]
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(duration, 0)
+        with test_app.app_context():
+            get_access_log().close()
+
 
 class HTTPTest(unittest.TestCase):
     def setUp(self):
@@ -115,6 +258,10 @@ class HTTPTest(unittest.TestCase):
             host=app.config['RMQ_HOST'],
             port=app.config['RMQ_MGMT_PORT']
         )
+        # the same requests are sent again with different RabbitMQ responses, they must not be replayed
+        idempotency = patch.dict(app.config, IDEMPOTENCY_TTL=0)
+        idempotency.start()
+        self.addCleanup(idempotency.stop)
 
     @responses.activate
     def test_send(self):
@@ -152,8 +299,1469 @@ class HTTPTest(unittest.TestCase):
             response = send('get', 'foo4', raise_for_status=False)
             self.assertEqual(response.status_code, 400)
 
+    def test_json_stream(self):
+        def chunks(text, size):
+            return [text[start:start + size] for start in range(0, len(text), size)]
+
+        items = [{'name': 'a [\\"quoted\\"] {name}', 'messages': 12345, 'rate': -1.5e3},
+                 [], {}, None, True, 'text', 67890]
+        for size in (1, 2, 7, 4096):
+            self.assertEqual(list(JSONStream(chunks(json.dumps(items), size))), items)
+            page = JSONStream(chunks(json.dumps({'page': 2, 'items': items, 'page_count': 12}), size))
+            self.assertEqual(list(page), items)
+            self.assertEqual((page.page_count, page.fields['page']), (12, 2))
+
+        self.assertEqual(list(JSONStream([' [ ] '])), [])
+        # numbers split right after their dot or exponent
+        self.assertEqual(list(JSONStream(['[1.', '5, 2e', '+3, -', '4]'])), [1.5, 2e3, -4])
+        self.assertEqual(list(JSONStream(['{}'])), [])
+        # plain arrays are a single page
+        self.assertEqual(JSONStream(['[]']).page_count, 1)
+        for malformed in ('[1, 2', '[1 2]', '{"items": [1]', '', '[{"a": 1]'):
+            with self.assertRaises(ValueError):
+                list(JSONStream(chunks(malformed, 3)))
+
+    @responses.activate
+    def test_stream(self):
+        with app.app_context():
+            items = [{'name': 'caf\u00e9 \u2603'}] * 3
+            responses.add(responses.GET, '{}/queues'.format(self.rmq_base_url),
+                          body=json.dumps(items, ensure_ascii=False).encode('utf-8'), status=200)
+            # multi-byte characters split across chunks are decoded
+            self.assertEqual(list(stream('queues', chunk_size=1)), items)
+
+            responses.add(responses.GET, '{}/vhosts'.format(self.rmq_base_url), status=200,
+                          json={'items': [{'name': 'foo'}], 'page_count': 3})
+            items = stream_page('vhosts', 1, 1, ('name',))
+            self.assertEqual((list(items), items.page_count), ([{'name': 'foo'}], 3))
+            self.assertEqual(responses.calls[-1].request.url,
+                             '{}/vhosts?page=1&page_size=1&columns=name'.format(self.rmq_base_url))
+
+    @responses.activate
+    def test_client_pool(self):
+        with app.app_context():
+            client = get_client()
+            # the client is built once per app and process, along with its base url and auth
+            self.assertIs(get_client(), client)
+            self.assertEqual(client.base_url, '{}/'.format(self.rmq_base_url))
+            self.assertEqual(client.session.auth, (app.config['RMQ_USER'], app.config['RMQ_PASSWORD']))
+            self.assertEqual(client.timeout, (app.config['RMQ_CONNECT_TIMEOUT'], app.config['RMQ_READ_TIMEOUT']))
+
+            responses.add(responses.GET, '{}/foo1'.format(self.rmq_base_url), status=200)
+            send('get', 'foo1')
+            self.assertEqual(responses.calls[0].request.headers['Content-Type'], 'application/json')
+            self.assertTrue(responses.calls[0].request.headers['Authorization'].startswith('Basic '))
+
+            #
+            # A forked worker must not reuse the connection pool of its parent
+            #
+            with patch('os.getpid', return_value=client.pid + 1):
+                forked_client = get_client()
+            self.assertIsNot(forked_client, client)
+
+
+class PipelineTest(unittest.TestCase):
+    def test_concurrent_steps(self):
+        first_started, second_started = threading.Event(), threading.Event()
+
+        def first():
+            first_started.set()
+            return second_started.wait(5)
+
+        def second():
+            second_started.set()
+            return first_started.wait(5)
+
+        with app.app_context():
+            pipeline = Pipeline()
+            pipeline.add('root', lambda: 'root')
+            pipeline.add('first', first, requires=['root'])
+            pipeline.add('second', second, requires=['root'])
+            # both steps only succeed if they run at the same time
+            self.assertEqual(pipeline.run(), {'root': 'root', 'first': True, 'second': True})
+
+    def test_rollback(self):
+        calls = []
+
+        def fail():
+            raise ValueError('failed')
+
+        with app.app_context():
+            pipeline = Pipeline()
+            pipeline.add('a', lambda: calls.append('a'), rollback=lambda: calls.append('undo a'))
+            pipeline.add('b', lambda: calls.append('b'), requires=['a'], rollback=lambda: calls.append('undo b'))
+            pipeline.add('c', fail, requires=['b'], rollback=lambda: calls.append('undo c'))
+            pipeline.add('d', lambda: calls.append('d'), requires=['c'])
+            with self.assertRaises(ValueError):
+                pipeline.run()
+        self.assertEqual(calls, ['a', 'b', 'undo b', 'undo a'])
+
+    def test_unsatisfiable(self):
+        with app.app_context():
+            pipeline = Pipeline()
+            pipeline.add('a', lambda: None, requires=['b'])
+            pipeline.add('b', lambda: None, requires=['a'])
+            with self.assertRaises(ValueError):
+                pipeline.run()
+
+
+class CacheTest(unittest.TestCase):
+    def test_ttl(self):
+        cache = TTLCache(maxsize=2, ttl=10, negative_ttl=1)
+        with patch('rabbitmqapi.cache.clock', return_value=100):
+            self.assertEqual(cache.get_or_compute('a', lambda: 'a1'), 'a1')
+            self.assertEqual(cache.get_or_compute('a', lambda: 'a2'), 'a1')
+            self.assertEqual(cache.get_or_compute('b', lambda: 'ko', is_negative=lambda v: v == 'ko'), 'ko')
+
+        # negative results expire sooner
+        with patch('rabbitmqapi.cache.clock', return_value=105):
+            self.assertEqual(cache.get_or_compute('a', lambda: 'a2'), 'a1')
+            self.assertEqual(cache.get_or_compute('b', lambda: 'ok'), 'ok')
+
+        with patch('rabbitmqapi.cache.clock', return_value=111):
+            self.assertEqual(cache.get_or_compute('a', lambda: 'a3'), 'a3')
+
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 4, 'coalesced': 0, 'size': 2, 'maxsize': 2})
+
+    def test_lru(self):
+        cache = TTLCache(maxsize=2, ttl=10)
+        cache.get_or_compute('a', lambda: 1)
+        cache.get_or_compute('b', lambda: 2)
+        cache.get_or_compute('a', lambda: 1)
+        cache.get_or_compute('c', lambda: 3)
+        # `b` was the least recently used key
+        self.assertEqual(cache.get_or_compute('a', lambda: None), 1)
+        self.assertEqual(cache.get_or_compute('b', lambda: None), None)
+
+    def test_errors(self):
+        cache = TTLCache()
+
+        def fail():
+            raise ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            cache.get_or_compute('a', fail)
+        self.assertEqual(cache.get_or_compute('a', lambda: 1), 1)
+
+        # like the GreenletExit of a killed gevent worker
+        def interrupted():
+            raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            cache.get_or_compute('b', interrupted)
+        self.assertEqual(cache.get_or_compute('b', lambda: 2), 2)
+
+    def test_coalescing(self):
+        cache = TTLCache()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'value'
+
+        leader = threading.Thread(target=lambda: results.append(cache.get_or_compute('a', slow)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(cache.get_or_compute('a', slow)))
+                     for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        while cache.coalesced < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 4)
+
+
+class CredentialsTest(unittest.TestCase):
+    hosts = ['host1', 'a-very-long-application-host.example.com', 'h\xf4te', '']
+
+    def reference(self, salt, instance_name, app_host):
+        hm = hmac.new(salt.encode('utf-8'), digestmod=hashlib.sha1)
+        hm.update(instance_name.encode('utf-8'))
+        hm.update(app_host.encode('utf-8'))
+        password = hm.hexdigest()
+        return '{}_{}_{}'.format(instance_name[:20], app_host[:20], password[:10]), password
+
+    def test_derive(self):
+        credentials = Credentials('foooosalt')
+        for instance_name in ('foobar', 'an-instance-with-a-long-name'):
+            for app_host in self.hosts:
+                expected = self.reference('foooosalt', instance_name, app_host)
+                self.assertEqual(credentials.derive(instance_name, app_host), expected)
+                # memoized
+                self.assertEqual(credentials.derive(instance_name, app_host), expected)
+            self.assertEqual(credentials.derive_many(instance_name, self.hosts),
+                             [self.reference('foooosalt', instance_name, app_host) for app_host in self.hosts])
+
+    def test_lru(self):
+        credentials = Credentials('foooosalt', maxsize=2)
+        credentials.derive_many('foobar', ['host1', 'host2'])
+        credentials.derive('foobar', 'host1')
+        credentials.derive('foobar', 'host3')
+        self.assertEqual(list(credentials._memo), [('foobar', 'host1'), ('foobar', 'host3')])
+
+    def test_app(self):
+        with app.app_context():
+            self.assertIs(get_credentials(), get_credentials('foooosalt'))
+            self.assertEqual(get_credentials('othersalt').derive('foobar', 'host1'),
+                             self.reference('othersalt', 'foobar', 'host1'))
+            self.assertEqual((generate_username('foobar', 'host1'), generate_password('foobar', 'host1')),
+                             self.reference('foooosalt', 'foobar', 'host1'))
+
+
+class DefinitionsTest(unittest.TestCase):
+    def setUp(self):
+        self.rmq_base_url = 'http://{host}:{port}/api'.format(
+            host=app.config['RMQ_HOST'],
+            port=app.config['RMQ_MGMT_PORT']
+        )
+        # the same requests are sent again with different RabbitMQ responses, they must not be replayed
+        idempotency = patch.dict(app.config, IDEMPOTENCY_TTL=0)
+        idempotency.start()
+        self.addCleanup(idempotency.stop)
+        self.definitions = Definitions()
+        self.definitions.add_vhost('foobar')
+        self.definitions.add_user('user', 'password')
+        self.definitions.add_permission('foobar', 'user', full_permissions)
+        self.definitions.add_policy(dict(ha_policy, vhost='foobar'))
+
+    def test_document(self):
+        document = self.definitions.document()
+        self.assertEqual(len(self.definitions), 4)
+        self.assertEqual(document['vhosts'], [{'name': 'foobar'}])
+        self.assertEqual(document['users'], [{'name': 'user', 'password': 'password', 'tags': ''}])
+        self.assertEqual(document['permissions'],
+                         [{'vhost': 'foobar', 'user': 'user', 'configure': '.*', 'write': '.*', 'read': '.*'}])
+        self.assertEqual(document['policies'][0]['vhost'], 'foobar')
+
+    @responses.activate
+    def test_submit(self):
+        responses.add(responses.POST, '{}/definitions'.format(self.rmq_base_url), status=204)
+        with app.app_context():
+            self.assertTrue(self.definitions.submit())
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(json.loads(responses.calls[0].request.body), self.definitions.document())
+
+    @responses.activate
+    def test_submit_fallback(self):
+        responses.add(responses.POST, '{}/definitions'.format(self.rmq_base_url), status=400)
+        urls = ['vhosts/foobar', 'users/user', 'permissions/foobar/user',
+                'policies/foobar/{}'.format(ha_policy_name)]
+        for url in urls:
+            responses.add(responses.PUT, '{}/{}'.format(self.rmq_base_url, url), status=204)
+
+        with app.app_context():
+            self.assertFalse(self.definitions.submit(fallback=False))
+            self.assertEqual(len(responses.calls), 1)
+            self.assertFalse(self.definitions.submit())
+        self.assertEqual(len(responses.calls), 6)
+        # vhosts and users are created before permissions and policies
+        self.assertEqual(set(call.request.url for call in responses.calls[2:4]),
+                         set('{}/{}'.format(self.rmq_base_url, url) for url in urls[:2]))
+        self.assertEqual(set(call.request.url for call in responses.calls[4:]),
+                         set('{}/{}'.format(self.rmq_base_url, url) for url in urls[2:]))
+
+
+class ClustersTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+        self.app.config.from_mapping(CONFIG, RMQ_CLUSTERS=[
+            {'name': 'one', 'host': 'one.example.com', 'plans': ['small']},
+            {'name': 'two', 'host': 'two.example.com', 'port': 5673},
+        ])
+        self.client = self.app.test_client()
+        self.auth_headers = ApiTest.auth_headers
+
+    def test_single_cluster(self):
+        with app.app_context():
+            clusters = get_clusters()
+            self.assertEqual(len(clusters.clusters), 1)
+            self.assertEqual(clusters.place('foobar').host, app.config['RMQ_HOST'])
+            self.assertEqual(clusters.locate('foobar').host, app.config['RMQ_HOST'])
+
+    def test_hash_placement(self):
+        with self.app.app_context():
+            clusters = get_clusters()
+            placed = [clusters.place('instance{}'.format(i)).name for i in range(200)]
+        self.assertEqual(placed, [clusters.place('instance{}'.format(i)).name for i in range(200)])
+        self.assertTrue(placed.count('one') > 50 and placed.count('two') > 50)
+
+        # removing a cluster only moves the instances it held
+        one = ClusterMap([clusters.clusters[0]])
+        for i, name in enumerate(placed):
+            if name == 'one':
+                self.assertEqual(one.hashed('instance{}'.format(i)).name, 'one')
+
+    def test_plan_placement(self):
+        with patch.dict(self.app.config, CLUSTER_PLACEMENT='plan'), self.app.app_context():
+            clusters = get_clusters()
+            for i in range(20):
+                self.assertEqual(clusters.place('instance{}'.format(i), 'small').name, 'one')
+
+    def test_placement_plans(self):
+        self.assertEqual(self.client.post('/resources', data={'name': 'foobar', 'plan': 'small'},
+                                          headers=self.auth_headers).status_code, 400)
+        placement_app = create_app()
+        placement_app.config.from_mapping(self.app.config, CLUSTER_PLACEMENT='plan')
+        with placement_app.app_context():
+            self.assertIs(get_plans().get('small'), get_plans().legacy)
+            self.assertRaises(KeyError, get_plans().get, 'big')
+
+    @responses.activate
+    def test_least_loaded_placement(self):
+        responses.add(responses.GET, 'http://one.example.com:15672/api/overview',
+                      body=json.dumps({'object_totals': {'connections': 10, 'queues': 1}}))
+        responses.add(responses.GET, 'http://two.example.com:15672/api/overview',
+                      body=json.dumps({'object_totals': {'connections': 5, 'queues': 1}}))
+        with patch.dict(self.app.config, CLUSTER_PLACEMENT='least-loaded'), self.app.app_context():
+            clusters = get_clusters()
+            self.assertEqual(clusters.place('foobar').name, 'two')
+            self.assertEqual(clusters.place('foobar2').name, 'two')
+        # loads are cached
+        self.assertEqual(len(responses.calls), 2)
+
+    def test_unknown_placement(self):
+        with self.assertRaises(ValueError):
+            ClusterMap([Cluster.from_config(CONFIG)], placement='random')
+
+    def test_store_routing(self):
+        with self.app.app_context():
+            get_store().add_instance('foobar', 'two')
+            # no call to the clusters is needed to locate the instance
+            self.assertEqual(get_clusters().locate('foobar').name, 'two')
+
+    @responses.activate
+    def test_routing(self):
+        responses.add(responses.GET, 'http://one.example.com:15672/api/vhosts/foobar', status=404)
+        responses.add(responses.GET, 'http://two.example.com:15672/api/vhosts/foobar', status=200)
+        for host in ('one', 'two'):
+            responses.add(responses.PUT, re.compile('http://{}.example.com:15672/api/.*'.format(host)), status=200)
+
+        with self.app.app_context():
+            hashed = get_clusters().hashed('foobar')
+            username = generate_username('foobar', 'domain.example.com')
+
+        response = self.client.post('/resources/foobar/bind-app', headers=self.auth_headers,
+                                    data={'app-host': 'domain.example.com'})
+        self.assertEqual(response.status_code, 201)
+        data = json.loads(response.get_data(as_text=True))
+        self.assertEqual(data['RABBITMQ_HOST'], 'two.example.com')
+        self.assertEqual(data['RABBITMQ_PORT'], '5673')
+        self.assertEqual(responses.calls[-1].request.url,
+                         'http://two.example.com:15672/api/permissions/foobar/{}'.format(username))
+
+        # the cluster of the instance is remembered
+        calls = len(responses.calls)
+        response = self.client.post('/resources/foobar/bind-app', headers=self.auth_headers,
+                                    data={'app-host': 'other.example.com'})
+        self.assertEqual(len(responses.calls), calls + 2)
+
+        # new instances go to the cluster they are placed in
+        response = self.client.post('/resources', headers=self.auth_headers, data={'name': 'foobar'})
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(responses.calls[-1].request.url.startswith('http://{}'.format(hashed.host)))
+
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'state.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_store(self):
+        store = StateStore(self.path)
+        store.add_instance('foobar', 'default', 'small')
+        store.add_bindings('foobar', {'host1': 'user1', 'host2': 'user2'})
+        store.remove_binding('foobar', 'host2')
+        self.assertEqual(store.instance('foobar'), {'cluster': 'default', 'plan': 'small'})
+        self.assertEqual(store.bindings_of('foobar'), {'host1': 'user1'})
+
+        # records survive restarts, and are seen by other processes
+        other = StateStore(self.path)
+        self.assertEqual(other.bindings_of('foobar'), {'host1': 'user1'})
+        store.add_instance('foobar2')
+        self.assertEqual(other.instance('foobar2'), {'cluster': None, 'plan': None})
+
+        store.remove_instance('foobar')
+        self.assertEqual(store.instance('foobar'), None)
+        self.assertEqual(store.bindings_of('foobar'), {})
+        self.assertEqual(StateStore(self.path).stats(), {'persistent': True, 'instances': 1, 'bindings': 0})
+
+    def test_memory_store(self):
+        store = StateStore()
+        store.add_instance('foobar')
+        self.assertFalse(store.persistent)
+        self.assertEqual(store.instance('foobar'), {'cluster': None, 'plan': None})
+
+    @responses.activate
+    def test_api_records(self):
+        responses.add(responses.PUT, re.compile('.*'), status=200)
+        responses.add(responses.DELETE, re.compile('.*'), status=200)
+        responses.add(responses.GET, re.compile('.*'), status=200, json=[])
+        custom_app = create_app()
+        custom_app.config.from_mapping(CONFIG, STATE_STORE_PATH=self.path,
+                                       PLANS=[{'name': 'small', 'description': 'Small'}])
+        client = custom_app.test_client()
+
+        client.post('/resources', headers=ApiTest.auth_headers, data={'name': 'foobar', 'plan': 'small'})
+        client.post('/resources/foobar/bind-app', headers=ApiTest.auth_headers, data={'app-host': 'host1'})
+        with custom_app.app_context():
+            store = get_store()
+            self.assertEqual(store.instance('foobar'), {'cluster': 'default', 'plan': 'small'})
+            self.assertEqual(store.bindings_of('foobar'), {'host1': generate_username('foobar', 'host1')})
+
+        client.delete('/resources/foobar/bind-app', headers=ApiTest.auth_headers, data={'app-host': 'host1'})
+        self.assertEqual(store.bindings_of('foobar'), {})
+        client.delete('/resources/foobar', headers=ApiTest.auth_headers)
+        self.assertEqual(store.instance('foobar'), None)
+        store.close()
+
+
+class ReconcilerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = create_app()
+        self.app.config.from_mapping(
+            CONFIG, STATE_STORE_PATH=os.path.join(self.tmpdir, 'state.db'),
+            RECONCILE_PAGE_SIZE=1, RECONCILE_PAGES_PER_CYCLE=1, RECONCILE_BATCH_INTERVAL=0,
+        )
+        self.rmq_base_url = 'http://{host}:{port}/api'.format(
+            host=CONFIG['RMQ_HOST'],
+            port=CONFIG['RMQ_MGMT_PORT']
+        )
+        with self.app.app_context():
+            store = get_store()
+            store.add_instance('foobar', 'default')
+            store.add_binding('foobar', 'host1', generate_username('foobar', 'host1'))
+            self.username = generate_username('foobar', 'host1')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def add_listing(self, kind, items):
+        """Serve `items` paginated, like RabbitMQ does"""
+        def callback(request):
+            page = int(re.search(r'page=(\d+)', request.url).group(1))
+            page_size = int(re.search(r'page_size=(\d+)', request.url).group(1))
+            return 200, {}, json.dumps({
+                'items': items[(page - 1) * page_size:page * page_size],
+                'page_count': (len(items) + page_size - 1) // page_size,
+            })
+        responses.add_callback(responses.GET, re.compile(r'{}/{}\?'.format(self.rmq_base_url, kind)), callback)
+
+    @responses.activate
+    def test_reconcile(self):
+        self.add_listing('vhosts', [{'name': '/'}, {'name': 'foobar'}])
+        self.add_listing('users', [{'name': CONFIG['RMQ_USER']}, {'name': 'other'}])
+        self.add_listing('permissions', [{'vhost': 'foobar', 'user': CONFIG['RMQ_USER']}])
+        self.add_listing('policies', [])
+        responses.add(responses.PUT, re.compile('.*'), status=204)
+
+        reconciler = Reconciler(self.app)
+        # listings of two pages, like users, are only compared in the second cycle
+        self.assertEqual(reconciler.run_once(), 2)
+        fixes = set(call.request.url for call in responses.calls if call.request.method == 'PUT')
+        self.assertEqual(fixes, set([
+            '{}/permissions/foobar/{}'.format(self.rmq_base_url, self.username),
+            '{}/policies/foobar/{}'.format(self.rmq_base_url, ha_policy_name),
+        ]))
+
+        reconciler.run_once()
+        fixes = set(call.request.url for call in responses.calls if call.request.method == 'PUT')
+        self.assertIn('{}/users/{}'.format(self.rmq_base_url, self.username), fixes)
+        self.assertEqual(len(fixes), 3)
+
+    @responses.activate
+    def test_deleted_instance(self):
+        other_worker = StateStore(os.path.join(self.tmpdir, 'state.db'))
+        self.addCleanup(other_worker.close)
+
+        def callback(request):
+            # deleted by another worker while the listings are walked
+            other_worker.remove_instance('foobar')
+            return 200, {}, json.dumps({'items': [{'name': '/'}], 'page_count': 1})
+        responses.add_callback(responses.GET, re.compile(r'{}/vhosts\?'.format(self.rmq_base_url)), callback)
+        for kind in ('users', 'permissions', 'policies'):
+            self.add_listing(kind, [])
+        responses.add(responses.PUT, re.compile('.*'), status=204)
+
+        Reconciler(self.app).run_once()
+        self.assertEqual([call.request.url for call in responses.calls if call.request.method == 'PUT'], [])
+
+    @responses.activate
+    def test_orphans(self):
+        with self.app.app_context():
+            orphan = generate_username('orphan', 'host1')
+            store = get_store()
+            store.add_instance('orphan', 'default')
+            store.add_binding('orphan', 'host1', orphan)
+            store.remove_instance('orphan')
+        # objects the store has no record of, e.g. created before it was set up, are left alone
+        self.add_listing('vhosts', [{'name': 'foobar'}, {'name': 'orphan'}, {'name': 'legacy'}])
+        self.add_listing('users', [{'name': self.username}, {'name': orphan}, {'name': 'other_host_0123456789'}])
+        self.add_listing('permissions', [{'vhost': 'foobar', 'user': CONFIG['RMQ_USER']},
+                                         {'vhost': 'foobar', 'user': self.username}])
+        self.add_listing('policies', [{'vhost': 'foobar', 'name': ha_policy_name}])
+        responses.add(responses.DELETE, re.compile('.*'), status=204)
+
+        with patch.dict(self.app.config, RECONCILE_PAGE_SIZE=10, RECONCILE_DELETE_ORPHANS=True):
+            reconciler = Reconciler(self.app)
+            # orphans must show up twice before being deleted
+            self.assertEqual(reconciler.run_once(), 0)
+            self.assertEqual(reconciler.run_once(), 2)
+        deleted = sorted(call.request.url for call in responses.calls if call.request.method == 'DELETE')
+        self.assertEqual(deleted, ['{}/users/{}'.format(self.rmq_base_url, orphan),
+                                   '{}/vhosts/orphan'.format(self.rmq_base_url)])
+
+    def test_start(self):
+        app_without_store = create_app()
+        app_without_store.config.from_mapping(CONFIG)
+        self.assertFalse(Reconciler(app_without_store).start())
+
+
+class ResilienceTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+        self.app.config.from_mapping(CONFIG, RMQ_RETRY_BACKOFF=0, RMQ_BREAKER_THRESHOLD=2)
+        self.rmq_base_url = 'http://{host}:{port}/api'.format(
+            host=CONFIG['RMQ_HOST'],
+            port=CONFIG['RMQ_MGMT_PORT']
+        )
+
+    @responses.activate
+    def test_retries(self):
+        responses.add(responses.GET, '{}/foo'.format(self.rmq_base_url), status=503)
+        responses.add(responses.GET, '{}/foo'.format(self.rmq_base_url), status=200)
+        responses.add(responses.POST, '{}/foo'.format(self.rmq_base_url), status=503)
+        with self.app.app_context():
+            self.assertEqual(send('get', 'foo').status_code, 200)
+            self.assertEqual(len(responses.calls), 2)
+
+            # non idempotent calls are never retried
+            self.assertEqual(send('post', 'foo', raise_for_status=False).status_code, 503)
+            self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    def test_circuit_breaker(self):
+        def callback(request):
+            raise requests.ConnectionError('Connection refused')
+        responses.add_callback(responses.GET, '{}/foo'.format(self.rmq_base_url), callback=callback)
+
+        with self.app.app_context():
+            for _ in range(2):
+                with self.assertRaises(InternalServerError):
+                    send('get', 'foo')
+            calls = len(responses.calls)
+            self.assertEqual(calls, 2 * (1 + self.app.config['RMQ_RETRIES']))
+
+            # the circuit is open, calls fail fast
+            with self.assertRaises(ServiceUnavailable):
+                send('get', 'foo')
+            self.assertEqual(len(responses.calls), calls)
+            self.assertEqual(get_client().breaker.state, 'open')
+
+    @responses.activate
+    def test_breaker_trial_rejected(self):
+        responses.add(responses.GET, '{}/foo'.format(self.rmq_base_url), status=200)
+        with self.app.app_context():
+            client = get_client()
+            client.breaker.failed()
+            client.breaker.failed()
+            client.breaker.opened_at -= client.breaker.reset_timeout
+            client.bulkhead = Bulkhead(1, 0.01)
+            with client.bulkhead:
+                with self.assertRaises(ServiceUnavailable):
+                    send('get', 'foo')
+            # the trial call never went out, so the next call gets it
+            self.assertEqual(client.breaker.state, 'half-open')
+            self.assertEqual(send('get', 'foo').status_code, 200)
+            self.assertEqual(client.breaker.state, 'closed')
+
+    def test_breaker_states(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=10)
+        with patch('rabbitmqapi.resilience.clock', return_value=100):
+            breaker.failed()
+            self.assertFalse(breaker.allow())
+        with patch('rabbitmqapi.resilience.clock', return_value=111):
+            # a single trial call goes out once the reset timeout is over
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+            breaker.failed()
+            self.assertEqual(breaker.state, 'open')
+        with patch('rabbitmqapi.resilience.clock', return_value=122):
+            self.assertTrue(breaker.allow())
+            breaker.succeeded()
+            self.assertEqual(breaker.state, 'closed')
+            self.assertTrue(breaker.allow())
+
+    def test_bulkhead(self):
+        bulkhead = Bulkhead(1, 0.01)
+        with bulkhead:
+            with self.assertRaises(Unavailable):
+                with bulkhead:
+                    pass
+        with bulkhead:
+            pass
+
+        # a call waits for a slot to be freed, within the timeout
+        bulkhead, entered = Bulkhead(1, 5), threading.Event()
+        bulkhead.__enter__()
+        waiter = threading.Thread(target=lambda: bulkhead.__enter__() and entered.set())
+        waiter.start()
+        self.assertFalse(entered.wait(0.05))
+        bulkhead.__exit__()
+        waiter.join()
+        self.assertTrue(entered.is_set())
+        self.assertEqual(bulkhead.running, 1)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        with patch('rabbitmqapi.resilience.time.time', return_value=1000):
+            bucket._updated = 1000
+            self.assertEqual([bucket.take(), bucket.take()], [0, 0])
+            self.assertAlmostEqual(bucket.take(), 0.1)
+        with patch('rabbitmqapi.resilience.time.time', return_value=1000.1):
+            self.assertEqual(bucket.take(), 0)
+            self.assertFalse(bucket.acquire(timeout=0.01))
+
+    def test_shared_bucket(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'writes.bucket')
+        bucket1, bucket2 = TokenBucket(rate=0.01, burst=3, path=path), TokenBucket(rate=0.01, burst=3, path=path)
+        self.assertEqual([bucket1.take(), bucket2.take(), bucket1.take()], [0, 0, 0])
+        self.assertGreater(bucket2.take(), 0)
+
+    def test_budgets(self):
+        self.assertEqual(budget_of('put', 'vhosts/foo'), 'writes')
+        self.assertEqual(budget_of('post', 'definitions'), 'writes')
+        self.assertEqual(budget_of('get', 'aliveness-test/foo'), 'expensive')
+        self.assertEqual(budget_of('get', 'vhosts?page=1'), 'expensive')
+        self.assertEqual(budget_of('get', 'permissions/foo'), 'expensive')
+        self.assertEqual(budget_of('get', 'vhosts/foo'), 'reads')
+
+    def test_rate_limit(self):
+        fake = FakeManagementAPI()
+        self.app.config.update(RMQ_ADAPTER=fake, RATE_LIMIT_EXPENSIVE=0.01, RATE_LIMIT_EXPENSIVE_BURST=1,
+                               RATE_LIMIT_TIMEOUT=0)
+        with self.app.app_context():
+            send('put', 'vhosts/foo')
+            send('put', 'vhosts/bar')
+            send('get', 'aliveness-test/foo')
+            with self.assertRaises(ServiceUnavailable):
+                send('get', 'aliveness-test/bar')
+            # other budgets are not limited
+            send('get', 'vhosts/foo')
+            send('delete', 'vhosts/foo')
+        self.assertEqual(fake.calls['GET', 'aliveness-test/{vhost}'], 1)
+
+    def test_backoff(self):
+        delays = list(backoff_delays(5, 0.1, 0.5))
+        self.assertEqual(len(delays), 5)
+        for attempt, delay in enumerate(delays):
+            self.assertTrue(0 <= delay <= min(0.5, 0.1 * 2 ** attempt))
+
+
+class BalancerTest(unittest.TestCase):
+    auth_headers = {'Authorization': 'Basic {}'.format(base64.b64encode(b'foo:bar').decode('utf-8'))}
+
+    def test_least_outstanding(self):
+        balancer = Balancer(['a', 'b', 'c'])
+        picked = [balancer.pick() for _ in range(4)]
+        self.assertEqual(len(set(node.base_url for node in picked[:3])), 3)
+        for node in picked:
+            balancer.release(node, 0.01)
+        # equally busy nodes take turns
+        self.assertEqual(len(set(balancer.pick().base_url for _ in range(3))), 3)
+        self.assertEqual(balancer.pick(avoid=balancer.nodes[0]).outstanding, 2)
+
+    def test_latency(self):
+        balancer = Balancer(['fast', 'slow'], strategy='latency')
+        for node, latency in zip(balancer.nodes, (0.01, 1)):
+            node.outstanding += 1
+            balancer.release(node, latency)
+        self.assertEqual([node.latency for node in balancer.nodes], [0.01, 1])
+        picks = Counter()
+        for _ in range(1000):
+            node = balancer.pick()
+            picks[node.base_url] += 1
+            balancer.release(node, node.latency)
+        self.assertGreater(picks['fast'], 900)
+        self.assertRaises(ValueError, Balancer, ['a'], strategy='random')
+
+    def test_ejection(self):
+        healthy = threading.Event()
+        balancer = Balancer(['a', 'b'], eject_threshold=2, probe=lambda node: healthy.is_set(), probe_interval=0.01)
+        node_a = balancer.nodes[0]
+        for _ in range(2):
+            balancer.pick()
+            balancer.release(node_a, 1, failed=True)
+        self.assertTrue(node_a.ejected)
+        self.assertEqual(set(balancer.pick().base_url for _ in range(4)), set(['b']))
+
+        healthy.set()
+        for _ in range(100):
+            if not node_a.ejected:
+                break
+            time.sleep(0.01)
+        self.assertFalse(node_a.ejected)
+
+    def test_node_url(self):
+        self.assertEqual(node_url('http', 'node1', 15672), 'http://node1:15672/api/')
+        self.assertEqual(node_url('https', 'node2:15673', 15672), 'https://node2:15673/api/')
+
+    def test_nodes(self):
+        fake = FakeManagementAPI()
+        fake.join('node2.example.com:15673', 'example.com:15672')
+        custom_app = create_app()
+        custom_app.config.from_mapping(CONFIG, RMQ_ADAPTER=fake, RMQ_RETRY_BACKOFF=0, RMQ_MGMT_PROBE_INTERVAL=60,
+                                       RMQ_MGMT_HOSTS=['example.com', 'node2.example.com:15673'])
+        client = custom_app.test_client()
+        self.assertEqual(client.post('/resources', data={'name': 'foo'}, headers=self.auth_headers).status_code, 201)
+        self.assertEqual(set(fake.node_calls), set(['example.com:15672', 'node2.example.com:15673']))
+
+        # units still connect to RMQ_HOST
+        response = client.post('/resources/foo/bind-app', data={'app-host': 'unit'}, headers=self.auth_headers)
+        self.assertEqual(json.loads(response.data.decode('utf-8'))['RABBITMQ_HOST'], 'example.com')
+
+        # a node going down is retried on the other one, and then ejected
+        fake.down.add('node2.example.com:15673')
+        for number in range(4):
+            self.assertEqual(client.post('/resources/foo/bind-app', data={'app-host': 'unit{}'.format(number)},
+                                         headers=self.auth_headers).status_code, 201)
+        with custom_app.app_context():
+            nodes = get_client().balancer.stats()
+        self.assertTrue(nodes['http://node2.example.com:15673/api/']['ejected'])
+        self.assertFalse(nodes['http://example.com:15672/api/']['ejected'])
+        calls = fake.node_calls['node2.example.com:15673']
+        client.post('/resources/foo/bind-app', data={'app-host': 'unit9'}, headers=self.auth_headers)
+        self.assertEqual(fake.node_calls['node2.example.com:15673'], calls)
+
+    def test_interrupted_calls(self):
+        custom_app = create_app()
+        custom_app.config.from_mapping(CONFIG, RMQ_ADAPTER=FakeManagementAPI(), RMQ_BULKHEAD_TIMEOUT=0.01,
+                                       RMQ_MGMT_HOSTS=['example.com', 'node2.example.com'])
+        with custom_app.app_context():
+            client = get_client()
+            with patch.object(client.session, 'get', side_effect=RuntimeError('interrupted')):
+                self.assertRaises(RuntimeError, client.request, 'get', 'whoami')
+            client.bulkhead = Bulkhead(1, 0.01)
+            with client.bulkhead:
+                self.assertRaises(Unavailable, client.request, 'get', 'whoami')
+            # neither call is left outstanding nor counted as a failure
+            self.assertEqual([(node.outstanding, node.failures) for node in client.balancer.nodes], [(0, 0), (0, 0)])
+
+
+class FakeManagementAPITest(unittest.TestCase):
+    auth_headers = {'Authorization': 'Basic {}'.format(base64.b64encode(b'foo:bar').decode('utf-8'))}
+
+    def setUp(self):
+        self.fake = FakeManagementAPI()
+        self.app = create_app()
+        self.app.config.from_mapping(CONFIG, RMQ_ADAPTER=self.fake)
+        self.client = self.app.test_client()
+
+    def test_path_template(self):
+        self.assertEqual(path_template('vhosts/foo'), 'vhosts/{vhost}')
+        self.assertEqual(path_template('permissions/foo/foo_bar_0123456789'), 'permissions/{vhost}/{user}')
+        self.assertEqual(path_template('users/bulk-delete'), 'users/bulk-delete')
+        self.assertEqual(path_template('vhosts?page=2&page_size=10'), 'vhosts')
+
+    def test_provisioning(self):
+        self.assertEqual(self.client.post('/resources', data={'name': 'myinstance'},
+                                          headers=self.auth_headers).status_code, 201)
+        response = self.client.post('/resources/myinstance/bind-app', data={'app-host': 'myapp.example.com'},
+                                    headers=self.auth_headers)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.client.get('/resources/myinstance/status', headers=self.auth_headers).status_code,
+                         204)
+
+        broker = self.fake.brokers['example.com:15672']
+        username = json.loads(response.data.decode('utf-8'))['RABBITMQ_USERNAME']
+        self.assertIn('myinstance', broker.vhosts)
+        self.assertIn(('myinstance', username), broker.permissions)
+        self.assertIn(('myinstance', ha_policy_name), broker.policies)
+        self.assertEqual(self.fake.calls['PUT', 'users/{user}'], 1)
+
+        self.assertEqual(self.client.delete('/resources/myinstance', headers=self.auth_headers).status_code, 200)
+        self.assertNotIn('myinstance', broker.vhosts)
+        self.assertNotIn(('myinstance', username), broker.permissions)
+
+    def test_failures(self):
+        self.fake.fail('put', 'policies/{vhost}/{name}', 500)
+        self.assertEqual(self.client.post('/resources', data={'name': 'myinstance'},
+                                          headers=self.auth_headers).status_code, 500)
+        # the vhost is rolled back
+        self.assertNotIn('myinstance', self.fake.brokers['example.com:15672'].vhosts)
+        self.assertEqual(self.fake.calls['DELETE', 'vhosts/{vhost}'], 1)
+        self.assertEqual(self.client.get('/resources/nope/status', headers=self.auth_headers).status_code, 500)
+
+    def test_pagination(self):
+        with self.app.app_context():
+            for number in range(5):
+                send('put', 'vhosts/vhost{}'.format(number))
+            items = stream_page('vhosts', 2, 2, ('name',))
+            self.assertEqual((list(items), items.page_count), ([{'name': 'vhost1'}, {'name': 'vhost2'}], 3))
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([], 0.5), 0)
+
+    def test_benchmark(self):
+        report = Benchmark(clients=2, iterations=2, binds=2, statuses=2, config=CONFIG).run()
+        self.assertEqual(sorted(report), ['add_instance', 'bind_app', 'status'])
+        self.assertEqual(report['add_instance']['requests'], 4)
+        self.assertEqual(report['bind_app']['requests'], 8)
+        self.assertEqual(report['status']['requests'], 8)
+        self.assertEqual(sum(stats['errors'] for stats in report.values()), 0)
+        self.assertEqual(report['bind_app']['upstream'], {'PUT users/{user}': 8, 'PUT permissions/{vhost}/{user}': 8})
+        # status checks are cached
+        self.assertEqual(report['status']['upstream'], {'GET aliveness-test/{vhost}': 4})
+
+
+class IdempotencyTest(unittest.TestCase):
+    auth_headers = FakeManagementAPITest.auth_headers
+
+    def setUp(self):
+        self.fake = FakeManagementAPI()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.app = create_app()
+        self.app.config.from_mapping(CONFIG, RMQ_ADAPTER=self.fake,
+                                     STATE_STORE_PATH=os.path.join(self.tmpdir, 'state.db'))
+        self.client = self.app.test_client()
+
+    def test_replay(self):
+        first = self.client.post('/resources', data={'name': 'myinstance'}, headers=self.auth_headers)
+        retry = self.client.post('/resources', data={'name': 'myinstance'}, headers=self.auth_headers)
+        self.assertEqual((first.status_code, retry.status_code), (201, 201))
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.fake.calls['PUT', 'vhosts/{vhost}'], 1)
+
+        bind = partial(self.client.post, '/resources/myinstance/bind-app', data={'app-host': 'myapp'})
+        first = bind(headers=self.auth_headers)
+        retry = bind(headers=self.auth_headers)
+        self.assertEqual(first.get_data(), retry.get_data())
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.fake.calls['PUT', 'users/{user}'], 1)
+        # the password of the unit is derived again rather than recorded
+        with self.app.app_context():
+            recorded = get_store()._conn.execute('SELECT data, headers FROM responses').fetchall()
+        self.assertEqual(len(recorded), 2)
+        self.assertNotIn(json.loads(first.data.decode('utf-8'))['RABBITMQ_PASSWORD'], repr(recorded))
+
+        # an explicit key tells requests apart
+        bind(headers=dict(self.auth_headers, **{'Idempotency-Key': 'abc'}))
+        bind(headers=dict(self.auth_headers, **{'Idempotency-Key': 'abc'}))
+        self.assertEqual(self.fake.calls['PUT', 'users/{user}'], 2)
+
+        # responses about deleted instances are not replayed
+        self.client.delete('/resources/myinstance', headers=self.auth_headers)
+        self.assertEqual(self.client.post('/resources', data={'name': 'myinstance'},
+                                          headers=self.auth_headers).status_code, 201)
+        self.assertEqual(self.fake.calls['PUT', 'vhosts/{vhost}'], 2)
+
+    def test_errors(self):
+        self.fake.fail('put', 'vhosts/{vhost}', 500)
+        self.assertEqual(self.client.post('/resources', data={'name': 'myinstance'},
+                                          headers=self.auth_headers).status_code, 500)
+        del self.fake.failures['PUT', 'vhosts/{vhost}']
+        self.assertEqual(self.client.post('/resources', data={'name': 'myinstance'},
+                                          headers=self.auth_headers).status_code, 201)
+
+    def test_in_flight(self):
+        self.fake.latency = 0.2
+        statuses = []
+
+        def add():
+            response = self.app.test_client().post('/resources', data={'name': 'myinstance'},
+                                                   headers=self.auth_headers)
+            statuses.append(response.status_code)
+
+        threads = [threading.Thread(target=add) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(statuses, [201] * 3)
+        self.assertEqual(self.fake.calls['PUT', 'vhosts/{vhost}'], 1)
+        with self.app.app_context():
+            self.assertEqual(idempotency_cache().stats()['coalesced'], 2)
+
+    def test_workers(self):
+        workers = []
+        for _ in range(2):
+            worker = create_app()
+            worker.config.from_mapping(CONFIG, RMQ_ADAPTER=self.fake,
+                                       STATE_STORE_PATH=self.app.config['STATE_STORE_PATH'])
+            workers.append(worker.test_client())
+        first, second = workers
+        bind = partial(second.post, '/resources/myinstance/bind-app', data={'app-host': 'myapp'},
+                       headers=self.auth_headers)
+        self.assertEqual(first.post('/resources', data={'name': 'myinstance'},
+                                    headers=self.auth_headers).status_code, 201)
+        self.assertEqual(second.post('/resources', data={'name': 'myinstance'},
+                                     headers=self.auth_headers).headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(bind().status_code, 201)
+
+        # unbinding on another worker stops the replays of every worker
+        first.delete('/resources/myinstance/bind-app', data={'app-host': 'myapp'}, headers=self.auth_headers)
+        response = bind()
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertIn(json.loads(response.data.decode('utf-8'))['RABBITMQ_USERNAME'],
+                      self.fake.brokers['example.com:15672'].users)
+
+        first.delete('/resources/myinstance', headers=self.auth_headers)
+        self.assertEqual(second.post('/resources', data={'name': 'myinstance'},
+                                     headers=self.auth_headers).status_code, 201)
+        self.assertIn('myinstance', self.fake.brokers['example.com:15672'].vhosts)
+
+    def test_memory_store(self):
+        workers = []
+        for _ in range(2):
+            worker = create_app()
+            worker.config.from_mapping(CONFIG, RMQ_ADAPTER=self.fake)
+            workers.append(worker.test_client())
+        first, second = workers
+        bind = partial(first.post, '/resources/myinstance/bind-app', data={'app-host': 'myapp'},
+                       headers=self.auth_headers)
+        first.post('/resources', data={'name': 'myinstance'}, headers=self.auth_headers)
+        bind()
+        # the other worker cannot tell this one about the unbind, so served requests are never replayed
+        second.delete('/resources/myinstance/bind-app', data={'app-host': 'myapp'}, headers=self.auth_headers)
+        response = bind()
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertIn(json.loads(response.data.decode('utf-8'))['RABBITMQ_USERNAME'],
+                      self.fake.brokers['example.com:15672'].users)
+
+
+class JobsTest(unittest.TestCase):
+    auth_headers = FakeManagementAPITest.auth_headers
+
+    def setUp(self):
+        self.fake = FakeManagementAPI()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.app = create_app()
+        self.app.config.from_mapping(CONFIG, RMQ_ADAPTER=self.fake, ASYNC_PROVISIONING=True, JOBS_POLL_INTERVAL=0.05,
+                                     STATE_STORE_PATH=os.path.join(self.tmpdir, 'state.db'))
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        if 'jobs' in self.app.extensions:
+            self.app.extensions['jobs'].stop()
+
+    def wait(self, job_id):
+        for _ in range(100):
+            job = json.loads(self.client.get('/jobs/{}'.format(job_id), headers=self.auth_headers).data.decode())
+            if job['state'] in ('done', 'failed'):
+                return job
+            time.sleep(0.02)
+        self.fail('Job {} did not finish'.format(job_id))
+
+    def test_add_instance(self):
+        self.fake.latency = 0.1
+        response = self.client.post('/resources', data={'name': 'myinstance'}, headers=self.auth_headers)
+        self.assertEqual(response.status_code, 202)
+        job_id = json.loads(response.data.decode('utf-8'))['job']
+        self.assertEqual(response.headers['X-Job-Id'], job_id)
+        self.assertTrue(response.headers['Location'].endswith('/jobs/{}'.format(job_id)))
+        self.assertEqual(self.client.get('/resources/myinstance/status', headers=self.auth_headers).status_code,
+                         202)
+
+        job = self.wait(job_id)
+        self.assertEqual((job['state'], job['kind'], job['instance']), ('done', 'add_instance', 'myinstance'))
+        self.assertIn('myinstance', self.fake.brokers['example.com:15672'].vhosts)
+        self.assertEqual(self.client.get('/resources/myinstance/status', headers=self.auth_headers).status_code,
+                         204)
+        self.assertEqual(self.client.get('/jobs/nope', headers=self.auth_headers).status_code, 404)
+
+    def test_memory_store(self):
+        # jobs in an in-memory queue would be lost on restart, and unknown to the other worker processes
+        self.app.config['STATE_STORE_PATH'] = None
+        self.assertEqual(self.client.post('/resources', data={'name': 'myinstance'},
+                                          headers=self.auth_headers).status_code, 201)
+        self.assertIn('myinstance', self.fake.brokers['example.com:15672'].vhosts)
+        self.assertNotIn('jobs', self.app.extensions)
+
+    def test_failure(self):
+        self.fake.fail('put', 'policies/{vhost}/{name}', 500)
+        response = self.client.post('/resources', data={'name': 'myinstance'}, headers=self.auth_headers)
+        job = self.wait(json.loads(response.data.decode('utf-8'))['job'])
+        self.assertEqual(job['state'], 'failed')
+        self.assertEqual(job['error'], 'Error, rabbitmq returned status code 500')
+        response = self.client.get('/resources/myinstance/status', headers=self.auth_headers)
+        self.assertEqual(response.status_code, 500)
+        self.assertIn(b'status code 500', response.data)
+        self.assertNotIn('myinstance', self.fake.brokers['example.com:15672'].vhosts)
+
+    def test_bind_app(self):
+        with self.app.app_context():
+            get_store().add_instance('myinstance')
+            send('put', 'vhosts/myinstance')
+            username, password = get_credentials().derive('myinstance', 'myapp')
+        response = self.client.post('/resources/myinstance/bind-app', data={'app-host': 'myapp'},
+                                    headers=self.auth_headers)
+        self.assertEqual(response.status_code, 202)
+        settings = json.loads(response.data.decode('utf-8'))
+        self.assertEqual((settings['RABBITMQ_USERNAME'], settings['RABBITMQ_PASSWORD']), (username, password))
+        job = self.wait(response.headers['X-Job-Id'])
+        self.assertEqual(job['state'], 'done')
+        self.assertIn(('myinstance', username), self.fake.brokers['example.com:15672'].permissions)
+
+    def test_delete_instance(self):
+        self.app.config['TEARDOWN_CHUNK_SIZE'] = 2
+        with self.app.app_context():
+            create_instance('myinstance')
+            for number in range(5):
+                bind_host('myinstance', 'unit{}'.format(number))
+            # bound by another worker, whose in-memory store this one does not see
+            username, password = get_credentials().derive('myinstance', 'unit5')
+            send('put', 'users/{}'.format(username), data=json.dumps({'password': password, 'tags': ''}))
+            send('put', 'permissions/myinstance/{}'.format(username), data=json.dumps(full_permissions))
+        broker = self.fake.brokers['example.com:15672']
+        other_user = sorted(broker.users)[0]
+
+        response = self.client.delete('/resources/myinstance', headers=self.auth_headers)
+        self.assertEqual(response.status_code, 202)
+        job = self.wait(response.headers['X-Job-Id'])
+        self.assertEqual((job['state'], job['kind']), ('done', 'delete_instance'))
+        self.assertEqual(job['progress'], {'users': 6, 'deleted': 6})
+        self.assertEqual(self.fake.calls['POST', 'users/bulk-delete'], 3)
+        self.assertEqual(self.fake.calls['DELETE', 'users/{user}'], 0)
+        self.assertNotIn('myinstance', broker.vhosts)
+        self.assertEqual(sorted(broker.users), [other_user])
+
+        # deleting it again is a no-op
+        job = self.wait(self.client.delete('/resources/myinstance', headers=self.auth_headers).headers['X-Job-Id'])
+        self.assertEqual((job['state'], job['progress']), ('done', {'users': 0, 'deleted': 0}))
+
+    def test_rotate_credentials(self):
+        # an in-memory store only knows the bindings made by the worker running the rotation
+        with patch.dict(self.app.config, STATE_STORE_PATH=None):
+            self.assertEqual(self.client.post('/credentials/rotate', headers=self.auth_headers).status_code, 400)
+            self.assertEqual(self.client.post('/credentials/retire', headers=self.auth_headers).status_code, 400)
+        self.app.config.update(ROTATION_BATCH_SIZE=2, ROTATION_CONCURRENCY=2, RMQ_BREAKER_THRESHOLD=100)
+        app_hosts = ['unit{}'.format(number) for number in range(6)]
+        with self.app.app_context():
+            create_instance('myinstance')
+            for app_host in app_hosts[:5]:
+                bind_host('myinstance', app_host)
+            old = dict((app_host, get_credentials().derive('myinstance', app_host)) for app_host in app_hosts)
+            self.app.config.update(SALT='newsalt', PREVIOUS_SALTS=['foooosalt'])
+            # bound since the salt changed, so already rotated
+            bind_host('myinstance', 'unit5')
+            new = dict((app_host, get_credentials().derive('myinstance', app_host)) for app_host in app_hosts)
+        broker = self.fake.brokers['example.com:15672']
+
+        self.fake.fail('post', 'definitions', 500)
+        self.fake.fail('put', 'users/{user}', 500)
+        job = self.wait(self.client.post('/credentials/rotate', headers=self.auth_headers).headers['X-Job-Id'])
+        self.assertEqual((job['state'], job['kind']), ('failed', 'rotate_credentials'))
+        self.assertEqual(job['progress'], {'bindings': 6, 'rotated': 1, 'failed': 5})
+        self.assertIn('5 of 6 bindings could not be rotated', job['error'])
+
+        # the rotation resumes with the bindings left
+        self.fake.failures.clear()
+        job = self.wait(self.client.post('/credentials/rotate', headers=self.auth_headers).headers['X-Job-Id'])
+        self.assertEqual((job['state'], job['progress']), ('done', {'bindings': 6, 'rotated': 6, 'failed': 0}))
+        self.assertEqual(self.fake.calls['POST', 'definitions'], 6)
+        job = self.wait(self.client.post('/credentials/rotate', headers=self.auth_headers).headers['X-Job-Id'])
+        self.assertEqual(job['progress'], {'bindings': 6, 'rotated': 6, 'failed': 0})
+        self.assertEqual(self.fake.calls['POST', 'definitions'], 6)
+
+        # both salts are accepted until the previous one is retired
+        with self.app.app_context():
+            self.assertEqual(get_store().bindings_of('myinstance'),
+                             dict((app_host, new[app_host][0]) for app_host in app_hosts))
+        for app_host in app_hosts:
+            self.assertEqual(broker.users[new[app_host][0]]['password'], new[app_host][1])
+            self.assertIn(('myinstance', new[app_host][0]), broker.permissions)
+        for app_host in app_hosts[:5]:
+            self.assertEqual(broker.users[old[app_host][0]]['password'], old[app_host][1])
+
+        job = self.wait(self.client.post('/credentials/retire', headers=self.auth_headers).headers['X-Job-Id'])
+        self.assertEqual((job['state'], job['kind']), ('done', 'retire_credentials'))
+        self.assertEqual(job['progress'], {'users': 6, 'deleted': 6, 'skipped': 0, 'failed': 0})
+        self.assertFalse(set(old[app_host][0] for app_host in app_hosts) & set(broker.users))
+        self.assertTrue(set(new[app_host][0] for app_host in app_hosts) <= set(broker.users))
+
+        self.app.config['PREVIOUS_SALTS'] = None
+        self.assertEqual(self.client.post('/credentials/retire', headers=self.auth_headers).status_code, 400)
+
+    def test_rotation_stale_binding(self):
+        with self.app.app_context():
+            for name in ('myinstance', 'gone'):
+                create_instance(name)
+                bind_host(name, 'unit0')
+            # the vhost of a binding the store still knows was deleted behind its back
+            send('delete', 'vhosts/gone')
+            self.app.config.update(SALT='newsalt', PREVIOUS_SALTS=['foooosalt'])
+            new = get_credentials().derive('myinstance', 'unit0')[0]
+
+        job = self.wait(self.client.post('/credentials/rotate', headers=self.auth_headers).headers['X-Job-Id'])
+        self.assertEqual(job['progress'], {'bindings': 2, 'rotated': 1, 'failed': 1})
+        self.assertIn('1 of 2 bindings could not be rotated', job['error'])
+        with self.app.app_context():
+            self.assertEqual(get_store().bindings_of('myinstance'), {'unit0': new})
+        self.assertIn(('myinstance', new), self.fake.brokers['example.com:15672'].permissions)
+
+        # only the stale binding is left to rotate
+        job = self.wait(self.client.post('/credentials/rotate', headers=self.auth_headers).headers['X-Job-Id'])
+        self.assertEqual(job['progress'], {'bindings': 2, 'rotated': 1, 'failed': 1})
+
+    def test_rotation_unbind(self):
+        with self.app.app_context():
+            create_instance('myinstance')
+            bind_host('myinstance', 'unit0')
+            old = generate_username('myinstance', 'unit0')
+            self.app.config.update(SALT='newsalt', PREVIOUS_SALTS=['foooosalt'])
+            bind_host('myinstance', 'unit1')
+            # not rotated yet, so its previous user is kept by retirements
+            self.assertEqual(retire_credentials(), None)
+            self.assertIn(old, self.fake.brokers['example.com:15672'].users)
+            unbind_host('myinstance', 'unit0')
+        self.assertNotIn(old, self.fake.brokers['example.com:15672'].users)
+        self.assertEqual(self.fake.calls['DELETE', 'users/{user}'], 0)
+
+    def test_claim(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'state.db')
+        queue1, queue2 = JobQueue(self.app, path, timeout=60), JobQueue(self.app, path, timeout=60)
+        with patch.object(JobQueue, 'start'):
+            job_id = queue1.enqueue('add_instance', 'foobar', name='foobar')
+        self.assertEqual(queue2.claim(), (job_id, 'add_instance', {'name': 'foobar'}))
+        self.assertIsNone(queue1.claim())
+        self.assertEqual(queue1.get(job_id)['state'], 'running')
+
+        # the worker process running it died
+        with patch('rabbitmqapi.jobs.time.time', return_value=time.time() + 120):
+            self.assertEqual(queue1.claim(), (job_id, 'add_instance', {'name': 'foobar'}))
+
+        with patch.dict(job_handlers, progress=lambda: report_progress(done=1, total=2)):
+            queue1.run(job_id, 'progress', {})
+        self.assertEqual(queue2.get(job_id)['progress'], {'done': 1, 'total': 2})
+        self.assertEqual(queue2.stats(), {'done': 1})
+
+
+class PlansTest(unittest.TestCase):
+    auth_headers = FakeManagementAPITest.auth_headers
+    plans = [
+        {'name': 'small', 'description': 'Mirrored on 2 nodes', 'ha': 'exactly', 'replicas': 2, 'lazy': True,
+         'max_length': 1000, 'message_ttl': 60000, 'max_connections': 10, 'max_queues': 5},
+        {'name': 'quorum', 'description': 'Quorum queues', 'ha': 'quorum'},
+    ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.fake = FakeManagementAPI()
+        self.app = create_app()
+        self.app.config.from_mapping(CONFIG, RMQ_ADAPTER=self.fake, PLANS=self.plans, RECONCILE_BATCH_INTERVAL=0,
+                                     STATE_STORE_PATH=os.path.join(self.tmpdir, 'state.db'))
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            send('get', 'overview')
+        self.broker = self.fake.brokers['example.com:15672']
+
+    def test_policies(self):
+        plans = Plans(self.plans)
+        self.assertEqual(plans.get('small').policies('foobar'), {'plan': {
+            'vhost': 'foobar', 'name': 'plan', 'pattern': '', 'apply-to': 'queues', 'priority': 0,
+            'definition': {'ha-mode': 'exactly', 'ha-params': 2, 'ha-sync-mode': 'automatic', 'queue-mode': 'lazy',
+                           'max-length': 1000, 'message-ttl': 60000},
+        }})
+        self.assertEqual(plans.get('small').limits(), {'max-connections': 10, 'max-queues': 5})
+        self.assertEqual(plans.get('quorum').policies('foobar'), {})
+        self.assertEqual(plans.get('quorum').vhost(), {'default_queue_type': 'quorum'})
+        self.assertIs(plans.get(None), plans.get('small'))
+        self.assertRaises(KeyError, plans.get, 'nope')
+        self.assertEqual(plans.of({'plan': None}).policies('foobar'),
+                         {ha_policy_name: dict(ha_policy, vhost='foobar')})
+        self.assertRaises(ValueError, Plan, 'broken', ha='some')
+
+        # without plans, only the plans placing instances in clusters are accepted, with the legacy HA policy
+        self.assertEqual(Plans(placement=['small']).get('small').policies('foobar'),
+                         {ha_policy_name: dict(ha_policy, vhost='foobar')})
+        self.assertRaises(KeyError, Plans().get, 'small')
+
+    def test_endpoint(self):
+        response = self.client.get('/resources/plans')
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(json.loads(response.data.decode('utf-8')), [
+            {'name': 'small', 'description': 'Mirrored on 2 nodes'},
+            {'name': 'quorum', 'description': 'Quorum queues'},
+        ])
+
+    def test_add_instance(self):
+        self.assertEqual(self.client.post('/resources', data={'name': 'one', 'plan': 'small'},
+                                          headers=self.auth_headers).status_code, 201)
+        self.assertEqual(self.broker.policies['one', 'plan']['definition']['ha-mode'], 'exactly')
+        self.assertEqual(self.broker.limits, {('one', 'max-connections'): 10, ('one', 'max-queues'): 5})
+
+        self.assertEqual(self.client.post('/resources', data={'name': 'two', 'plan': 'quorum'},
+                                          headers=self.auth_headers).status_code, 201)
+        self.assertEqual(self.broker.vhosts['two'], {'name': 'two', 'default_queue_type': 'quorum'})
+        self.assertNotIn(('two', 'plan'), self.broker.policies)
+
+        self.assertEqual(self.client.post('/resources', data={'name': 'three', 'plan': 'nope'},
+                                          headers=self.auth_headers).status_code, 400)
+        with self.app.app_context():
+            self.assertEqual(get_store().instance('one')['plan'], 'small')
+
+    def test_reconcile(self):
+        self.client.post('/resources', data={'name': 'one', 'plan': 'small'}, headers=self.auth_headers)
+        policy = self.broker.policies.pop(('one', 'plan'))
+        Reconciler(self.app).run_once()
+        self.assertEqual(self.broker.policies['one', 'plan'], policy)
+
+
+class FakeAMQPConnection(object):
+    def __init__(self, log):
+        self.log = log
+        self.is_open = True
+
+    def channel(self):
+        if not self.is_open:
+            raise IOError('Connection closed')
+        self.log.append('channel')
+        return self
+
+    def close(self):
+        self.log.append('close')
+
+
+class ChecksTest(unittest.TestCase):
+    auth_headers = FakeManagementAPITest.auth_headers
+
+    def setUp(self):
+        self.fake = FakeManagementAPI()
+        self.app = create_app()
+        self.app.config.from_mapping(CONFIG, RMQ_ADAPTER=self.fake, STATUS_CACHE_TTL=0, STATUS_CACHE_NEGATIVE_TTL=0,
+                                     PLANS=[{'name': 'basic', 'description': 'Basic'},
+                                            {'name': 'cheap', 'description': 'Cheap', 'check': 'vhost'}])
+        self.client = self.app.test_client()
+        for name, plan in (('one', 'basic'), ('two', 'cheap')):
+            self.client.post('/resources', data={'name': name, 'plan': plan}, headers=self.auth_headers)
+        self.broker = self.fake.brokers['example.com:15672']
+
+    def status(self, name):
+        return self.client.get('/resources/{}/status'.format(name), headers=self.auth_headers)
+
+    def test_plan_check(self):
+        response = self.status('one')
+        self.assertEqual((response.status_code, response.headers['X-Check']), (204, 'aliveness'))
+        self.assertGreaterEqual(float(response.headers['X-Check-Latency']), 0)
+        response = self.status('two')
+        self.assertEqual((response.status_code, response.headers['X-Check']), (204, 'vhost'))
+        self.assertEqual(self.fake.calls['GET', 'aliveness-test/{vhost}'], 1)
+
+        self.app.config['STATUS_CHECK'] = 'health'
+        self.assertEqual(self.status('one').headers['X-Check'], 'health')
+        with self.app.app_context():
+            self.assertEqual(get_metrics().status_check_duration.get(check='vhost'), 1)
+        self.assertRaises(ValueError, Plan, 'broken', check='ping')
+
+    def test_vhost(self):
+        self.broker.vhosts['two']['cluster_state'] = {'rabbit@a': 'running', 'rabbit@b': 'stopped'}
+        response = self.status('two')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.data, b'Error, vhost two is not running on rabbit@b')
+        del self.broker.vhosts['two']
+        self.assertEqual(self.status('two').data, b'Error, vhost two not found')
+
+    def test_health(self):
+        self.app.config.update(STATUS_CHECK='health', STATUS_CACHE_TTL=5)
+        self.assertEqual(self.status('one').status_code, 204)
+        # a single call checks every instance of the cluster
+        self.assertEqual(self.status('three').status_code, 204)
+        self.assertEqual(self.fake.calls['GET', 'health/checks/virtual-hosts'], 1)
+
+        self.broker.vhosts['two']['cluster_state'] = {'rabbit@a': 'stopped'}
+        self.app.extensions['status_cache'].clear()
+        response = self.status('one')
+        self.assertEqual(response.status_code, 500)
+        self.assertIn(b'Some virtual hosts are down: two', response.data)
+
+    def test_amqp(self):
+        log = []
+        connections = []
+
+        def connect(cluster, vhost):
+            connections.append(FakeAMQPConnection(log))
+            return connections[-1]
+
+        check = AMQPCheck(pool_size=1, connect=connect)
+        with self.app.app_context():
+            self.app.extensions.setdefault('checks', {})['amqp'] = check
+            self.app.config['STATUS_CHECK'] = 'amqp'
+        for _ in range(2):
+            response = self.status('one')
+            self.assertEqual((response.status_code, response.headers['X-Check']), (204, 'amqp'))
+        # the connection is kept open between checks
+        self.assertEqual((len(connections), log), (1, ['channel', 'close'] * 2))
+
+        # connections closed by the broker are opened again
+        connections[0].is_open = False
+        self.assertEqual(self.status('one').status_code, 204)
+        self.assertEqual(len(connections), 2)
+
+        # the least recently used connection is closed when the pool is full
+        with self.app.app_context():
+            check('two')
+        self.assertEqual(len(connections), 3)
+        self.assertEqual(log[-3:], ['close', 'channel', 'close'])
+
+        def refuse(cluster, vhost):
+            raise IOError('Connection refused')
+        check.connect = refuse
+        response = self.status('one')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.data, b'Error opening an AMQP channel: Connection refused')
+        check.close()
+
+        with patch('rabbitmqapi.checks.pika', None):
+            self.assertRaises(RuntimeError, AMQPCheck)
+
+
+class UsageTest(unittest.TestCase):
+    auth_headers = FakeManagementAPITest.auth_headers
+
+    def setUp(self):
+        self.fake = FakeManagementAPI()
+        self.app = create_app()
+        self.app.config.from_mapping(CONFIG, RMQ_ADAPTER=self.fake, USAGE_PAGE_SIZE=2)
+        self.client = self.app.test_client()
+        for name in ('foo', 'bar'):
+            self.client.post('/resources', data={'name': name}, headers=self.auth_headers)
+        broker = self.fake.brokers['example.com:15672']
+        broker.declare_queue('foo', 'q1', messages=10, unacknowledged=2, consumers=1, memory=1000, publish_rate=1.5,
+                             deliver_rate=1)
+        broker.declare_queue('foo', 'q2', messages=5, memory=500, publish_rate=0.5)
+        broker.declare_queue('foo', 'q3', consumers=2, memory=100)
+        broker.declare_queue('bar', 'q1', memory=200)
+        broker.connect('foo', 'guest')
+        broker.connect('bar', 'guest')
+        broker.connect('bar', 'guest')
+        self.foo = {'queues': 3, 'consumers': 3, 'memory': 1600, 'messages': 15, 'messages_ready': 13,
+                    'messages_unacknowledged': 2, 'publish_rate': 2.0, 'deliver_rate': 1, 'connections': 1}
+
+    def get(self, url):
+        response = self.client.get(url, headers=self.auth_headers)
+        return response.status_code, json.loads(response.data.decode('utf-8'))
+
+    def test_instance(self):
+        self.assertEqual(self.get('/resources/foo/usage'), (200, self.foo))
+        # the queues of foo take two pages, with only the columns needed
+        self.assertEqual(self.fake.calls['GET', 'queues/{vhost}'], 2)
+        self.assertEqual(self.fake.calls['GET', 'vhosts/{vhost}'], 1)
+
+        # reports are cached
+        self.get('/resources/foo/usage')
+        self.assertEqual(self.fake.calls['GET', 'vhosts/{vhost}'], 1)
+
+    def test_unknown_instance(self):
+        response = self.client.get('/resources/unknown/usage', headers=self.auth_headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_all(self):
+        status, data = self.get('/usage')
+        self.assertEqual(status, 200)
+        self.assertEqual(data['instances'], {
+            'foo': self.foo,
+            'bar': {'queues': 1, 'consumers': 0, 'memory': 200, 'messages': 0, 'messages_ready': 0,
+                    'messages_unacknowledged': 0, 'publish_rate': 0, 'deliver_rate': 0, 'connections': 2},
+        })
+        self.assertEqual(self.fake.calls['GET', 'queues'], 2)
+
+    def test_requires_auth(self):
+        self.assertEqual(self.client.get('/usage').status_code, 401)
+
+
+class MetricsTest(unittest.TestCase):
+    auth_headers = FakeManagementAPITest.auth_headers
+
+    def test_histogram(self):
+        histogram = Metric('latency_seconds', 'histogram', 'Latency', ('path',), (0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, path='vhosts/{vhost}')
+        self.assertEqual(histogram.get(path='vhosts/{vhost}'), 4)
+        self.assertEqual(histogram.render().split('\n'), [
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{path="vhosts/{vhost}",le="0.1"} 2',
+            'latency_seconds_bucket{path="vhosts/{vhost}",le="1"} 3',
+            'latency_seconds_bucket{path="vhosts/{vhost}",le="+Inf"} 4',
+            'latency_seconds_sum{path="vhosts/{vhost}"} 2.65',
+            'latency_seconds_count{path="vhosts/{vhost}"} 4',
+        ])
+
+    def test_counter(self):
+        counter = Metric('calls_total', 'counter', 'Calls', ('verb', 'status'))
+        counter.inc(verb='GET', status=200)
+        counter.inc(2, verb='GET', status=200)
+        counter.inc(verb='PUT', status='a "quoted"\nstatus')
+        self.assertEqual(counter.get(verb='GET', status=200), 3)
+        self.assertEqual(counter.render().split('\n')[2:], [
+            'calls_total{verb="GET",status="200"} 3',
+            'calls_total{verb="PUT",status="a \\"quoted\\"\\nstatus"} 1',
+        ])
+
+    def test_endpoint(self):
+        fake = FakeManagementAPI()
+        fake.fail('put', 'policies/{vhost}/{name}', 500)
+        test_app = create_app()
+        test_app.config.from_mapping(CONFIG, RMQ_ADAPTER=fake, RMQ_RETRIES=0)
+        client = test_app.test_client()
+
+        self.assertEqual(client.post('/resources', data={'name': 'myinstance'},
+                                     headers=self.auth_headers).status_code, 500)
+        with patch('requests.Session.get', side_effect=requests.Timeout):
+            self.assertEqual(client.get('/resources/myinstance/status', headers=self.auth_headers).status_code, 500)
+        self.assertEqual(client.get('/metrics').status_code, 401)
+
+        response = client.get('/metrics', headers=self.auth_headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        text = response.data.decode('utf-8')
+        for line in [
+            'rabbitmqapi_requests_total{endpoint="api.add_instance",method="POST",status="500"} 1',
+            'rabbitmqapi_requests_total{endpoint="api.metrics",method="GET",status="401"} 1',
+            'rabbitmqapi_requests_in_flight{endpoint="api.add_instance"} 0',
+            'rabbitmqapi_requests_in_flight{endpoint="api.metrics"} 1',
+            'rabbitmqapi_request_duration_seconds_count{endpoint="api.status",method="GET"} 1',
+            'rabbitmqapi_management_calls_total{verb="PUT",path="vhosts/{vhost}",status="204"} 1',
+            'rabbitmqapi_management_calls_total{verb="PUT",path="policies/{vhost}/{name}",status="500"} 1',
+            'rabbitmqapi_management_call_duration_seconds_count{verb="PUT",path="permissions/{vhost}/{user}"} 1',
+            'rabbitmqapi_management_call_errors_total{verb="PUT",path="policies/{vhost}/{name}",reason="status"} 1',
+            'rabbitmqapi_management_call_errors_total{verb="GET",path="aliveness-test/{vhost}",reason="timeout"} 1',
+            'rabbitmqapi_management_calls_in_flight{verb="DELETE",path="vhosts/{vhost}"} 0',
+        ]:
+            self.assertIn(line, text.split('\n'))
+        with test_app.app_context():
+            self.assertEqual(get_metrics().management_calls.get(verb='DELETE', path='vhosts/{vhost}', status=204), 1)
+
 
 class ApiTest(unittest.TestCase):
+    auth_headers = {
+        'Authorization': 'Basic {}'.format(base64.b64encode(
+            "{0}:{1}".format(CONFIG['USERNAME'], CONFIG['PASSWORD']).encode('utf-8')).decode('utf-8'))
+    }
 
     def assertSameJSON(self, json1, json2):
         """Tells whether two json strings, once decoded, are the same dictionary"""
@@ -171,6 +1779,10 @@ class ApiTest(unittest.TestCase):
             host=app.config['RMQ_HOST'],
             port=app.config['RMQ_MGMT_PORT']
         )
+        # the same requests are sent again with different RabbitMQ responses, they must not be replayed
+        idempotency = patch.dict(app.config, IDEMPOTENCY_TTL=0)
+        idempotency.start()
+        self.addCleanup(idempotency.stop)
 
     def test_plans(self):
         response = self.app.get('/resources/plans')
@@ -275,6 +1887,11 @@ class ApiTest(unittest.TestCase):
 
     @responses.activate
     def test_delete_instance(self):
+        responses.add(responses.GET, '{}/vhosts/foobar'.format(self.rmq_base_url), status=200, json={})
+        username = 'foobar_myapp.example.com_0123456789'
+        responses.add(responses.GET, '{}/vhosts/foobar/permissions'.format(self.rmq_base_url), status=200,
+                      json=[{'user': username}, {'user': app.config['RMQ_USER']}, {'user': 'someone'}])
+        responses.add(responses.POST, '{}/users/bulk-delete'.format(self.rmq_base_url), status=204)
         responses.add(
             responses.DELETE,
             '{}/vhosts/foobar'.format(self.rmq_base_url),
@@ -282,6 +1899,11 @@ class ApiTest(unittest.TestCase):
         )
         response = self.app.delete('/resources/foobar', headers=self.auth_headers)
         self.assertEqual(response.status_code, 200)
+        # only the users of the bound units are deleted
+        deleted = json.loads(responses.calls[2].request.body)['users']
+        self.assertIn(username, deleted)
+        self.assertNotIn(app.config['RMQ_USER'], deleted)
+        self.assertNotIn('someone', deleted)
 
     @responses.activate
     def test_bind_app(self):
@@ -458,5 +2080,97 @@ class ApiTest(unittest.TestCase):
         self.assertEqual(response.data,
                          b'''Error pinging rabbitmq, content: {"status":"ko"}''')
 
+    @responses.activate
+    def test_status_cache(self):
+        responses.add(
+            responses.GET,
+            '{}/aliveness-test/cached'.format(self.rmq_base_url),
+            status=200,
+            body='''{"status": "ok"}''',
+            content_type='application/json'
+        )
+        for _ in range(2):
+            response = self.app.get('/resources/cached/status', headers=self.auth_headers)
+            self.assertEqual(response.status_code, 204)
+        self.assertEqual(len(responses.calls), 1)
+
+        #
+        # Errors are cached too
+        #
+        responses.add(responses.GET, '{}/aliveness-test/cached-error'.format(self.rmq_base_url), status=500)
+        for _ in range(2):
+            response = self.app.get('/resources/cached-error/status', headers=self.auth_headers)
+            self.assertEqual(response.status_code, 500)
+        self.assertEqual(len(responses.calls), 2)
+
+        response = self.app.get('/stats', headers=self.auth_headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('hits', json.loads(response.get_data(as_text=True))['status_cache'])
+
+    @responses.activate
+    def test_bind_app_batch(self):
+        response = self.app.post('/resources/foobar/bind-app/batch', headers=self.auth_headers)
+        self.assertEqual(response.status_code, 400)
+
+        app_hosts = ['host{}.example.com'.format(i) for i in range(5)]
+        with app.app_context():
+            usernames = dict((host, generate_username('foobar', host)) for host in app_hosts)
+            passwords = dict((host, generate_password('foobar', host)) for host in app_hosts)
+
+        for host in app_hosts:
+            responses.add(responses.PUT, '{}/users/{}'.format(self.rmq_base_url, usernames[host]), status=200)
+            responses.add(responses.PUT, '{}/permissions/foobar/{}'.format(self.rmq_base_url, usernames[host]),
+                          status=400 if host == app_hosts[0] else 200)
+        responses.add(responses.DELETE, '{}/users/{}'.format(self.rmq_base_url, usernames[app_hosts[0]]), status=200)
+
+        response = self.app.post('/resources/foobar/bind-app/batch',
+                                 headers=self.auth_headers,
+                                 data={'app-host': app_hosts})
+        self.assertEqual(response.status_code, 500)
+        data = json.loads(response.get_data(as_text=True))
+        self.assertEqual(data['errors'], {app_hosts[0]: 'Error, rabbitmq returned status code 400'})
+        self.assertEqual(sorted(data['bindings']), app_hosts[1:])
+        for host in app_hosts[1:]:
+            # credentials are the same as the ones of the single unit bind
+            self.assertEqual(data['bindings'][host]['RABBITMQ_USERNAME'], usernames[host])
+            self.assertEqual(data['bindings'][host]['RABBITMQ_PASSWORD'], passwords[host])
+
+        response = self.app.post('/resources/foobar/bind-app/batch',
+                                 headers=self.auth_headers,
+                                 data={'app-host': app_hosts[1:]})
+        self.assertEqual(response.status_code, 201)
+
+    @responses.activate
+    def test_bind_app_batch_definitions(self):
+        app_hosts = ['host{}.example.com'.format(i) for i in range(3)]
+        responses.add(responses.POST, '{}/definitions'.format(self.rmq_base_url), status=204)
+        with patch.dict(app.config, BULK_DEFINITIONS=True):
+            response = self.app.post('/resources/foobar/bind-app/batch',
+                                     headers=self.auth_headers,
+                                     data={'app-host': app_hosts})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(responses.calls), 1)
+        document = json.loads(responses.calls[0].request.body)
+        bindings = json.loads(response.get_data(as_text=True))['bindings']
+        self.assertEqual(sorted(user['name'] for user in document['users']),
+                         sorted(binding['RABBITMQ_USERNAME'] for binding in bindings.values()))
+        self.assertEqual(set(permission['vhost'] for permission in document['permissions']), set(['foobar']))
+
+    @responses.activate
+    def test_unbind_app_batch(self):
+        app_hosts = ['host{}.example.com'.format(i) for i in range(3)]
+        with app.app_context():
+            for host in app_hosts:
+                responses.add(
+                    responses.DELETE, '{}/users/{}'.format(self.rmq_base_url, generate_username('foobar', host)),
+                    status=200,
+                )
+        response = self.app.delete('/resources/foobar/bind-app/batch',
+                                   headers=self.auth_headers,
+                                   data={'app-host': app_hosts})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['errors'], {})
+        self.assertEqual(len(responses.calls), 3)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,117 @@
+from __future__ import unicode_literals
+
+from flask import abort, current_app
+
+from .cache import TTLCache
+from .clusters import get_clusters
+from .http_client import send, stream_page
+from .utils import app_extension
+
+
+#
+# Figures reported for each instance, and the columns of the vhost and queue listings they are summed from
+#
+FIELDS = ('queues', 'consumers', 'memory', 'messages', 'messages_ready', 'messages_unacknowledged',
+          'publish_rate', 'deliver_rate', 'connections')
+VHOST_COLUMNS = (
+    ('messages', 'messages'),
+    ('messages_ready', 'messages_ready'),
+    ('messages_unacknowledged', 'messages_unacknowledged'),
+    ('publish_rate', 'message_stats.publish_details.rate'),
+    ('deliver_rate', 'message_stats.deliver_get_details.rate'),
+)
+QUEUE_COLUMNS = (('consumers', 'consumers'), ('memory', 'memory'))
+
+
+def field(item, column):
+    """The value of a column, like `message_stats.publish_details.rate`, of a listing item, 0 if it is missing"""
+    value = item
+    for name in column.split('.'):
+        value = value.get(name) if isinstance(value, dict) else None
+    return value or 0
+
+
+def listing(rel_url, columns, page_size, cluster):
+    """
+    Yield the items of a management API listing, fetching it a page at a time with only the given `columns`, and
+    parsing each page as it is read, so neither the listing nor a page is ever held in memory
+    """
+    page = page_count = 1
+    while page <= page_count:
+        items = stream_page(rel_url, page, page_size, columns, cluster=cluster)
+        for item in items:
+            yield item
+        page_count = items.page_count
+        page += 1
+
+
+def add(usage, item, columns):
+    for name, column in columns:
+        usage[name] += field(item, column)
+
+
+def instance_usage(name, page_size):
+    """Usage of the instance named <name>"""
+    cluster = get_clusters().locate(name)
+    response = send('get', 'vhosts/{}'.format(name), raise_for_status=False, cluster=cluster,
+                    params={'columns': ','.join(column for _, column in VHOST_COLUMNS)})
+    if response.status_code == 404:
+        return abort(404, 'Unknown instance {}'.format(name))
+    if not response.ok:
+        return abort(500, 'Error, rabbitmq returned status code {}'.format(response.status_code))
+
+    usage = dict.fromkeys(FIELDS, 0)
+    add(usage, response.json(), VHOST_COLUMNS)
+    for queue in listing('queues/{}'.format(name), [column for _, column in QUEUE_COLUMNS], page_size, cluster):
+        usage['queues'] += 1
+        add(usage, queue, QUEUE_COLUMNS)
+    for _ in listing('vhosts/{}/connections'.format(name), ['name'], page_size, cluster):
+        usage['connections'] += 1
+    return usage
+
+
+def cluster_usage(cluster, page_size):
+    """Usage of every instance of `cluster`, by name"""
+    usages = {}
+    for vhost in listing('vhosts', ['name'] + [column for _, column in VHOST_COLUMNS], page_size, cluster):
+        add(usages.setdefault(vhost['name'], dict.fromkeys(FIELDS, 0)), vhost, VHOST_COLUMNS)
+    for queue in listing('queues', ['vhost'] + [column for _, column in QUEUE_COLUMNS], page_size, cluster):
+        usage = usages.get(queue['vhost'])
+        # vhosts created since they were listed are left for the next time
+        if usage is not None:
+            usage['queues'] += 1
+            add(usage, queue, QUEUE_COLUMNS)
+    for connection in listing('connections', ['vhost'], page_size, cluster):
+        if connection['vhost'] in usages:
+            usages[connection['vhost']]['connections'] += 1
+    # the default vhost is not an instance
+    usages.pop('/', None)
+    return usages
+
+
+def usage_cache():
+    """Cache of the usage reports, see `usage`"""
+    return app_extension('usage_cache', lambda app: TTLCache(
+        maxsize=app.config['USAGE_CACHE_SIZE'],
+        ttl=app.config['USAGE_CACHE_TTL'],
+    ))
+
+
+def usage(name=None):
+    """
+    Queues, consumers, queue memory, message backlog, publish and deliver rates and connections of the instance
+    named <name>, or of every instance by name if not given.
+
+    Listings are streamed a page at a time and summed as they come, so instances with many queues take more calls to
+    the management API but not more memory. Reports are cached for USAGE_CACHE_TTL seconds.
+    """
+    page_size = current_app.config['USAGE_PAGE_SIZE']
+    if name is not None:
+        return usage_cache().get_or_compute(('instance', name), lambda: instance_usage(name, page_size))
+
+    def all_usages():
+        usages = {}
+        for cluster in get_clusters().clusters:
+            usages.update(cluster_usage(cluster, page_size))
+        return usages
+    return usage_cache().get_or_compute(('all',), all_usages)
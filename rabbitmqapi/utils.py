@@ -2,18 +2,105 @@ from __future__ import unicode_literals
 
 import hmac
 import hashlib
+import re
+import threading
+from collections import OrderedDict
 
 from flask import current_app
 
 
+_extension_lock = threading.RLock()
+
+#
+# Users created by `bind_app` are named after `generate_username`
+#
+service_username = re.compile(r'^.{1,20}_.{1,20}_[0-9a-f]{10}$')
+
+
+class Credentials(object):
+    """
+    Derives the RabbitMQ username and password of each bound unit from a salt.
+
+    The HMAC is keyed with the salt once, and copied for each derivation. Derived credentials are kept in a bounded
+    LRU map, since binds, batch binds and the reconciler derive the same ones over and over.
+    """
+
+    def __init__(self, salt, maxsize=4096):
+        self.salt = salt
+        self.maxsize = maxsize
+        self._keyed = hmac.new(salt.encode('utf-8'), digestmod=hashlib.sha1)
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _derive(self, key):
+        credentials = self._memo.pop(key, None)
+        if credentials is None:
+            hm = self._keyed.copy()
+            hm.update(key[0].encode('utf-8'))
+            hm.update(key[1].encode('utf-8'))
+            password = hm.hexdigest()
+            credentials = ('{}_{}_{}'.format(key[0][:20], key[1][:20], password[:10]), password)
+        # re-inserting the key marks it as the most recently used one
+        self._memo[key] = credentials
+        while len(self._memo) > self.maxsize:
+            self._memo.popitem(last=False)
+        return credentials
+
+    def derive(self, instance_name, app_host):
+        """The username and password of the unit `app_host` bound to the instance named <instance_name>"""
+        with self._lock:
+            return self._derive((instance_name, app_host))
+
+    def derive_many(self, instance_name, app_hosts):
+        """The username and password of each unit of `app_hosts` bound to the instance named <instance_name>"""
+        with self._lock:
+            return [self._derive((instance_name, app_host)) for app_host in app_hosts]
+
+
+def get_credentials(salt=None):
+    """Return the credentials derivation of the current app for `salt`, SALT by default"""
+    app = current_app._get_current_object()
+    salt = salt or app.config['SALT']
+    derivations = app_extension('credentials', lambda app: {})
+    try:
+        return derivations[salt]
+    except KeyError:
+        with _extension_lock:
+            return derivations.setdefault(salt, Credentials(salt, app.config['CREDENTIALS_CACHE_SIZE']))
+
+
+def previous_credentials():
+    """The credentials derivations of the PREVIOUS_SALTS, whose users are still accepted while SALT is rotated"""
+    return [get_credentials(salt) for salt in current_app.config['PREVIOUS_SALTS'] or ()]
+
+
+def all_credentials():
+    """The credentials derivations of SALT and of the PREVIOUS_SALTS"""
+    return [get_credentials()] + previous_credentials()
+
+
 def generate_password(instance_name, app_host):
     """Generate a password for a RabbitMQ user"""
-    hm = hmac.new(current_app.config['SALT'].encode('utf-8'), digestmod=hashlib.sha1)
-    hm.update(instance_name.encode('utf-8'))
-    hm.update(app_host.encode('utf-8'))
-    return hm.hexdigest()
+    return get_credentials().derive(instance_name, app_host)[1]
 
 
 def generate_username(instance_name, app_host):
     """Generate a username to be created in RabbitMQ"""
-    return '{}_{}_{}'.format(instance_name[:20], app_host[:20], generate_password(instance_name, app_host)[:10])
+    return get_credentials().derive(instance_name, app_host)[0]
+
+
+def app_extension(name, factory):
+    """
+    Return the `name` extension of the current app, built with `factory(app)` the first time it is requested.
+
+    Extensions are built lazily so they see the final configuration of the app, even when it is updated after
+    `create_app` returns.
+    """
+    app = current_app._get_current_object()
+    try:
+        return app.extensions[name]
+    except KeyError:
+        with _extension_lock:
+            if name not in app.extensions:
+                app.extensions[name] = factory(app)
+            return app.extensions[name]